@@ -0,0 +1,393 @@
+from multiprocessing import Event, Queue
+from dataclasses import dataclass, replace
+from itertools import count
+from pathlib import Path
+from queue import Empty
+from typing import Optional
+from time import perf_counter, perf_counter_ns
+import json
+import numpy as np
+
+from scanning import (
+    Scanner,
+    ScanningParameters,
+    ScanningState,
+    RoiParameters,
+    ImageReconstructor,
+    ParameterUpdate,
+)
+from streaming_save import StackSaver, SavingParameters, SavingStatus
+from frame_queues import FrameQueue, FrameAccounting, BackpressurePolicy
+from registration import Registration
+from raw_capture import RawSaver, RawCaptureParameters
+from replay import ReplaySource, SavedRecording
+from sequence_diagram import TraceCollector, TraceEvent, NoTrace
+from process_placement import apply_placement, default_placement
+from memory_budget import MemoryBudget
+
+
+@dataclass
+class ScanningConfig:
+    """ The scanning settings of the GUI, for runs without it
+    """
+
+    aspect_ratio: float = 1.0
+    voltage: float = 3.0
+    framerate: float = 2.0
+    shutter: bool = False
+    binning: int = 10
+    output_rate_khz: float = 400
+    laser_power: float = 10.0
+    n_turn: int = 10
+    n_extra_init: int = 100
+    pause: int = 1
+    # one of scanning_patterns.PATTERNS
+    pattern: str = "bidirectional"
+    reconstruction: str = "pixels"  # or "sparse"
+
+
+def convert_params(st) -> ScanningParameters:
+    """
+    Converts the scanning settings, from the GUI or a ScanningConfig, in
+    parameters appropriate for the laser scanning
+
+    """
+    pause = True if st.pause else False
+
+    sample_rate = st.output_rate_khz * 1000
+    n_total = sample_rate / st.framerate
+    # Loosens the restraint by 2 * the turn value, as the first and last line require one turn less.
+    n_total += 2 * st.n_turn
+
+    # Solving for the biggest image surface is basically a constraint problem of the form:
+    # ax**2 + bx + c = 0, where a is the aspect ratio (can be seen as y * x where y = a * x), b is the two turns,
+    # and c is the total number of available positions (given the desired frequency and sampling rate).
+    b = 2 * st.n_turn
+    if pause:  # If pause is enabled, additional points dependent on x will be added to the trajectory.
+        b += 1
+    n = (-b + np.sqrt(b**2 - (4 * st.aspect_ratio * -n_total))) / (2 * st.aspect_ratio) # Image dimensions.
+
+    # Change the y-axis to get the right aspect ratio.
+    n_x = int(np.floor(n))
+    n_y = int(np.floor(n * st.aspect_ratio))
+
+    # No need to get rid of 2 turns, we already added it before.
+    n_extra = int(n_total - ((n_x * b) + (n_x*n_y)))
+
+    mystery_offset = -int(round(st.output_rate_khz * 0.8))
+    voltage_max = st.voltage
+    if st.aspect_ratio >= 1:
+        voltage_y = voltage_max
+        voltage_x = voltage_y / st.aspect_ratio
+    else:
+        voltage_y = voltage_max * st.aspect_ratio
+        voltage_x = voltage_max
+
+    sp = ScanningParameters(
+        voltage_x=voltage_x,
+        voltage_y=voltage_y,
+        n_x=n_x,
+        n_y=n_y,
+        n_turn=st.n_turn,
+        n_extra=n_extra,
+        sample_rate_out=sample_rate,
+        shutter=st.shutter,
+        mystery_offset=mystery_offset,
+        framerate=st.framerate,
+        pause=pause,
+        pattern=st.pattern,
+        reconstruction=st.reconstruction,
+    )
+    return sp
+
+
+class AcquisitionPipeline:
+    """ The scanner, reconstructor, registration and saver processes and the
+    queues between them, without any GUI. Driven by the ExperimentState
+    of the GUI and by the headless runs
+
+    """
+
+    def __init__(
+        self,
+        diagnostics=False,
+        placement=None,
+        memory_budget=None,
+        publisher=None,
+        replay=None,
+        raw_capture=False,
+    ):
+        """
+        :param diagnostics: trace the pipeline processes
+        :param placement: dictionary of ProcessPlacement for the main, scanner,
+            reconstructor and saver processes, see process_placement.default_placement
+        :param memory_budget: MemoryBudget sizing the queues between the processes
+        :param publisher: PublisherParameters to publish the reconstructed frames
+            to external consumers, not published if None
+        :param replay: ReplayParameters of a saved recording which is replayed
+            instead of scanning, the scanner is then not started
+        :param raw_capture: save the samples of the PMTs of the recordings,
+            to reconstruct them again offline. Not available in replays
+        """
+        self.placement = placement if placement is not None else default_placement()
+        # numbers the parameter updates, see ParameterUpdate
+        self.generations = count(1)
+        self.memory_budget = (
+            memory_budget if memory_budget is not None else MemoryBudget()
+        )
+        self.tracing = None
+        self.trace = NoTrace()
+        if diagnostics:
+            self.tracing = TraceCollector(["main", "scanner", "reconstructor", "saver"])
+            self.trace = self.tracing.buffers["main"]
+
+        self.experiment_start_event = Event()
+        self.duration_queue = Queue()
+        self.scanner = Scanner(
+            self.experiment_start_event,
+            duration_queue=self.duration_queue,
+            max_queuesize=self.memory_budget.allocation_mbytes("scanner"),
+            trace=self.trace_buffer("scanner"),
+            placement=self.placement.get("scanner"),
+        )
+        self.registration = Registration(
+            self.scanner.stop_event, placement=self.placement.get("registration")
+        )
+        self.raw_saver = None
+        if raw_capture and replay is None:
+            self.memory_budget.include("raw")
+            self.raw_saver = RawSaver(
+                self.scanner.stop_event,
+                max_mbytes=self.memory_budget.allocation_mbytes("raw"),
+                placement=self.placement.get("raw_saver"),
+            )
+        reconstructor_options = dict(
+            max_mbytes_queue=self.memory_budget.allocation_mbytes("reconstructor"),
+            trace=self.trace_buffer("reconstructor"),
+            placement=self.placement.get("reconstructor"),
+            registration_queue=self.registration.frame_queue,
+            registration_every=self.registration.every_n,
+            publisher_parameters=publisher,
+            raw_queue=self.raw_saver.frame_queue if self.raw_saver is not None else None,
+            raw_capture_event=(
+                self.raw_saver.capture_event if self.raw_saver is not None else None
+            ),
+            raw_generation_queue=(
+                self.raw_saver.generation_queue if self.raw_saver is not None else None
+            ),
+        )
+        self.replay = replay
+        if replay is None:
+            self.replayed = None
+            self.reconstructor = ImageReconstructor(
+                self.scanner.data_queue, self.scanner.stop_event, **reconstructor_options
+            )
+        else:
+            self.replayed = SavedRecording(replay.path)
+            self.reconstructor = ReplaySource(
+                replay,
+                self.experiment_start_event,
+                self.duration_queue,
+                self.scanner.n_frames_queue,
+                self.scanner.stop_event,
+                **reconstructor_options
+            )
+        self.save_queue = FrameQueue(
+            "saver",
+            max_mbytes=self.memory_budget.allocation_mbytes("saver"),
+            policy=BackpressurePolicy.NEVER_DROP,
+            stop_event=self.scanner.stop_event,
+        )
+        self.frame_accounting = FrameAccounting(self.frame_queues())
+        self.saver = StackSaver(
+            self.scanner.stop_event,
+            self.save_queue,
+            self.scanner.n_frames_queue,
+            trace=self.trace_buffer("saver"),
+            placement=self.placement.get("saver"),
+        )
+        self.scanning_parameters: Optional[ScanningParameters] = None
+        self.roi_parameters: Optional[RoiParameters] = None
+        self.save_status: Optional[SavingStatus] = None
+
+    def start(self):
+        if self.replay is None:
+            self.scanner.start()
+        self.reconstructor.start()
+        self.saver.start()
+        self.registration.start()
+        if self.raw_saver is not None:
+            self.raw_saver.start()
+        # the main process is moved only after the others are started, so
+        # they do not inherit its affinity
+        apply_placement("main", self.placement.get("main"))
+
+    def stop(self):
+        self.scanner.stop_event.set()
+        if self.replay is None:
+            self.scanner.join()
+        self.reconstructor.join()
+        self.registration.join()
+        if self.raw_saver is not None:
+            self.raw_saver.join()
+
+    def trace_buffer(self, source):
+        if self.tracing is None:
+            return None
+        return self.tracing.buffers[source]
+
+    def export_trace(self, path):
+        """ Writes the spans traced so far by all the processes
+        in the Chrome trace format
+
+        """
+        if self.tracing is not None:
+            self.tracing.export_chrome_trace(path)
+
+    @property
+    def saving(self):
+        return self.saver.saving_signal.is_set()
+
+    def frame_queues(self):
+        queues = [
+            self.scanner.data_queue,
+            self.reconstructor.output_queue,
+            self.save_queue,
+        ]
+        if self.raw_saver is not None:
+            queues.append(self.raw_saver.frame_queue)
+        return queues
+
+    def seconds_buffered(self):
+        return {
+            queue.name: self.memory_budget.seconds_buffered(
+                queue.name, self.scanning_parameters
+            )
+            for queue in self.frame_queues()
+        }
+
+    def set_saving_policies(self, saving):
+        """ While saving no frame can be dropped on the way to the saver,
+        in preview the newest frames are kept
+
+        """
+        policy = (
+            BackpressurePolicy.NEVER_DROP if saving else BackpressurePolicy.DROP_OLDEST
+        )
+        self.scanner.data_queue.policy = policy
+        self.reconstructor.output_queue.policy = policy
+
+    def write_frame_accounting(self, output_dir):
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with open(output_dir / "frame_accounting.json", "w") as f:
+            json.dump(self.frame_accounting.summary(), f)
+
+    def send_scan_params(self, sp: ScanningParameters):
+        self.scanning_parameters = sp
+        update = ParameterUpdate(next(self.generations), sp)
+        if self.replay is None:
+            self.scanner.parameter_queue.put(update)
+        self.memory_budget.apply(self.frame_queues(), sp)
+        self.reconstructor.parameter_queue.put(update)
+
+    def set_scanning_state(self, sp: ScanningParameters, scanning_state: ScanningState):
+        update = ParameterUpdate(
+            next(self.generations), replace(sp, scanning_state=scanning_state)
+        )
+        if self.replay is None:
+            self.scanner.parameter_queue.put(update)
+        else:
+            # the replay follows the scanning state in place of the scanner
+            self.reconstructor.parameter_queue.put(update)
+
+    def send_roi_params(self, rp: RoiParameters):
+        self.roi_parameters = rp
+        update = ParameterUpdate(next(self.generations), rp)
+        if self.replay is None:
+            self.scanner.roi_queue.put(update)
+        self.reconstructor.roi_queue.put(update)
+
+    def send_save_params(self, saving_parameters: SavingParameters):
+        if self.replayed is not None:
+            saving_parameters = replace(
+                saving_parameters, plane_size=self.replayed.plane_size
+            )
+        self.saver.saving_parameter_queue.put(saving_parameters)
+
+    def start_plane(
+        self,
+        sp: ScanningParameters,
+        duration,
+        saving_parameters: Optional[SavingParameters] = None,
+    ):
+        """ Starts scanning a plane for the given duration, a new recording
+        is started if saving parameters are given
+
+        """
+        self.duration_queue.put(duration)
+        self.set_scanning_state(sp, ScanningState.EXPERIMENT_RUNNING)
+        if saving_parameters is not None:
+            self.set_saving_policies(True)
+            self.frame_accounting.start()
+            self.send_save_params(saving_parameters)
+            self.saver.saving_signal.set()
+            if self.raw_saver is not None:
+                self.raw_saver.parameter_queue.put(
+                    RawCaptureParameters(
+                        saving_parameters.output_dir,
+                        replace(sp, scanning_state=ScanningState.EXPERIMENT_RUNNING),
+                        self.roi_parameters
+                        if self.roi_parameters is not None
+                        else RoiParameters(),
+                    )
+                )
+                self.raw_saver.capture_event.set()
+        if self.raw_saver is not None and self.raw_saver.capture_event.is_set():
+            # the frames of the plane are the ones read after this time
+            self.raw_saver.plane_queue.put(perf_counter())
+        self.experiment_start_event.set()
+
+    def end_plane(self):
+        self.experiment_start_event.clear()
+
+    def stop_saving(self, output_dir):
+        self.saver.saving_signal.clear()
+        if self.raw_saver is not None:
+            self.raw_saver.capture_event.clear()
+        self.set_saving_policies(False)
+        self.write_frame_accounting(output_dir)
+
+    def get_frame(self):
+        """ Returns the header and the images of the next reconstructed frame
+        """
+        try:
+            t_start = perf_counter_ns()
+            header, images = self.reconstructor.output_queue.get(timeout=0.001)
+            self.trace.span(TraceEvent.QUEUE_GET, t_start)
+            return header, images
+        except Empty:
+            return None
+
+    def save_frame(self, images, header):
+        t_start = perf_counter_ns()
+        self.save_queue.put(images, header)
+        self.trace.span(TraceEvent.QUEUE_PUT, t_start)
+
+    def get_save_status(self) -> Optional[SavingStatus]:
+        try:
+            self.save_status = self.saver.saved_status_queue.get(timeout=0.001)
+            return self.save_status
+        except Empty:
+            pass
+        return None
+
+    def get_display_frame(self):
+        """ Returns the header, with the display levels, and the latest
+        display-ready frame rendered by the reconstructor
+
+        """
+        try:
+            return self.reconstructor.display_queue.get(timeout=0.001)
+        except Empty:
+            return None
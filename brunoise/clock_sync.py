@@ -0,0 +1,271 @@
+from collections import deque, namedtuple
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import perf_counter
+import flammkuchen as fl
+import numpy as np
+import zmq
+
+# a ping, t_send and t_receive on the local clock, the others on the remote one
+ClockPing = namedtuple(
+    "ClockPing", "t_send t_remote_receive t_remote_send t_receive"
+)
+
+PING_KEY = "clock_ping"
+
+
+def answer_clock_ping(request, t_receive, clock=perf_counter):
+    """ For the stimulus side: the reply to a ping, to be sent right away,
+    or None if the request is not a ping, e.g. the parameters of a trial
+
+    :param request: the JSON request received
+    :param t_receive: time at which the request was received, on clock
+    :param clock: the clock the stimulus times are given in
+    """
+    if not isinstance(request, dict) or PING_KEY not in request:
+        return None
+    return {PING_KEY: request[PING_KEY], "t_receive": t_receive, "t_send": clock()}
+
+
+class ClockServer(Thread):
+    """ For the stimulus side: answers the clock pings on a port of its own,
+    with the times of the given clock. The pings are never sent to the
+    server of the trials, which starts a trial on any request it receives
+
+    """
+
+    def __init__(self, zmq_tcp_address="tcp://*:5557", clock=perf_counter):
+        super().__init__(daemon=True)
+        self.zmq_tcp_address = zmq_tcp_address
+        self.clock = clock
+        self.stopped = Event()
+        self.ready = Event()
+
+    def run(self):
+        context = zmq.Context()
+        with context.socket(zmq.REP) as socket:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.bind(self.zmq_tcp_address)
+            self.ready.set()
+            while not self.stopped.is_set():
+                if socket.poll(50, zmq.POLLIN):
+                    request = socket.recv_json()
+                    reply = answer_clock_ping(request, self.clock(), self.clock)
+                    socket.send_json(
+                        reply if reply is not None else dict(error="not a clock ping")
+                    )
+        context.term()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def offset_and_delay(ping: ClockPing):
+    """ Offset of the remote clock from the local one and round trip
+    delay of the ping, as in NTP
+    """
+    offset = (
+        (ping.t_remote_receive - ping.t_send) + (ping.t_remote_send - ping.t_receive)
+    ) / 2
+    delay = (ping.t_receive - ping.t_send) - (
+        ping.t_remote_send - ping.t_remote_receive
+    )
+    return offset, delay
+
+
+class ClockModel:
+    """ The remote clock as the local one plus an offset which drifts
+    linearly, fitted on the pings with the shortest round trips, whose
+    offsets are the least skewed by asymmetric delays
+
+    """
+
+    def __init__(self, pings=(), delay_quantile=0.5):
+        """
+        :param delay_quantile: fraction of the pings, the fastest ones,
+            used for the fit
+        """
+        self.delay_quantile = delay_quantile
+        self.t_reference = 0.0
+        self.offset = 0.0
+        self.drift = 0.0
+        self.precision = np.inf
+        self.fit(pings)
+
+    def fit(self, pings):
+        if len(pings) == 0:
+            return
+        pings = np.array(pings, dtype=np.float64).reshape(-1, 4)
+        offsets, delays = offset_and_delay(ClockPing(*pings.T))
+        t_local = (pings[:, 0] + pings[:, 3]) / 2
+        used = delays <= np.quantile(delays, self.delay_quantile)
+        self.t_reference = t_local[used].mean()
+        if used.sum() > 2 and np.ptp(t_local[used]) > 0:
+            self.drift, self.offset = np.polyfit(
+                t_local[used] - self.t_reference, offsets[used], 1
+            )
+        else:
+            self.drift = 0.0
+            self.offset = offsets[used].mean()
+        # the offset of a ping is within half its round trip of the true one
+        self.precision = delays[used].max() / 2
+
+    def remote_time(self, t_local):
+        t_local = np.asarray(t_local)
+        return t_local + self.offset + self.drift * (t_local - self.t_reference)
+
+    def local_time(self, t_remote):
+        t_remote = np.asarray(t_remote)
+        return (
+            t_remote - self.offset + self.drift * self.t_reference
+        ) / (1 + self.drift)
+
+
+class ClockSync(Thread):
+    """ Estimates the offset of the clock of the stimulus computer from the
+    perf_counter of the microscope, on which the frames are timed, by pinging
+    the ClockServer of the stimulus computer every interval. The ClockServer
+    has a port of its own, apart from the one of the trials, and the times
+    of the pings are taken right at the sending and the receiving
+
+    """
+
+    def __init__(
+        self,
+        zmq_tcp_address="tcp://localhost:5557",
+        interval=1.0,
+        timeout=1.0,
+        max_pings=100000,
+        model_pings=120,
+    ):
+        """
+        :param max_pings: pings kept for the alignment tables
+        :param model_pings: last pings the running model is fitted on
+        """
+        super().__init__(daemon=True)
+        self.zmq_tcp_address = zmq_tcp_address
+        self.interval = interval
+        self.timeout = timeout
+        self.model_pings = model_pings
+        self.pings = deque(maxlen=max_pings)
+        self.lock = Lock()
+        self.model = ClockModel()
+        self.stopped = Event()
+        self.n_lost = 0
+        self.unsupported = False
+
+    def open_socket(self, context):
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.zmq_tcp_address)
+        return socket
+
+    def ping(self, socket):
+        """ Returns the ping, or None if the reply did not come in time
+        """
+        t_send = perf_counter()
+        socket.send_json({PING_KEY: t_send})
+        if not socket.poll(int(self.timeout * 1000), zmq.POLLIN):
+            return None
+        reply = socket.recv_json()
+        t_receive = perf_counter()
+        if not isinstance(reply, dict) or reply.get(PING_KEY) != t_send:
+            self.unsupported = True
+            return None
+        return ClockPing(t_send, reply["t_receive"], reply["t_send"], t_receive)
+
+    def run(self):
+        context = zmq.Context()
+        socket = self.open_socket(context)
+        while not self.stopped.is_set():
+            ping = self.ping(socket)
+            if self.unsupported:
+                print(
+                    "{} does not answer the clock pings, the clocks are "
+                    "not synchronized".format(self.zmq_tcp_address)
+                )
+                break
+            if ping is None:
+                # a REQ socket without a reply cannot send again
+                socket.close(linger=0)
+                socket = self.open_socket(context)
+                if self.n_lost == 0:
+                    print("No clock server at {} yet".format(self.zmq_tcp_address))
+                self.n_lost += 1
+            else:
+                with self.lock:
+                    self.pings.append(ping)
+                    self.model = ClockModel(list(self.pings)[-self.model_pings :])
+            self.stopped.wait(self.interval)
+        socket.close(linger=0)
+        context.term()
+
+    def current_model(self):
+        with self.lock:
+            return self.model
+
+    def alignment_table(self, t_start=-np.inf, t_end=np.inf):
+        """ The pings between the times, on the local clock, and the model
+        fitted on them, to align the times of a recording afterwards
+        """
+        with self.lock:
+            pings = [
+                ping
+                for ping in self.pings
+                if t_start <= ping.t_send and ping.t_receive <= t_end
+            ]
+        return alignment_table(pings)
+
+    def write_alignment(self, path, t_start=-np.inf, t_end=np.inf):
+        table = self.alignment_table(t_start, t_end)
+        fl.save(path, table)
+        return table
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def alignment_table(pings):
+    pings = np.array(pings, dtype=np.float64).reshape(-1, 4)
+    offsets, delays = offset_and_delay(ClockPing(*pings.T))
+    model = ClockModel(pings)
+    return dict(
+        **{name: pings[:, i] for i, name in enumerate(ClockPing._fields)},
+        offset=offsets,
+        delay=delays,
+        model=dict(
+            t_reference=model.t_reference,
+            offset=model.offset,
+            drift=model.drift,
+            precision=model.precision,
+        ),
+    )
+
+
+def load_alignment(path):
+    """ The ClockModel saved with a recording, whose remote_time converts
+    the times of the frames in times of the stimulus computer
+    """
+    table = fl.load(path)
+    model = ClockModel()
+    for name, value in table["model"].items():
+        setattr(model, name, float(value))
+    return model
+
+
+def stimulus_frame_times(path):
+    """ Times of the frames of a recording, of shape (n_t, n_z), on the clock
+    of the stimulus computer, from the sample clock if all frames have it
+    """
+    path = Path(path)
+    saved = fl.load(path / "time.h5")
+    if not isinstance(saved, dict) or "t_plane_start" not in saved:
+        raise ValueError("{} has no start times of the planes".format(path))
+    clock = "t_sample" if np.all(np.isfinite(saved["t_sample"])) else "t"
+    times = np.asarray(saved[clock])
+    local_times = times.reshape(times.shape[0], -1) + np.asarray(
+        saved[clock + "_plane_start"]
+    )
+    return load_alignment(path / "clock_alignment.h5").remote_time(local_times)
@@ -0,0 +1,202 @@
+from concurrent.futures import Future, TimeoutError
+from queue import Empty, SimpleQueue
+from threading import Event, Thread
+import zmq
+
+
+class ControlServer(Thread):
+    """ Answers the requests of automation scripts on a ZMQ REP socket.
+    A request is a JSON object with the name of the command and its
+    arguments, e.g. {"command": "set_settings", "settings": {...}}, the reply
+    is {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+    The commands are run by the main loop through execute_pending, so that
+    the settings and the devices are only ever touched from the GUI thread
+
+    """
+
+    def __init__(self, zmq_tcp_address="tcp://127.0.0.1:5560", timeout=30.0):
+        """
+        :param timeout: s to wait for the main loop to run a command
+        """
+        super().__init__(daemon=True)
+        self.zmq_tcp_address = zmq_tcp_address
+        self.timeout = timeout
+        self.requests = SimpleQueue()
+        self.stopped = Event()
+        self.ready = Event()
+
+    def run(self):
+        context = zmq.Context()
+        with context.socket(zmq.REP) as socket:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.bind(self.zmq_tcp_address)
+            self.ready.set()
+            while not self.stopped.is_set():
+                if not socket.poll(50, zmq.POLLIN):
+                    continue
+                try:
+                    request = socket.recv_json()
+                except ValueError as e:
+                    socket.send_json(dict(ok=False, error="invalid JSON: {}".format(e)))
+                    continue
+                future = Future()
+                self.requests.put((request, future))
+                try:
+                    reply = dict(ok=True, result=future.result(self.timeout))
+                except TimeoutError:
+                    future.cancel()
+                    reply = dict(ok=False, error="not run within {} s".format(self.timeout))
+                except Exception as e:
+                    reply = dict(ok=False, error="{}: {}".format(type(e).__name__, e))
+                try:
+                    socket.send_json(reply)
+                except (TypeError, ValueError) as e:
+                    # the reply is serialized before sending, so one still has to go
+                    socket.send_json(
+                        dict(
+                            ok=False, error="result not JSON serializable: {}".format(e)
+                        )
+                    )
+        context.term()
+
+    def execute_pending(self, commands):
+        """ Runs the requests received since the last call
+
+        :param commands: dictionary of the callables of the commands, which
+            are called with the arguments of the request
+        """
+        while True:
+            try:
+                request, future = self.requests.get_nowait()
+            except Empty:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if not isinstance(request, dict) or "command" not in request:
+                    raise ValueError("a request needs a command")
+                arguments = dict(request)
+                name = arguments.pop("command")
+                if name not in commands:
+                    raise ValueError(
+                        "unknown command {}, available: {}".format(
+                            name, ", ".join(sorted(commands.keys()))
+                        )
+                    )
+                future.set_result(commands[name](**arguments))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class StateCommands:
+    """ The commands of the control server, on the ExperimentState
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def commands(self):
+        return dict(
+            status=self.status,
+            get_settings=self.get_settings,
+            set_settings=self.set_settings,
+            start_recording=self.start_recording,
+            stop_recording=self.stop_recording,
+            pause=self.pause,
+            resume=self.resume,
+            move_motor=self.move_motor,
+            motor_state=self.motor_state,
+        )
+
+    def status(self):
+        state = self.state
+        save_status = state.save_status
+        accounting = state.frame_accounting
+        counts = accounting.counts()
+        return dict(
+            saving=state.saving,
+            starting=state.starting,
+            start_error=state.start_error,
+            paused=state.paused,
+            stack_phase=state.zstack.phase.name,
+            i_plane=state.zstack.i_plane,
+            save_status=(
+                dict(
+                    i_t=save_status.i_t,
+                    i_z=save_status.i_z,
+                    n_t=save_status.target_params.n_t,
+                    n_z=save_status.target_params.n_z,
+                )
+                if save_status is not None
+                else None
+            ),
+            queues={
+                name: dict(counts[name], queued=queue.n_queued())
+                for name, queue in accounting.queues.items()
+            },
+            seconds_buffered=state.seconds_buffered(),
+            stage={axis: motor.get_position() for axis, motor in state.motors.items()},
+            laser_power=state.power_service.position_percent,
+        )
+
+    def get_settings(self):
+        return {
+            settings.name: settings.params.values for settings in self.state.all_settings()
+        }
+
+    def set_settings(self, settings):
+        """ Sets the given settings, of the form {"scanning": {"framerate": 3}},
+        with one reconfiguration of the pipeline
+        """
+        self.state.apply_settings(settings)
+        return self.get_settings()
+
+    def start_recording(self, pause_after=False):
+        """ Requests the first trial from Stytra, the recording starts once
+        it answers, as reported by the status
+        """
+        if self.state.saving or self.state.starting:
+            raise RuntimeError("already recording")
+        self.state.pause_after = pause_after
+        self.state.start_experiment()
+        return True
+
+    def stop_recording(self):
+        if not self.state.saving:
+            return False
+        self.state.end_experiment(force=True)
+        return True
+
+    def pause(self):
+        if self.state.saving:
+            raise RuntimeError("cannot pause while recording")
+        self.state.pause_scanning()
+        return True
+
+    def resume(self):
+        if self.state.saving:
+            raise RuntimeError("cannot resume while recording")
+        self.state.restart_scanning()
+        return True
+
+    def move_motor(self, axis, position=None, displacement=None):
+        """ Starts moving the axis to the position or by the displacement,
+        in mm, returns the id of the command to query its state with motor_state
+        """
+        if not self.state.motors_ready():
+            raise RuntimeError("the motors are not ready")
+        if (position is None) == (displacement is None):
+            raise ValueError("give either a position or a displacement")
+        motor = self.state.motors[axis]
+        if position is not None:
+            return motor.move_abs(position)
+        return motor.move_rel(displacement)
+
+    def motor_state(self, command_id):
+        """ One of sent, done, settled and error
+        """
+        return self.state.motor_client.state(command_id)
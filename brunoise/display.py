@@ -0,0 +1,140 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional
+from streaming_save import SAVED_SCALE
+
+# images are quantized with the same step used for saving before
+# the lookup, so that the lookup tables cover the full range of int16
+QUANTIZATION_STEP = SAVED_SCALE
+LUT_SIZE = 2 ** 16
+LUT_OFFSET = 2 ** 15
+
+
+@dataclass
+class DisplayParameters:
+    channels: str = "g"  # "g", "r" or "gr" for the two-channel composite
+    # (min, max) for the green and red channel, if None set from the next frame
+    levels: Optional[tuple] = None
+    auto_levels: bool = True
+    percentile_low: float = 1.0
+    percentile_high: float = 99.5
+    smoothing: float = 0.8
+
+
+class AutoLevels:
+    """ Live contrast: robust percentiles computed on a strided subsample of
+    each channel, smoothed exponentially over frames
+
+    """
+
+    def __init__(self, n_subsample=128 * 128):
+        self.n_subsample = n_subsample
+        self.levels = None
+
+    def reset(self):
+        self.levels = None
+
+    def subsample(self, image):
+        stride = max(int(np.sqrt(image.size / self.n_subsample)), 1)
+        return image[::stride, ::stride]
+
+    def update(self, images, parameters: DisplayParameters):
+        new_levels = [
+            np.percentile(
+                self.subsample(image),
+                (parameters.percentile_low, parameters.percentile_high),
+            )
+            for image in images
+        ]
+        if self.levels is None:
+            self.levels = new_levels
+        else:
+            self.levels = [
+                parameters.smoothing * old + (1 - parameters.smoothing) * new
+                for old, new in zip(self.levels, new_levels)
+            ]
+        return tuple((float(lo), float(hi)) for lo, hi in self.levels)
+
+
+def make_lut(level_min, level_max):
+    """ Lookup table from quantized image values to uint8
+    """
+    values = (np.arange(LUT_SIZE) - LUT_OFFSET) * QUANTIZATION_STEP
+    scale = 255 / max(level_max - level_min, QUANTIZATION_STEP)
+    return np.clip((values - level_min) * scale, 0, 255).astype(np.uint8)
+
+
+class DisplayRenderer:
+    """ Turns reconstructed images into display-ready uint8 frames, mono
+    for a single channel or RGB with red in the red and blue components and
+    green in the green one for the composite. Lookup tables are recomputed
+    only when the levels change and all the buffers are reused
+
+    """
+
+    def __init__(self, lut_tolerance=0.01):
+        self.parameters = DisplayParameters()
+        self.levels = None
+        self.auto_levels = AutoLevels()
+        # relative change of the levels before the lookup tables are updated
+        self.lut_tolerance = lut_tolerance
+        self.luts = [None, None]
+        self.lut_levels = [None, None]
+        self.buffers = dict()
+
+    def set_parameters(self, parameters: DisplayParameters):
+        if parameters.channels != self.parameters.channels:
+            self.levels = None
+            self.auto_levels.reset()
+        if parameters.levels is not None:
+            self.levels = parameters.levels
+        self.parameters = parameters
+
+    def buffer(self, name, shape, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    def lut_outdated(self, i_channel):
+        if self.lut_levels[i_channel] is None:
+            return True
+        (lo, hi), (lut_lo, lut_hi) = self.levels[i_channel], self.lut_levels[i_channel]
+        tolerance = self.lut_tolerance * abs(lut_hi - lut_lo)
+        return abs(lo - lut_lo) > tolerance or abs(hi - lut_hi) > tolerance
+
+    def lut(self, i_channel):
+        if self.lut_outdated(i_channel):
+            self.luts[i_channel] = make_lut(*self.levels[i_channel])
+            self.lut_levels[i_channel] = self.levels[i_channel]
+        return self.luts[i_channel]
+
+    def initial_levels(self, images):
+        return tuple((float(image.min()), float(image.max())) for image in images)
+
+    def map_channel(self, image, i_channel, out):
+        scaled = self.buffer("scaled", image.shape, np.float32)
+        indices = self.buffer("indices", image.shape, np.uint16)
+        np.multiply(image, 1 / QUANTIZATION_STEP, out=scaled)
+        np.add(scaled, LUT_OFFSET, out=scaled)
+        np.clip(scaled, 0, LUT_SIZE - 1, out=scaled)
+        np.copyto(indices, scaled, casting="unsafe")
+        np.take(self.lut(i_channel), indices, out=out)
+        return out
+
+    def render(self, images):
+        if self.parameters.auto_levels:
+            self.levels = self.auto_levels.update(images, self.parameters)
+        elif self.levels is None:
+            self.levels = self.initial_levels(images)
+        if self.parameters.channels == "gr":
+            frame = self.buffer("composite", images.shape[1:] + (3,), np.uint8)
+            mono = self.buffer("mono", images.shape[1:], np.uint8)
+            frame[:, :, 1] = self.map_channel(images[0], 0, mono)
+            frame[:, :, 0] = self.map_channel(images[1], 1, mono)
+            frame[:, :, 2] = frame[:, :, 0]
+            return frame
+        i_channel = 1 if self.parameters.channels == "r" else 0
+        frame = self.buffer("mono", images.shape[1:], np.uint8)
+        return self.map_channel(images[i_channel], i_channel, frame)
@@ -1,5 +1,11 @@
+from concurrent.futures import Future
+from queue import Empty, SimpleQueue
+from threading import Event, Lock, Thread
+from time import perf_counter
 import zmq
+from zmq.utils.monitor import recv_monitor_message
 from lightparam.param_qt import ParameterTree
+from clock_sync import ClockServer
 
 
 class ExternalCommunicationSettings(ParameterTree):
@@ -7,27 +13,221 @@ class ExternalCommunicationSettings(ParameterTree):
         super().__init__()
 
 
+class ZMQSession(Thread):
+    """ Keeps a REQ connection to the stimulus server open in a background
+    thread. Requests are answered through futures. The connection is kept
+    alive by ZMQ heartbeats, and the socket is opened anew if a reply does
+    not come in time (the lazy pirate pattern)
+
+    """
+
+    def __init__(
+        self,
+        zmq_tcp_address="tcp://localhost:5555",
+        timeout=5.0,
+        retries=0,
+        heartbeat_interval=1.0,
+    ):
+        """
+        :param timeout: s to wait for a reply
+        :param retries: times a request is sent again after a timeout. As the
+            server could have received a request whose reply got lost, requests
+            which start a trial should not be retried
+        :param heartbeat_interval: s between ZMQ heartbeats
+        """
+        super().__init__(daemon=True)
+        self.zmq_tcp_address = zmq_tcp_address
+        self.timeout = timeout
+        self.retries = retries
+        self.heartbeat_interval = heartbeat_interval
+        self.requests = SimpleQueue()
+        self.stopped = Event()
+        self.connected = Event()
+        self.wake_address = "inproc://zmq-session-{}".format(id(self))
+        self.wake_lock = Lock()
+        self.wake_socket = None
+        self.context = None
+        self.n_reconnections = 0
+
+    def start(self):
+        self.context = zmq.Context()
+        # bound before the thread starts, so that requests can wake it right away
+        self.wake_receiver = self.context.socket(zmq.PULL)
+        self.wake_receiver.bind(self.wake_address)
+        self.wake_socket = self.context.socket(zmq.PUSH)
+        self.wake_socket.connect(self.wake_address)
+        super().start()
+
+    def request(self, data) -> Future:
+        """ Sends the data as JSON, the future gets the JSON reply or None
+        if there was no reply
+        """
+        future = Future()
+        self.requests.put((data, future))
+        with self.wake_lock:
+            self.wake_socket.send(b"")
+        return future
+
+    def stop(self):
+        self.stopped.set()
+        with self.wake_lock:
+            self.wake_socket.send(b"")
+        self.join()
+        self.wake_socket.close(linger=0)
+        self.context.term()
+
+    def open_socket(self):
+        socket = self.context.socket(zmq.REQ)
+        # Prevents the socket/context from hanging indefinitely when there is no connection.
+        socket.setsockopt(zmq.LINGER, 0)
+        if hasattr(zmq, "HEARTBEAT_IVL"):
+            interval = int(self.heartbeat_interval * 1000)
+            socket.setsockopt(zmq.HEARTBEAT_IVL, interval)
+            socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 3 * interval)
+        socket.connect(self.zmq_tcp_address)
+        self.monitor = socket.get_monitor_socket(
+            zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED
+        )
+        return socket
+
+    def close_socket(self, socket):
+        socket.disable_monitor()
+        self.monitor.close(linger=0)
+        socket.close(linger=0)
+        self.connected.clear()
+
+    def update_connection(self):
+        while self.monitor.poll(0):
+            event = recv_monitor_message(self.monitor)["event"]
+            if event == zmq.EVENT_CONNECTED:
+                self.connected.set()
+            elif event == zmq.EVENT_DISCONNECTED:
+                self.connected.clear()
+
+    def exchange(self, socket, data):
+        """ Sends the request and waits for the reply, returns the socket to
+        use next, which is a new one if the reply did not come
+        """
+        for _ in range(self.retries + 1):
+            socket.send_json(data)
+            if socket.poll(int(self.timeout * 1000), zmq.POLLIN):
+                return socket, socket.recv_json()
+            # a REQ socket without a reply cannot send again, so it is replaced
+            self.close_socket(socket)
+            socket = self.open_socket()
+            self.n_reconnections += 1
+        return socket, None
+
+    def run(self):
+        socket = self.open_socket()
+        poller = zmq.Poller()
+        poller.register(self.wake_receiver, zmq.POLLIN)
+        poller.register(self.monitor, zmq.POLLIN)
+        while not self.stopped.is_set():
+            events = dict(poller.poll(int(self.heartbeat_interval * 1000)))
+            if self.wake_receiver in events:
+                self.wake_receiver.recv()
+            self.update_connection()
+            while not self.stopped.is_set():
+                try:
+                    data, future = self.requests.get_nowait()
+                except Empty:
+                    break
+                if not future.set_running_or_notify_cancel():
+                    continue
+                poller.unregister(self.monitor)
+                try:
+                    socket, reply = self.exchange(socket, data)
+                    future.set_result(reply)
+                except Exception as e:
+                    future.set_exception(e)
+                poller.register(self.monitor, zmq.POLLIN)
+                self.update_connection()
+        self.close_socket(socket)
+        self.wake_receiver.close(linger=0)
+
+
 class ZMQcomm:
-    def __init__(self, zmq_tcp_address="tcp://localhost:5555", timeout=2):
+    def __init__(self, zmq_tcp_address="tcp://localhost:5555", timeout=5.0):
         self.zmq_tcp_address = zmq_tcp_address
         self.timeout = timeout
+        self.session = None
+
+    def start(self):
+        """ Opens the session, otherwise opened with the first request
+        """
+        if self.session is None:
+            self.session = ZMQSession(self.zmq_tcp_address, timeout=self.timeout)
+            self.session.start()
+        return self.session
+
+    def request(self, data) -> Future:
+        return self.start().request(data)
 
     def send(self, data):
-        zmq_context = zmq.Context()
-        with zmq_context.socket(zmq.REQ) as zmq_socket:
-            # Prevents the socket/context from hanging indefinitely when there is no connection.
-            zmq_socket.setsockopt(zmq.LINGER, 0)
-
-            zmq_socket.connect(self.zmq_tcp_address)
-            zmq_socket.send_json(data)
-            poller = zmq.Poller()
-            poller.register(zmq_socket, zmq.POLLIN)
-            duration = None
-            if poller.poll(5000):
-                duration = zmq_socket.recv_json()
-            zmq_socket.close()
-
-        # Clean up the connection.
-        zmq_context.term()
-        zmq_context.destroy()
-        return duration
+        """ Sends the data and waits for the reply, the duration of the
+        trial, returns None if there was none
+        """
+        return self.request(data).result()
+
+    @property
+    def connected(self):
+        return self.session is not None and self.session.connected.is_set()
+
+    def close(self):
+        if self.session is not None:
+            self.session.stop()
+            self.session = None
+
+
+class LocalStimulusServer(Thread):
+    """ Stands in for the stimulus server: answers every request with the
+    duration, and keeps the received requests. If clock_address is given a
+    ClockServer answers the clock pings there, with a clock offset and
+    drifting from perf_counter, as the one of another computer
+
+    """
+
+    def __init__(
+        self,
+        zmq_tcp_address="tcp://127.0.0.1:5555",
+        duration=10.0,
+        clock_address=None,
+        clock_offset=0.0,
+        clock_drift=0.0,
+    ):
+        super().__init__(daemon=True)
+        self.zmq_tcp_address = zmq_tcp_address
+        self.duration = duration
+        self.clock_address = clock_address
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self.received = []
+        self.stopped = Event()
+        self.ready = Event()
+
+    def clock(self):
+        return perf_counter() * (1 + self.clock_drift) + self.clock_offset
+
+    def run(self):
+        clock_server = None
+        if self.clock_address is not None:
+            clock_server = ClockServer(self.clock_address, clock=self.clock)
+            clock_server.start()
+            clock_server.ready.wait()
+        context = zmq.Context()
+        with context.socket(zmq.REP) as socket:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.bind(self.zmq_tcp_address)
+            self.ready.set()
+            while not self.stopped.is_set():
+                if socket.poll(50, zmq.POLLIN):
+                    self.received.append(socket.recv_json())
+                    socket.send_json(self.duration)
+        context.term()
+        if clock_server is not None:
+            clock_server.stop()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,187 @@
+from dataclasses import dataclass
+from threading import Thread
+from typing import Optional
+from time import perf_counter, sleep
+import json
+import numpy as np
+import zmq
+
+from frame_queues import FrameHeader
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+FRAME_TOPIC = b"frame"
+
+
+@dataclass
+class PublisherParameters:
+    address: str = "tcp://*:5556"
+    compression: Optional[str] = None  # None or "lz4"
+    # frames queued for each subscriber before new ones are dropped for it
+    send_hwm: int = 4
+
+
+class FramePublisher:
+    """ Broadcasts the reconstructed frames on a ZMQ PUB socket, as a
+    topic, a JSON header and the buffer of the array, sent without copying
+    unless compressed. A PUB socket drops the frames of the subscribers
+    whose queue is full, so slow consumers never hold back the acquisition
+
+    """
+
+    def __init__(self, parameters: PublisherParameters):
+        if parameters.compression == "lz4" and lz4_frame is None:
+            raise ImportError("lz4 compression of the published frames requires lz4")
+        self.parameters = parameters
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, parameters.send_hwm)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(parameters.address)
+        # the address actually bound, which has the port if it was chosen by ZMQ
+        self.address = self.socket.getsockopt(zmq.LAST_ENDPOINT).decode()
+        self.n_published = 0
+
+    def publish(self, header, images):
+        images = np.ascontiguousarray(images)
+        if self.parameters.compression == "lz4":
+            buffer = lz4_frame.compress(images.data)
+        else:
+            buffer = images.data
+        message_header = dict(
+            seq=header.seq,
+            t=header.t,
+            t_sample=header.t_sample,
+            shape=images.shape,
+            dtype=images.dtype.str,
+            compression=self.parameters.compression,
+        )
+        # never blocks, the frames over the high-water mark are dropped
+        self.socket.send_multipart(
+            [FRAME_TOPIC, json.dumps(message_header).encode(), buffer],
+            flags=zmq.NOBLOCK,
+            copy=False,
+        )
+        self.n_published += 1
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+
+def decode_frame(parts):
+    """ Header and images of a published frame
+    """
+    _, header, buffer = parts
+    header = json.loads(bytes(header))
+    if header["compression"] == "lz4":
+        buffer = lz4_frame.decompress(bytes(buffer))
+    images = np.frombuffer(buffer, dtype=np.dtype(header["dtype"]))
+    return header, images.reshape(header["shape"])
+
+
+class FrameSubscriber:
+    """ Receives the published frames. ZMQ conflation does not work for
+    multipart messages, so latest drains the received frames and decodes
+    only the newest one
+
+    """
+
+    def __init__(self, address="tcp://localhost:5556", receive_hwm=4):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, receive_hwm)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SUBSCRIBE, FRAME_TOPIC)
+        self.socket.connect(address)
+        self.n_skipped = 0
+
+    def receive(self, timeout=1.0):
+        """ The next frame as (header, images), None if none came in time
+        """
+        if not self.socket.poll(int(timeout * 1000)):
+            return None
+        return decode_frame(self.socket.recv_multipart(copy=False))
+
+    def latest(self, timeout=1.0):
+        """ The newest frame received, waiting for one if there is none
+        """
+        if not self.socket.poll(int(timeout * 1000)):
+            return None
+        parts = None
+        while True:
+            try:
+                new_parts = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            if parts is not None:
+                self.n_skipped += 1
+            parts = new_parts
+        return decode_frame(parts)
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+
+def benchmark(
+    shape=(2, 800, 800), n_frames=500, framerate=None, compression=None, conflate=False
+):
+    """ Publishes random frames to a local subscriber, at the frame rate
+    or as fast as possible, and prints the throughput, the latency and
+    the frames the subscriber did not get
+    """
+    # on a free port, the fixed ones are used by the other servers
+    publisher = FramePublisher(
+        PublisherParameters(address="tcp://127.0.0.1:*", compression=compression)
+    )
+    subscriber = FrameSubscriber(publisher.address)
+    sleep(0.5)  # lets the subscription reach the publisher
+
+    images = (np.random.randn(*shape) * 100).astype(np.int16)
+    latencies = []
+
+    def consume():
+        while True:
+            frame = subscriber.latest() if conflate else subscriber.receive()
+            if frame is None:
+                break
+            latencies.append(perf_counter() - frame[0]["t"])
+
+    consumer = Thread(target=consume)
+    consumer.start()
+    t_start = perf_counter()
+    for i_frame in range(n_frames):
+        if framerate is not None:
+            while perf_counter() - t_start < i_frame / framerate:
+                sleep(0.0001)
+        publisher.publish(FrameHeader(seq=i_frame, t=perf_counter()), images)
+    t_published = perf_counter() - t_start
+    consumer.join()
+    print(
+        "{}{}: {:.0f} frames/s published ({:.0f} MB/s), {} received, "
+        "{} skipped by conflation, {} dropped at the high-water mark, "
+        "latency {:.2f} ms median".format(
+            compression or "raw",
+            ", conflated" if conflate else "",
+            n_frames / t_published,
+            n_frames * images.nbytes / t_published / 1e6,
+            len(latencies),
+            subscriber.n_skipped,
+            n_frames - len(latencies) - subscriber.n_skipped,
+            np.median(latencies) * 1000 if latencies else np.nan,
+        )
+    )
+    publisher.close()
+    subscriber.close()
+
+
+if __name__ == "__main__":
+    benchmark(framerate=30)
+    benchmark()
+    benchmark(conflate=True)
+    if lz4_frame is not None:
+        benchmark(framerate=30, compression="lz4")
@@ -0,0 +1,199 @@
+from multiprocessing import RawArray, RawValue
+from arrayqueues.shared_arrays import ArrayView, TimestampedArrayQueue
+from collections import namedtuple
+from enum import IntEnum
+from queue import Empty, Full
+from time import perf_counter, sleep
+
+# t is the perf_counter time at which the frame was read, t_sample the one of
+# its first sample from the sample clock of the DAQ, levels are set only for
+# display frames, generation is the (scanning, roi) pair of the numbers of the
+# parameter updates the frame was scanned with
+FrameHeader = namedtuple(
+    "FrameHeader", "seq t levels t_sample generation", defaults=(None, None, None)
+)
+
+# frames dropped by the producer when the queue is full, and skipped by the
+# consumer to get to the newest frame, each counted by its own process
+PRODUCED, CONSUMED, DROPPED, SKIPPED = range(4)
+
+
+class BackpressurePolicy(IntEnum):
+    # wait for up to block_timeout, then drop the new frame
+    BLOCK = 1
+    # the consumer skips to the newest frame, the new frame is dropped only
+    # if the consumer let the whole queue fill up
+    DROP_OLDEST = 2
+    DROP_NEWEST = 3
+    # wait for as long as needed, only used when saving
+    NEVER_DROP = 4
+
+
+class FrameQueue(TimestampedArrayQueue):
+    """ Queue of frames between two processes of the pipeline, each frame
+    travels with its FrameHeader. When the queue is full the frame is
+    handled according to the backpressure policy, which can be changed from
+    any process. The number of frames produced, consumed and dropped is
+    counted in shared memory, with the sequence numbers of the last n_recent
+    dropped frames.
+
+    The frames are views of the shared memory, valid until the next get,
+    so frames are only ever taken out of the queue by the consumer
+
+    """
+
+    def __init__(
+        self,
+        name,
+        max_mbytes,
+        policy=BackpressurePolicy.BLOCK,
+        stop_event=None,
+        block_timeout=0.1,
+        n_recent=1000,
+    ):
+        super().__init__(max_mbytes=max_mbytes)
+        self.name = name
+        self.stop_event = stop_event
+        self.block_timeout = block_timeout
+        self._policy = RawValue("i", int(policy))
+        # 0 for no limit other than the size of the shared memory
+        self._max_frames = RawValue("q", 0)
+        self.counts = RawArray("q", 4)
+        # rings of the sequence numbers of the dropped and of the skipped frames
+        self.n_recent = n_recent
+        self.recent_dropped = RawArray("q", 2 * n_recent)
+
+    @property
+    def policy(self):
+        return BackpressurePolicy(self._policy.value)
+
+    @policy.setter
+    def policy(self, policy):
+        self._policy.value = int(policy)
+
+    @property
+    def max_frames(self):
+        return self._max_frames.value
+
+    @max_frames.setter
+    def max_frames(self, max_frames):
+        self._max_frames.value = max_frames
+
+    def check_full(self):
+        super().check_full()
+        if 0 < self.max_frames <= self.n_queued():
+            raise Full("Queue {} holds {} frames".format(self.name, self.max_frames))
+
+    def put(self, element, header=None):
+        """ Puts the frame in the queue, returns False if it was dropped
+        """
+        t_start = perf_counter()
+        while True:
+            try:
+                super().put(element, header)
+                self.counts[PRODUCED] += 1
+                return True
+            except Full:
+                policy = self.policy
+                if (
+                    policy
+                    in (BackpressurePolicy.DROP_NEWEST, BackpressurePolicy.DROP_OLDEST)
+                    or (
+                        policy == BackpressurePolicy.BLOCK
+                        and perf_counter() - t_start > self.block_timeout
+                    )
+                    or (self.stop_event is not None and self.stop_event.is_set())
+                ):
+                    self.counts[PRODUCED] += 1
+                    self.count_dropped(header, DROPPED)
+                    return False
+                else:
+                    sleep(0.0005)
+
+    def get(self, **kwargs):
+        """ Returns the header and the frame, the newest one with DROP_OLDEST
+        """
+        header, item = self.queue.get(**kwargs)
+        if self.policy == BackpressurePolicy.DROP_OLDEST:
+            while True:
+                try:
+                    newer = self.queue.get_nowait()
+                except Empty:
+                    break
+                self.count_dropped(header, SKIPPED)
+                header, item = newer
+        if self.view is None or not self.view.fits(item):
+            self.view = ArrayView(self.array.get_obj(), self.maxbytes, *item)
+        # frees the slots up to this one, the skipped ones included
+        self.read_queue.put(item[2])
+        self.counts[CONSUMED] += 1
+        return header, self.view.pop(item[2])
+
+    def count_dropped(self, header, counter):
+        """ Counts the frame as dropped, only from the process which
+        increments the counter
+        """
+        n = self.counts[counter]
+        ring = (counter - DROPPED) * self.n_recent
+        self.recent_dropped[ring + n % self.n_recent] = (
+            header.seq if header is not None else -1
+        )
+        self.counts[counter] = n + 1
+
+    def n_dropped(self):
+        return self.counts[DROPPED] + self.counts[SKIPPED]
+
+    def dropped_frames(self, since=(0, 0)):
+        """ Sequence numbers of the last dropped frames, at most n_recent
+        dropped and n_recent skipped ones, after the counts given as
+        (dropped, skipped), e.g. at the start of a recording
+        """
+        seqs = []
+        for counter, n_start in zip((DROPPED, SKIPPED), since):
+            n = self.counts[counter]
+            ring = (counter - DROPPED) * self.n_recent
+            seqs.extend(
+                self.recent_dropped[ring + i % self.n_recent]
+                for i in range(max(n_start, n - self.n_recent), n)
+            )
+        return sorted(seq for seq in seqs if seq >= 0)
+
+    def n_queued(self):
+        return self.counts[PRODUCED] - self.counts[CONSUMED] - self.n_dropped()
+
+
+class FrameAccounting:
+    """ Reports the counts and the dropped frames of the queues of the
+    pipeline, in the main process
+
+    """
+
+    def __init__(self, queues):
+        self.queues = {queue.name: queue for queue in queues}
+        self.counts_start = {name: [0, 0, 0, 0] for name in self.queues.keys()}
+
+    def start(self):
+        """ Starts counting anew, e.g. at the beginning of a recording
+        """
+        for name, queue in self.queues.items():
+            self.counts_start[name] = queue.counts[:]
+
+    def counts(self):
+        counts = dict()
+        for name, queue in self.queues.items():
+            produced, consumed, dropped, skipped = (
+                n - n_start for n, n_start in zip(queue.counts, self.counts_start[name])
+            )
+            counts[name] = dict(
+                produced=produced, consumed=consumed, dropped=dropped + skipped
+            )
+        return counts
+
+    def dropped_frames(self):
+        return {
+            name: queue.dropped_frames(self.counts_start[name][DROPPED:])
+            for name, queue in self.queues.items()
+        }
+
+    def summary(self):
+        return dict(counts=self.counts(), dropped_frames=self.dropped_frames())
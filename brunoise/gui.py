@@ -11,13 +11,17 @@ from PyQt5.QtWidgets import (
     QProgressBar,
     QFileDialog,
     QCheckBox,
+    QMessageBox,
 )
 from state import ExperimentState, ScanningParameters, frame_duration
+from sequence_diagram import TraceEvent
+from traces import DeltaFBuffer
 from brunoise.objective_motor_sliders import MotionControlXYZ
 
 import pyqtgraph as pg
 import qdarkstyle
 from pathlib import Path
+from time import perf_counter_ns
 import numpy as np
 
 from lightparam.gui import ParameterGui
@@ -29,16 +33,20 @@ class CalculatedParameterDisplay(QWidget):
         self.setLayout(QVBoxLayout())
         self.lbl_frameinfo = QLabel()
         self.layout().addWidget(self.lbl_frameinfo)
-        self.lbl_frameinfo.setMinimumHeight(120)
+        self.lbl_frameinfo.setMinimumHeight(180)
 
-    def display_scanning_parameters(self, sp: ScanningParameters):
+    def display_scanning_parameters(self, sp: ScanningParameters, buffered=None):
         self.lbl_frameinfo.setText(
-            "Resolution: {} x {}\n".format(sp.n_x, sp.n_y)
+            "Resolution: {} x {}, {} pattern\n".format(sp.n_x, sp.n_y, sp.pattern)
             + "Estimated frame duration {:.3f}\n".format(frame_duration(sp))
             + "Extra pixels {}\n".format(sp.n_extra)
             + "Line scanning frequency {:.2f}Hz".format(
                 sp.sample_rate_out / (2 * (sp.n_x + sp.n_turn))
             )
+            + "".join(
+                "\n{} buffer {:.1f}s".format(name, seconds)
+                for name, seconds in (buffered or dict()).items()
+            )
         )
 
 
@@ -52,12 +60,16 @@ class ExperimentControl(QWidget):
         self.save_location_button.clicked.connect(self.set_save_location)
         self.startstop_button = QPushButton()
         self.set_saving()
+        # the button is restyled only when the saving state changes
+        self.was_saving = False
         self.chk_pause = QCheckBox("Pause after experiment")
         self.stack_progress = QProgressBar()
         self.plane_progress = QProgressBar()
+        self.lbl_frame_counts = QLabel()
         self.plane_progress.setFormat("Frame %v of %m")
         self.stack_progress.setFormat("Plane %v of %m")
         self.startstop_button.clicked.connect(self.toggle_start)
+        self.state.sig_start_failed.connect(self.warn_start_failed)
 
         self.setLayout(QVBoxLayout())
         self.layout().addWidget(self.experiment_settings_gui)
@@ -66,6 +78,7 @@ class ExperimentControl(QWidget):
         self.layout().addWidget(self.chk_pause)
         self.layout().addWidget(self.plane_progress)
         self.layout().addWidget(self.stack_progress)
+        self.layout().addWidget(self.lbl_frame_counts)
 
     def set_saving(self):
         self.startstop_button.setText("Start recording")
@@ -83,10 +96,20 @@ class ExperimentControl(QWidget):
         if self.state.saving:
             self.state.end_experiment(force=True)
             self.set_saving()
-        else:
+        elif not self.state.starting:
             self.state.pause_after = self.chk_pause.isChecked()
-            if self.state.start_experiment():
-                self.set_notsaving()
+            # the recording starts from the main loop once Stytra answers
+            self.state.start_experiment()
+
+    def warn_start_failed(self):
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Critical)
+        msg.setText("Warning")
+        msg.setInformativeText(
+            "Couldn't make a connection with Stytra. Experiment not started."
+        )
+        msg.setWindowTitle("Warning")
+        msg.exec_()
 
     def set_locationbutton(self):
         pathtext = self.state.experiment_settings.save_dir
@@ -112,8 +135,21 @@ class ExperimentControl(QWidget):
             self.plane_progress.setValue(sstatus.i_t)
             self.stack_progress.setMaximum(sstatus.target_params.n_z)
             self.stack_progress.setValue(sstatus.i_z)
-        if not self.state.saving:
-            self.set_saving()
+        # the recording can also be started and stopped by the control server
+        if self.state.saving != self.was_saving:
+            self.was_saving = self.state.saving
+            if self.was_saving:
+                self.set_notsaving()
+            else:
+                self.set_saving()
+        self.lbl_frame_counts.setText(
+            "\n".join(
+                "{}: {} in, {} out, {} dropped".format(
+                    name, counts["produced"], counts["consumed"], counts["dropped"]
+                )
+                for name, counts in self.state.frame_accounting.counts().items()
+            )
+        )
 
 
 class ViewingWidget(QWidget):
@@ -128,83 +164,174 @@ class ViewingWidget(QWidget):
         self.chk_red = QCheckBox("Red Channel")
         self.chk_roi = QCheckBox("draw an roi")
         self.chk_roi.toggled.connect(self.draw_roi)
+        self.lbl_levels = QLabel()
 
         self.layout = QGridLayout()
         self.layout.addWidget(self.image_viewer, 0, 0, 1, 2)
         self.layout.addWidget(self.chk_green, 1, 0)
         self.layout.addWidget(self.chk_red, 2, 0)
         self.layout.addWidget(self.chk_roi, 1, 1)
+        self.layout.addWidget(self.lbl_levels, 2, 1)
         self.setLayout(self.layout)
 
         self.first_image = True
         self.color_modality_in_use = "g"
         self.modality_to_display = "g"
-        self.levelMode_in_use = "mono"
-        self.levelMode_to_display = "mono"
 
         self.roi = None
 
     def update(self) -> None:
-        current_images = self.state.get_image()
-
-        if current_images is None:
-            return
+        # the reconstructed images still go through the state for saving,
+        # the frames to display are rendered by the reconstructor
+        self.state.get_image()
 
         if not(self.chk_green.isChecked()) and not(self.chk_red.isChecked()):
             self.chk_green.setChecked(True)
-            self.modality_to_display = "g"
-            self.levelMode_to_display = "mono"
-        if self.chk_green.isChecked() and not(self.chk_red.isChecked()):
-            current_image = current_images[0, :, :]
-            self.modality_to_display = "g"
-            self.levelMode_to_display = "mono"
-        elif self.chk_red.isChecked() and not(self.chk_green.isChecked()):
-            current_image = current_images[1, :, :]
-            self.modality_to_display = "r"
-            self.levelMode_to_display = "mono"
-        elif self.chk_red.isChecked() and self.chk_green.isChecked():
-            current_image = np.stack([current_images[1, :, :], current_images[0, :, :], current_images[1, :, :]], -1)
+        if self.chk_red.isChecked() and self.chk_green.isChecked():
             self.modality_to_display = "gr"
-            self.levelMode_to_display = "rgba"
+        elif self.chk_red.isChecked():
+            self.modality_to_display = "r"
+        else:
+            self.modality_to_display = "g"
 
         if self.color_modality_in_use != self.modality_to_display:
             self.first_image = True
             self.color_modality_in_use = self.modality_to_display
+            self.state.set_display_channels(self.modality_to_display)
 
-        if self.levelMode_in_use != self.levelMode_to_display:
-            self.levelMode_in_use = self.levelMode_to_display
-
-        self.image_viewer.setImage(
-            current_image,
-            autoLevels=self.first_image,
-            autoRange=self.first_image,
-            autoHistogramRange=self.first_image,
-            levelMode=self.levelMode_in_use
+        display_frame = self.state.get_display_frame()
+        if display_frame is None:
+            return
+        header, current_frame = display_frame
+        # the frame is a view of the shared memory of the queue, reused once
+        # the next frame is taken, while pyqtgraph keeps the image to redraw
+        current_frame = np.array(current_frame)
+
+        t_start = perf_counter_ns()
+        if self.first_image or current_frame.shape != self.image_viewer.image.shape:
+            self.image_viewer.setImage(
+                current_frame,
+                autoLevels=False,
+                levels=(0, 255),
+                autoRange=True,
+                autoHistogramRange=False,
+            )
+            self.image_viewer.ui.histogram.setHistogramRange(0, 255)
+        else:
+            # the frames are display-ready, so only the image is replaced
+            self.image_viewer.imageItem.setImage(current_frame, autoLevels=False)
+        # the image of the scanned ROI is shown at its place in the full frame
+        self.image_viewer.imageItem.setPos(
+            *self.state.image_origin(current_frame.shape)
         )
+        self.state.trace.span(TraceEvent.GUI_REDRAW, t_start)
         self.first_image = False
-
-        if self.roi is None:
-            self.state.roi_settings.roi_write_signals = np.empty(0)
-        else:
-            self.state.roi_settings.roi_write_signals = self.get_roi_write_signals()
+        if header.levels is not None:
+            self.lbl_levels.setText(
+                "Levels green {:.2f} - {:.2f}, red {:.2f} - {:.2f}".format(
+                    *header.levels[0], *header.levels[1]
+                )
+            )
 
     def draw_roi(self):
         if self.chk_roi.isChecked():
             self.roi = pg.RectROI((0, 0), (30, 30), removable=True)
+            self.roi.sigRegionChangeFinished.connect(self.send_roi)
             self.image_viewer.addItem(self.roi)
+            self.send_roi()
         else:
             self.image_viewer.removeItem(self.roi)
             self.roi = None
+            self.state.set_roi_rect(None)
+
+    def send_roi(self):
+        # the waveforms are computed, and cached, by the scanner and the
+        # reconstructor, only the geometry of the ROI is sent
+        x0, y0 = self.roi.pos()
+        width, height = self.roi.size()
+        self.state.set_roi_rect((x0, y0, width, height))
+
+
+class TracesWidget(QWidget):
+    """ Live dF/F of elliptical ROIs drawn on the viewer, the means are
+    extracted by the reconstructor. The traces of the channels shown in the
+    viewer are plotted, the red ones dashed
+
+    """
 
-    def get_roi_write_signals(self):
-        vol_x = self.state.scanning_parameters.voltage_x
-        vol_y = self.state.scanning_parameters.voltage_y
-        n_x = self.state.scanning_parameters.n_x
-        n_y = self.state.scanning_parameters.n_y
-        x_array = np.array([np.linspace(-vol_x, vol_x, n_x) for _ in range(n_x)]).T
-        y_array = np.array([np.linspace(-vol_y, vol_y, n_y) for _ in range(n_y)])
-        result = self.roi.getArrayRegion(np.stack([x_array, y_array], axis=0), self.image_viewer.imageItem, axes=(1, 2))
-        return result.reshape(2, -1)
+    CHANNELS = dict(g=[0], r=[1], gr=[0, 1])
+
+    def __init__(self, state: ExperimentState, image_viewer):
+        super().__init__()
+        self.state = state
+        self.image_viewer = image_viewer
+        self.rois = []
+        self.channels = None
+        self.delta_f = DeltaFBuffer()
+        self.plot = pg.PlotWidget()
+        self.plot.setLabel("left", "dF/F")
+        self.plot.setLabel("bottom", "time", "s")
+        self.curves = []
+        self.btn_add = QPushButton("Add ROI")
+        self.btn_add.clicked.connect(self.add_roi)
+        self.btn_clear = QPushButton("Clear ROIs")
+        self.btn_clear.clicked.connect(self.clear_rois)
+
+        self.setLayout(QGridLayout())
+        self.layout().addWidget(self.plot, 0, 0, 1, 2)
+        self.layout().addWidget(self.btn_add, 1, 0)
+        self.layout().addWidget(self.btn_clear, 1, 1)
+
+    def add_roi(self):
+        color = pg.intColor(len(self.rois), hues=9)
+        roi = pg.EllipseROI((0, 0), (20, 20), pen=color)
+        roi.sigRegionChangeFinished.connect(self.send_labels)
+        self.image_viewer.addItem(roi)
+        self.rois.append(roi)
+        self.curves.append(
+            [
+                self.plot.plot(pen=color),
+                self.plot.plot(pen=pg.mkPen(color, style=Qt.DashLine)),
+            ]
+        )
+        self.send_labels()
+
+    def clear_rois(self):
+        for roi in self.rois:
+            self.image_viewer.removeItem(roi)
+        for curves in self.curves:
+            for curve in curves:
+                self.plot.removeItem(curve)
+        self.rois = []
+        self.curves = []
+        self.delta_f.clear()
+        self.state.set_trace_rois(None)
+
+    def send_labels(self):
+        # the reconstructor draws the labels where the ROIs are in its images
+        ellipses = [(*roi.pos(), *roi.size()) for roi in self.rois]
+        self.delta_f.clear()
+        self.state.set_trace_rois(ellipses)
+
+    def update(self):
+        traces = self.state.get_traces()
+        if len(traces) == 0:
+            return
+        channels = self.CHANNELS[self.state.display_parameters.channels]
+        if channels != self.channels:
+            self.delta_f.clear()
+            self.channels = channels
+        for header, means in traces:
+            self.delta_f.append(header.t, means[channels].ravel())
+        times, delta_f = self.delta_f.delta_f()
+        n_rois = delta_f.shape[1] // len(channels)
+        for i_roi, curves in enumerate(self.curves[:n_rois]):
+            for i_channel, curve in enumerate(curves):
+                if i_channel in channels:
+                    i_trace = channels.index(i_channel) * n_rois + i_roi
+                    curve.setData(times - times[-1], delta_f[:, i_trace])
+                else:
+                    curve.clear()
 
 
 class DockedWidget(QDockWidget):
@@ -229,9 +356,11 @@ class ScanningWidget(QWidget):
         self.scanning_calc = CalculatedParameterDisplay()
         self.pause_button = QPushButton()
         self.pause_button.clicked.connect(self.toggle_pause)
+        self.lbl_laser = QLabel()
 
         self.scanning_layout.addWidget(self.scanning_settings_gui)
         self.scanning_layout.addWidget(self.scanning_calc)
+        self.scanning_layout.addWidget(self.lbl_laser)
         self.scanning_layout.addWidget(self.pause_button)
         self.setLayout(self.scanning_layout)
 
@@ -240,10 +369,21 @@ class ScanningWidget(QWidget):
         self.update_button()
 
     def update_display(self):
-        self.scanning_calc.display_scanning_parameters(self.state.scanning_parameters)
+        self.scanning_calc.display_scanning_parameters(
+            self.state.scanning_parameters, self.state.seconds_buffered()
+        )
 
         self.pause_button.setEnabled(self.state.scanning_parameters.pause)
 
+    def update_laser(self):
+        power_service = self.state.power_service
+        if power_service.position_percent is not None:
+            self.lbl_laser.setText(
+                "Laser power {:.1f}% (stage at {:.2f} deg)".format(
+                    power_service.position_percent, power_service.position_angle
+                )
+            )
+
     def update_button(self):
         if self.state.paused:
             self.pause_button.setText("Resume")
@@ -258,6 +398,36 @@ class ScanningWidget(QWidget):
         self.update_button()
 
 
+class DisplayWidget(QWidget):
+    def __init__(self, state: ExperimentState):
+        self.state = state
+        super().__init__()
+        self.setLayout(QVBoxLayout())
+        self.display_settings_gui = ParameterGui(self.state.display_settings)
+        self.layout().addWidget(self.display_settings_gui)
+
+
+class DriftWidget(QWidget):
+    def __init__(self, state: ExperimentState):
+        self.state = state
+        super().__init__()
+        self.setLayout(QVBoxLayout())
+        self.drift_settings_gui = ParameterGui(self.state.drift_settings)
+        self.btn_reference = QPushButton("New reference")
+        self.btn_reference.clicked.connect(self.state.reset_drift)
+        self.lbl_drift = QLabel()
+        self.layout().addWidget(self.drift_settings_gui)
+        self.layout().addWidget(self.btn_reference)
+        self.layout().addWidget(self.lbl_drift)
+
+    def update(self):
+        if len(self.state.drift_log) > 0:
+            _, _, drift_x, drift_y = self.state.drift_log[-1]
+            self.lbl_drift.setText(
+                "Drift x {:.1f} um, y {:.1f} um".format(drift_x, drift_y)
+            )
+
+
 class RoiWidget(QWidget):
     def __init__(self, state: ExperimentState):
         self.state = state
@@ -269,20 +439,44 @@ class RoiWidget(QWidget):
 
 
 class TwopViewer(QMainWindow):
-    def __init__(self):
+    def __init__(
+        self,
+        diagnostics=False,
+        startup_timer=None,
+        laser_calibration=None,
+        publisher=None,
+        control_address=None,
+        replay=None,
+        raw_capture=False,
+        clock_address=None,
+    ):
         super().__init__()
 
         # State variables
-        self.state = ExperimentState()
+        self.state = ExperimentState(
+            diagnostics=diagnostics,
+            startup_timer=startup_timer,
+            laser_calibration=laser_calibration,
+            publisher=publisher,
+            control_address=control_address,
+            replay=replay,
+            raw_capture=raw_capture,
+            clock_address=clock_address,
+        )
+        self.first_frame_shown = False
 
         self.image_display = ViewingWidget(self.state)
         self.setCentralWidget(self.image_display)
 
         self.scanning_widget = ScanningWidget(self.state)
         self.roi_widget = RoiWidget(self.state)
+        self.display_widget = DisplayWidget(self.state)
+        self.drift_widget = DriftWidget(self.state)
         self.experiment_widget = ExperimentControl(self.state)
 
-        self.motor_control_slider = MotionControlXYZ(self.state.motors)
+        # added once the motors, which open in the background, are ready
+        self.motor_control_slider = None
+        self.traces_widget = TracesWidget(self.state, self.image_display.image_viewer)
 
         self.addDockWidget(
             Qt.LeftDockWidgetArea,
@@ -293,21 +487,70 @@ class TwopViewer(QMainWindow):
             DockedWidget(widget=self.roi_widget, title="Roi scanning"),
         )
         self.addDockWidget(
-            Qt.RightDockWidgetArea,
-            DockedWidget(widget=self.motor_control_slider, title="Stage control"),
+            Qt.LeftDockWidgetArea,
+            DockedWidget(widget=self.display_widget, title="Display"),
         )
         self.addDockWidget(
             Qt.RightDockWidgetArea,
             DockedWidget(widget=self.experiment_widget, title="Experiment running"),
         )
+        self.addDockWidget(
+            Qt.RightDockWidgetArea,
+            DockedWidget(widget=self.drift_widget, title="Drift"),
+        )
+        self.addDockWidget(
+            Qt.BottomDockWidgetArea,
+            DockedWidget(widget=self.traces_widget, title="ROI traces"),
+        )
+
+        self.state.sig_settings_changed.connect(self.refresh_settings)
 
         self.timer = QTimer()
         self.timer.timeout.connect(self.update)
         self.timer.start()
 
+    def add_motor_control(self):
+        self.motor_control_slider = MotionControlXYZ(self.state.motors)
+        self.addDockWidget(
+            Qt.RightDockWidgetArea,
+            DockedWidget(widget=self.motor_control_slider, title="Stage control"),
+        )
+
+    def update_startup(self):
+        devices_done = self.state.update_devices()
+        if self.motor_control_slider is None and self.state.motors_ready():
+            self.add_motor_control()
+        if not self.first_frame_shown and self.image_display.image_viewer.image is not None:
+            self.first_frame_shown = True
+            self.state.startup_timer.mark("first frame")
+        if devices_done and self.first_frame_shown:
+            self.state.startup_timer.report()
+
+    def refresh_settings(self):
+        """ Shows the settings changed by the control server
+        """
+        for settings_gui in [
+            self.scanning_widget.scanning_settings_gui,
+            self.experiment_widget.experiment_settings_gui,
+            self.roi_widget.roi_settings_gui,
+            self.display_widget.display_settings_gui,
+            self.drift_widget.drift_settings_gui,
+        ]:
+            settings_gui.refresh_widgets()
+        self.experiment_widget.set_locationbutton()
+
     def update(self):
         self.image_display.update()
+        self.state.execute_remote_commands()
+        self.state.poll_start()
+        self.state.zstack.poll()
+        if not self.state.startup_timer.reported:
+            self.update_startup()
         self.experiment_widget.update()
+        self.scanning_widget.update_laser()
+        self.traces_widget.update()
+        self.state.update_drift()
+        self.drift_widget.update()
 
     def closeEvent(self, event) -> None:
         self.state.close_setup()
@@ -0,0 +1,335 @@
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Optional
+from time import perf_counter
+import json
+import click
+import toml
+
+from acquisition import AcquisitionPipeline, ScanningConfig, convert_params
+from scanning import ScanningState, RoiParameters, image_shape
+from streaming_save import SavingParameters
+from zstack import ZStackEngine, StackPhase
+from frame_publisher import PublisherParameters
+from replay import ReplayParameters
+
+
+@dataclass
+class RecordingConfig:
+    save_dir: str = "."
+    n_planes: int = 1
+    dz: float = 1.0  # um, the objective is moved only for more than one plane
+    channel: str = "Green"
+    duration: float = 10.0  # s of each plane, unless synchronised with Stytra
+    sync_stytra: bool = False
+    # answer the synchronisation with a local stand-in for Stytra, for dry runs
+    local_stimulus_server: bool = False
+    set_laser_power: bool = True
+    laser_calibration: Optional[str] = None  # file of the calibration table
+    preview: float = 2.0  # s of scanning before the recording starts
+    progress_interval: float = 1.0  # s between progress reports
+    # the reconstructed frames are published on this ZMQ address if set
+    publish_address: Optional[str] = None
+    publish_compression: Optional[str] = None  # None or "lz4"
+    # directory of a saved recording replayed instead of scanning, the
+    # laser and the stage are then left alone
+    replay: Optional[str] = None
+    replay_realtime: bool = True  # otherwise as fast as possible
+    # save the samples of the PMTs, to reconstruct the recording offline
+    save_raw: bool = False
+    # address of the clock server of the stimulus computer, pinged to estimate
+    # the offset of its clock, saved as clock_alignment.h5. With the local
+    # stimulus server, the address it binds, e.g. tcp://127.0.0.1:5557
+    clock_address: Optional[str] = None
+
+
+def _from_section(config_class, section):
+    names = {field.name for field in fields(config_class)}
+    unknown = set(section) - names
+    if unknown:
+        raise ValueError(
+            "Unknown {} parameters: {}".format(
+                config_class.__name__, ", ".join(sorted(unknown))
+            )
+        )
+    return config_class(**section)
+
+
+def load_config(path):
+    """ Reads the scanning and recording sections of a TOML or JSON
+    parameter file, which use the names of the GUI settings
+
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path) as f:
+            config = json.load(f)
+    else:
+        config = toml.load(path)
+    return (
+        _from_section(ScanningConfig, config.get("scanning", {})),
+        _from_section(RecordingConfig, config.get("recording", {})),
+    )
+
+
+class HeadlessAcquisition:
+    """ Runs a recording with the acquisition pipeline and no GUI,
+    reporting the progress on stdout
+
+    """
+
+    def __init__(
+        self,
+        scanning: ScanningConfig,
+        recording: RecordingConfig,
+        diagnostics=False,
+        placement=None,
+        memory_budget=None,
+    ):
+        self.scanning = scanning
+        self.recording = recording
+        self.pipeline = AcquisitionPipeline(
+            diagnostics=diagnostics,
+            placement=placement,
+            memory_budget=memory_budget,
+            publisher=(
+                PublisherParameters(
+                    address=recording.publish_address,
+                    compression=recording.publish_compression,
+                )
+                if recording.publish_address is not None
+                else None
+            ),
+            replay=(
+                ReplayParameters(recording.replay, realtime=recording.replay_realtime)
+                if recording.replay is not None
+                else None
+            ),
+            raw_capture=recording.save_raw,
+        )
+        self.scanning_parameters = convert_params(scanning)
+        self.output_dir = Path(recording.save_dir)
+        self.power_controller = None
+        self.motor_z = None
+        self.z_move = None
+        self.external_sync = None
+        self.stimulus_server = None
+        self.clock_sync = None
+        self.t_recording_start = None
+        self.n_received = 0
+        self.zstack = ZStackEngine(
+            move_to_plane=self.move_to_plane,
+            move_state=self.move_state,
+            negotiate_trial=self.negotiate_trial,
+            start_plane=self.start_plane,
+            saving=lambda: self.pipeline.saving,
+            finish=self.finish,
+        )
+
+    def open_hardware(self):
+        if self.recording.sync_stytra:
+            from brunoise.external_communication import ZMQcomm, LocalStimulusServer
+
+            if self.recording.local_stimulus_server:
+                self.stimulus_server = LocalStimulusServer(
+                    "tcp://127.0.0.1:5555",
+                    duration=self.recording.duration,
+                    clock_address=self.recording.clock_address,
+                )
+                self.stimulus_server.start()
+                self.stimulus_server.ready.wait()
+            self.external_sync = ZMQcomm()
+            self.external_sync.start()
+        if self.recording.clock_address is not None:
+            from clock_sync import ClockSync
+
+            self.clock_sync = ClockSync(self.recording.clock_address)
+            self.clock_sync.start()
+        if self.recording.replay is not None:
+            return
+        if self.recording.set_laser_power:
+            from brunoise.power_control import PowerService, PowerCalibration
+
+            self.power_controller = PowerService(
+                calibration=PowerCalibration.load_or_default(
+                    self.recording.laser_calibration
+                ),
+                debounce=0.0,
+            )
+            self.power_controller.start()
+            self.power_controller.set_power(self.scanning.laser_power)
+        if self.recording.n_planes > 1:
+            from motor_service import MotorService, MotorClient, MotorProxy
+
+            client = MotorClient(MotorService("COM5", axes=("z",)))
+            client.service.start()
+            if not client.service.ready_event.wait(30):
+                client.update()
+                raise ConnectionError("Couldn't open the motor controller")
+            self.motor_z = MotorProxy(client, "z")
+
+    def close_hardware(self):
+        if self.clock_sync is not None:
+            self.clock_sync.stop()
+        if self.external_sync is not None:
+            self.external_sync.close()
+        if self.stimulus_server is not None:
+            self.stimulus_server.stop()
+        if self.power_controller is not None:
+            self.power_controller.stop()
+        if self.motor_z is not None:
+            self.motor_z.client.stop()
+
+    def plane_duration(self):
+        if not self.recording.sync_stytra:
+            return self.recording.duration
+        duration = self.external_sync.send(
+            dict(scanning=self.scanning.__dict__, recording=self.recording.__dict__)
+        )
+        if duration is None:
+            raise ConnectionError("Couldn't make a connection with Stytra")
+        return duration
+
+    def saving_parameters(self):
+        return SavingParameters(
+            output_dir=self.output_dir,
+            plane_size=image_shape(self.scanning_parameters),
+            n_z=self.recording.n_planes,
+            channel=self.recording.channel,
+        )
+
+    def start_plane(self, i_plane, duration):
+        self.pipeline.start_plane(
+            self.scanning_parameters,
+            duration,
+            self.saving_parameters() if i_plane == 0 else None,
+        )
+
+    def move_to_plane(self, i_plane):
+        if self.recording.replay is not None:
+            return
+        self.motor_z.send_command("MO")
+        self.z_move = self.motor_z.move_rel(self.recording.dz / 1000)
+
+    def move_state(self):
+        # the objective does not move in replays
+        if self.z_move is None:
+            return "settled"
+        return self.motor_z.client.state(self.z_move)
+
+    def negotiate_trial(self):
+        try:
+            return self.plane_duration()
+        except ConnectionError as e:
+            print(e)
+            return None
+
+    def finish(self, aborted):
+        if aborted:
+            print("Recording aborted on plane {}".format(self.zstack.i_plane + 1))
+
+    def preview(self):
+        t_start = perf_counter()
+        while perf_counter() - t_start < self.recording.preview:
+            self.pipeline.get_frame()
+
+    def report(self, t_start):
+        status = self.pipeline.save_status
+        summary = self.pipeline.frame_accounting.summary()
+        elapsed = perf_counter() - t_start
+        print(
+            "plane {}/{}, frame {}/{}, {:.1f} fps, dropped {}".format(
+                self.zstack.i_plane + 1,
+                self.recording.n_planes,
+                status.i_t if status is not None else 0,
+                status.target_params.n_t if status is not None else "?",
+                self.n_received / elapsed if elapsed > 0 else 0.0,
+                sum(counts["dropped"] for counts in summary["counts"].values()),
+            ),
+            flush=True,
+        )
+
+    def record(self):
+        self.t_recording_start = perf_counter()
+        self.start_plane(0, self.plane_duration())
+        self.zstack.begin(self.recording.n_planes)
+        t_start = perf_counter()
+        t_report = t_start
+        while self.zstack.phase != StackPhase.IDLE:
+            self.pipeline.get_save_status()
+            frame = self.pipeline.get_frame()
+            if frame is not None:
+                header, images = frame
+                status = self.pipeline.save_status
+                if (
+                    status is not None
+                    and self.zstack.scanning_plane(status.i_z)
+                    and status.i_t + 1 == status.target_params.n_t
+                ):
+                    self.pipeline.end_plane()
+                    self.zstack.end_plane()
+                self.pipeline.save_frame(images, header)
+                self.n_received += 1
+            self.zstack.poll()
+            if perf_counter() - t_report > self.recording.progress_interval:
+                self.report(t_start)
+                t_report = perf_counter()
+        self.report(t_start)
+        dead_times = self.zstack.dead_times()
+        if len(dead_times) > 0:
+            print(
+                "Time between planes {:.3f} s on average, {:.3f} s at most".format(
+                    sum(dead_times) / len(dead_times), max(dead_times)
+                )
+            )
+        return self.n_received / (perf_counter() - t_start)
+
+    def run(self):
+        """ Runs the whole recording and returns the summary of the
+        frame accounting with the mean frame rate
+
+        """
+        self.open_hardware()
+        self.pipeline.start()
+        try:
+            self.pipeline.send_scan_params(self.scanning_parameters)
+            self.pipeline.send_roi_params(RoiParameters())
+            self.preview()
+            framerate = self.record()
+            self.pipeline.stop_saving(self.output_dir)
+            if self.clock_sync is not None:
+                # with the pings from before the recording, for a steadier fit
+                self.clock_sync.write_alignment(
+                    self.output_dir / "clock_alignment.h5",
+                    t_start=self.t_recording_start - 60.0,
+                )
+            self.pipeline.set_scanning_state(
+                self.scanning_parameters, ScanningState.PAUSED
+            )
+        finally:
+            self.pipeline.stop()
+            self.close_hardware()
+        self.pipeline.export_trace(self.output_dir / "trace.json")
+        summary = self.pipeline.frame_accounting.summary()
+        summary["framerate"] = framerate
+        return summary
+
+
+def run_headless(parameter_file, diagnostics=False):
+    scanning, recording = load_config(parameter_file)
+    return HeadlessAcquisition(scanning, recording, diagnostics=diagnostics).run()
+
+
+@click.command()
+@click.argument("parameter_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--diagnostics",
+    is_flag=True,
+    help="Trace the pipeline, the trace is saved as trace.json in the save directory",
+)
+def main(parameter_file, diagnostics):
+    """ Records without the GUI, with the scanning and recording
+    parameters given in a TOML or JSON file
+    """
+    summary = run_headless(parameter_file, diagnostics=diagnostics)
+    print(json.dumps(summary, indent=2))
@@ -1,12 +1,102 @@
-from PyQt5.QtWidgets import QApplication
-import qdarkstyle
-from brunoise.gui import TwopViewer
 import click
 
+
 @click.command()
-def main():
+@click.option(
+    "--diagnostics",
+    is_flag=True,
+    help="Trace the pipeline, the trace is saved as trace.json in the save directory",
+)
+@click.option(
+    "--laser-calibration",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Table of the laser power calibration, as saved by the calibration notebook",
+)
+@click.option(
+    "--publish",
+    default=None,
+    metavar="ADDRESS",
+    help="Publish the reconstructed frames on a ZMQ PUB socket, e.g. tcp://*:5556",
+)
+@click.option(
+    "--publish-lz4", is_flag=True, help="Compress the published frames with lz4",
+)
+@click.option(
+    "--control",
+    default=None,
+    metavar="ADDRESS",
+    help="Answer the requests of automation scripts on a ZMQ REP socket, "
+    "e.g. tcp://127.0.0.1:5560",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Replay a saved recording instead of scanning, without opening the devices",
+)
+@click.option(
+    "--replay-fast",
+    is_flag=True,
+    help="Replay as fast as possible instead of at the original frame times",
+)
+@click.option(
+    "--raw-capture",
+    is_flag=True,
+    help="Save the samples of the PMTs of the recordings, to reconstruct them offline",
+)
+@click.option(
+    "--clock-sync",
+    default=None,
+    metavar="ADDRESS",
+    help="Estimate the offset of the clock of the stimulus computer with the pings "
+    "of its clock server, e.g. tcp://192.168.1.2:5557, saved with the recordings",
+)
+def main(
+    diagnostics,
+    laser_calibration,
+    publish,
+    publish_lz4,
+    control,
+    replay,
+    replay_fast,
+    raw_capture,
+    clock_sync,
+):
+    # the GUI is imported here so that the startup, imports included, is timed,
+    # and importing brunoise for headless use does not load Qt
+    from startup import StartupTimer
+
+    timer = StartupTimer()
+    from PyQt5.QtWidgets import QApplication
+    import qdarkstyle
+    from brunoise.gui import TwopViewer
+    from frame_publisher import PublisherParameters
+    from replay import ReplayParameters
+
+    timer.mark("imports")
     app = QApplication([])
     app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
-    viewer = TwopViewer()
+    timer.mark("application")
+    publisher = (
+        PublisherParameters(address=publish, compression="lz4" if publish_lz4 else None)
+        if publish is not None
+        else None
+    )
+    viewer = TwopViewer(
+        diagnostics=diagnostics,
+        startup_timer=timer,
+        laser_calibration=laser_calibration,
+        publisher=publisher,
+        control_address=control,
+        replay=(
+            ReplayParameters(replay, realtime=not replay_fast)
+            if replay is not None
+            else None
+        ),
+        raw_capture=raw_capture,
+        clock_address=clock_sync,
+    )
     viewer.show()
+    timer.mark("window")
     app.exec_()
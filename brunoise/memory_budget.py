@@ -0,0 +1,82 @@
+from math import floor
+from scanning import ScanningParameters, frame_duration, frame_samples
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# share of the budget allocated to the queue after each stage, the raw
+# samples are queued for the raw saver only when they are captured
+EDGE_SHARES = dict(scanner=0.2, reconstructor=0.2, saver=0.6, raw=0.25)
+DEFAULT_EDGES = ("scanner", "reconstructor", "saver")
+
+
+def available_mbytes():
+    if psutil is None:
+        return None
+    return psutil.virtual_memory().available / 1e6
+
+
+def frame_nbytes(edge, sp: ScanningParameters):
+    """ Size of a frame in the queue after the stage: raw samples of the two
+    channels after the scanner and for the raw saver, reconstructed images
+    after the others
+
+    """
+    if edge in ("scanner", "raw"):
+        return 2 * frame_samples(sp) * sp.n_bin * 8
+    return 2 * sp.n_x * sp.n_y * 8
+
+
+class MemoryBudget:
+    """ Sizes the queues of the pipeline. The shared memory of each queue is
+    allocated once, as a share of a global limit given by the RAM available at
+    startup. The number of frames each queue can hold is then computed for the
+    current scanning parameters, so that it corresponds to the same duration
+    of acquisition whatever the frame size
+
+    """
+
+    def __init__(self, max_mbytes=4000, ram_fraction=0.25, seconds=10.0):
+        available = available_mbytes()
+        if available is not None:
+            max_mbytes = min(max_mbytes, ram_fraction * available)
+        self.total_mbytes = max_mbytes
+        self.seconds = seconds
+        self.edges = list(DEFAULT_EDGES)
+
+    def include(self, edge):
+        """ Shares the budget with an optional queue, before the queues
+        are allocated
+        """
+        if edge not in self.edges:
+            self.edges.append(edge)
+
+    def allocation_mbytes(self, edge):
+        total_share = sum(EDGE_SHARES[name] for name in self.edges)
+        return self.total_mbytes * EDGE_SHARES[edge] / total_share
+
+    def capacity(self, edge, sp: ScanningParameters):
+        """ Number of frames the queue after the stage holds, the circular
+        buffer of the ArrayQueue always keeps one slot empty
+
+        """
+        n_fit = floor(self.allocation_mbytes(edge) * 1e6 / frame_nbytes(edge, sp)) - 1
+        n_wanted = int(round(self.seconds / frame_duration(sp)))
+        return max(min(n_fit, n_wanted), 0)
+
+    def seconds_buffered(self, edge, sp: ScanningParameters):
+        return self.capacity(edge, sp) * frame_duration(sp)
+
+    def apply(self, queues, sp: ScanningParameters):
+        for queue in queues:
+            capacity = self.capacity(queue.name, sp)
+            if capacity < 2:
+                print(
+                    "The {} queue can hold only {} frames, increase the memory budget".format(
+                        queue.name, capacity
+                    )
+                )
+            queue.max_frames = capacity
@@ -0,0 +1,359 @@
+from multiprocessing import Event, Process, Queue, RawArray, RawValue
+from collections import namedtuple
+from itertools import count
+from queue import Empty
+from time import perf_counter, sleep
+import math
+import pyvisa
+
+AXIS_NUMBERS = dict(x=1, y=2, z=3)
+
+# kind is one of "ready", "done", "settled" and "error"
+MotorNotification = namedtuple("MotorNotification", "command_id axis kind message")
+MotorCommand = namedtuple("MotorCommand", "command_id axis command value")
+
+
+class MotorService(Process):
+    """ Owns the connection to the motor controller: polls the positions of
+    all the axes with one query and publishes them in shared memory, and
+    executes the commands sent through the command queue, notifying when
+    they are done and, for moves, when the axis has settled on the target
+
+    """
+
+    def __init__(
+        self,
+        port="COM5",
+        axes=("x", "y", "z"),
+        poll_interval=0.05,
+        settle_tolerance=0.0005,
+        settle_time=0.1,
+        settle_timeout=10.0,
+        batch_queries=None,
+        probe_timeout=0.5,
+    ):
+        """
+        :param poll_interval: s between the position queries
+        :param settle_tolerance: mm from the target within which an axis is settled
+        :param settle_time: s an axis has to stay within the tolerance
+        :param settle_timeout: s after which a move which has not settled is an error
+        :param batch_queries: query the positions of all the axes at once, if None
+            whether the controller answers to it is probed when opening
+        :param probe_timeout: s to wait for the answer to the probe
+        """
+        super().__init__()
+        self.port = port
+        self.axes = tuple(axes)
+        self.settle_tolerance = settle_tolerance
+        self.settle_time = settle_time
+        self.settle_timeout = settle_timeout
+        self.stop_event = Event()
+        self.ready_event = Event()
+        self.command_queue = Queue()
+        self.notification_queue = Queue()
+        self.poll_interval = RawValue("d", poll_interval)
+        self.positions = RawArray("d", [math.nan] * len(self.axes))
+        self.home_positions = RawArray("d", [math.nan] * len(self.axes))
+        self.t_positions = RawValue("d", math.nan)
+        self.moves = dict()
+        self.batch_queries = batch_queries
+        self.probe_timeout = probe_timeout
+
+    def notify(self, command_id, axis, kind, message=None):
+        self.notification_queue.put(MotorNotification(command_id, axis, kind, message))
+
+    def axis_prefix(self, axis):
+        return str(AXIS_NUMBERS[axis])
+
+    def execute(self, command, axis=None, command_id=None):
+        """ Sends the command, errors are notified instead of raised
+        """
+        try:
+            return self.motor.query(command)
+        except pyvisa.VisaIOError as e:
+            self.notify(command_id, axis, "error", "{}: {}".format(command, e))
+            return None
+
+    def start_session(self, axis):
+        prefix = self.axis_prefix(axis)
+        # motor on
+        self.execute(prefix + "MO", axis)
+        # set trajectory mode to trapezoidal
+        self.execute(prefix + "TJ1", axis)
+        # set jog high speed to 0.2 for x,y or to 0.5 for z
+        self.execute(prefix + "JH" + ("0.5" if axis == "z" else "0.2"), axis)
+        # set jog low speed to 0.01
+        self.execute(prefix + "TW0.01", axis)
+        # set mm as unit
+        self.execute(prefix + "SN2", axis)
+
+    def batched_query(self):
+        return ";".join(self.axis_prefix(axis) + "TP" for axis in self.axes)
+
+    def parse_batched(self, output):
+        """ Positions in the answer to the batched query, None if it is not one
+        """
+        try:
+            positions = [float(s) for s in output.split(",")]
+        except (AttributeError, ValueError):
+            return None
+        return positions if len(positions) == len(self.axes) else None
+
+    def probe_batch_queries(self):
+        """ Whether the controller answers to the batched query, asked with a
+        short timeout so that the ones which do not are not waited for
+        """
+        timeout = self.motor.timeout
+        # the VISA timeout is in ms
+        self.motor.timeout = self.probe_timeout * 1000
+        try:
+            output = self.motor.query(self.batched_query())
+            return self.parse_batched(output) is not None
+        except pyvisa.VisaIOError:
+            # discards an answer which would come late
+            self.motor.clear()
+            return False
+        finally:
+            self.motor.timeout = timeout
+
+    def axis_position(self, axis):
+        output = self.execute(self.axis_prefix(axis) + "TP", axis)
+        try:
+            return float(output.split(",")[0])
+        except (AttributeError, ValueError):
+            return math.nan
+
+    def query_positions(self):
+        """ Positions of all the axes, with a single query if the controller
+        answers to the batched one
+
+        """
+        if self.batch_queries:
+            positions = self.parse_batched(self.execute(self.batched_query()))
+            if positions is not None:
+                return positions
+            # the controller stopped answering to batched queries
+            self.batch_queries = False
+        return [self.axis_position(axis) for axis in self.axes]
+
+    def update_positions(self):
+        positions = self.query_positions()
+        self.positions[:] = positions
+        self.t_positions.value = perf_counter()
+
+    def run_command(self, command: MotorCommand):
+        i_axis = self.axes.index(command.axis)
+        prefix = self.axis_prefix(command.axis)
+        if command.command == "move_abs":
+            target = command.value
+            serial_command = prefix + "PA" + str(command.value)
+        elif command.command == "move_rel":
+            # from the position when the move starts, the cached one can be
+            # from before the previous command
+            position = self.axis_position(command.axis)
+            if math.isnan(position):
+                position = self.positions[i_axis]
+            target = position + command.value
+            serial_command = prefix + "PR" + str(command.value)
+        elif command.command == "go_home":
+            target = None
+            serial_command = prefix + "OR2"
+        else:
+            target = None
+            serial_command = prefix + command.command
+        if self.execute(serial_command, command.axis, command.command_id) is None:
+            return
+        self.notify(command.command_id, command.axis, "done")
+        if command.command in ("move_abs", "move_rel", "go_home"):
+            # a new move on the same axis supersedes the previous one
+            self.moves[command.axis] = dict(
+                command_id=command.command_id,
+                target=target,
+                t_start=perf_counter(),
+                t_within=None,
+                last_position=math.nan,
+            )
+
+    def check_settled(self):
+        t_now = perf_counter()
+        for axis, move in list(self.moves.items()):
+            position = self.positions[self.axes.index(axis)]
+            target = move["target"]
+            if target is None:
+                # homing, settled once the axis stops moving
+                target = move["last_position"]
+                move["last_position"] = position
+            within = abs(position - target) <= self.settle_tolerance
+            if not within:
+                move["t_within"] = None
+            elif move["t_within"] is None:
+                move["t_within"] = t_now
+            if move["t_within"] is not None and t_now - move["t_within"] >= self.settle_time:
+                self.notify(move["command_id"], axis, "settled", position)
+                del self.moves[axis]
+            elif t_now - move["t_start"] > self.settle_timeout:
+                self.notify(
+                    move["command_id"],
+                    axis,
+                    "error",
+                    "not settled at {} after {} s, at {}".format(
+                        target, self.settle_timeout, position
+                    ),
+                )
+                del self.moves[axis]
+
+    def open(self):
+        t_start = perf_counter()
+        rm = pyvisa.ResourceManager()
+        self.motor = rm.open_resource(
+            self.port,
+            baud_rate=921600,
+            parity=pyvisa.constants.Parity.none,
+            encoding="ascii",
+            timeout=10,
+        )
+        for axis in self.axes:
+            self.start_session(axis)
+        if self.batch_queries is None:
+            self.batch_queries = len(self.axes) > 1 and self.probe_batch_queries()
+        self.update_positions()
+        self.home_positions[:] = self.positions[:]
+        self.ready_event.set()
+        self.notify(None, None, "ready", perf_counter() - t_start)
+
+    def close(self):
+        for axis in self.axes:
+            # motor off
+            self.execute(self.axis_prefix(axis) + "MF", axis)
+        self.motor.close()
+
+    def run(self):
+        try:
+            self.open()
+        except Exception as e:
+            self.notify(None, None, "error", "could not open {}: {}".format(self.port, e))
+            return
+        t_poll = 0.0
+        while not self.stop_event.is_set():
+            try:
+                while True:
+                    self.run_command(self.command_queue.get_nowait())
+            except Empty:
+                pass
+            if perf_counter() - t_poll >= self.poll_interval.value:
+                t_poll = perf_counter()
+                self.update_positions()
+                self.check_settled()
+            sleep(0.001)
+        self.close()
+
+
+class MotorClient:
+    """ The side of the motor service in the main process, which sends
+    the commands and keeps the state of the notified ones
+
+    """
+
+    def __init__(self, service: MotorService):
+        self.service = service
+        self.command_ids = count()
+        self.command_states = dict()
+        self.errors = []
+        self.startup_duration = None
+
+    @property
+    def ready(self):
+        return self.service.ready_event.is_set()
+
+    def send(self, axis, command, value=0.0):
+        """ Sends the command and returns its id, to check its state
+        """
+        command_id = next(self.command_ids)
+        self.command_states[command_id] = "sent"
+        self.service.command_queue.put(MotorCommand(command_id, axis, command, value))
+        return command_id
+
+    def update(self):
+        """ Takes the notifications of the service, returns the new errors
+        """
+        new_errors = []
+        while True:
+            try:
+                notification = self.service.notification_queue.get_nowait()
+            except Empty:
+                break
+            if notification.kind == "ready":
+                self.startup_duration = notification.message
+            elif notification.kind == "error":
+                new_errors.append(notification)
+                print("Motor {} error: {}".format(notification.axis, notification.message))
+            if notification.command_id is not None:
+                self.command_states[notification.command_id] = notification.kind
+        self.errors.extend(new_errors)
+        return new_errors
+
+    def state(self, command_id):
+        self.update()
+        return self.command_states.get(command_id)
+
+    def wait(self, command_id, kind="settled", timeout=10.0):
+        """ Waits until the command is in the given state, returns whether
+        it got there
+        """
+        t_start = perf_counter()
+        while perf_counter() - t_start < timeout:
+            state = self.state(command_id)
+            if state == kind or state == "error":
+                return state == kind
+            sleep(0.005)
+        return False
+
+    def position(self, axis):
+        return self.service.positions[self.service.axes.index(axis)]
+
+    def stop(self):
+        self.service.stop_event.set()
+        self.service.join()
+
+
+class MotorProxy:
+    """ Stands for a MotorControl of one axis, with the positions read from
+    the cache of the service and the commands sent to it without blocking
+
+    """
+
+    def __init__(self, client: MotorClient, axis):
+        self.client = client
+        self.axis = axis
+        self.axes = str(AXIS_NUMBERS[axis])
+        self.home_pos = client.service.home_positions[client.service.axes.index(axis)]
+        self.connection = True
+        self.last_command = None
+
+    def get_position(self):
+        position = self.client.position(self.axis)
+        return None if math.isnan(position) else position
+
+    def send_command(self, command):
+        # "MO": motor on, "MF": off
+        self.last_command = self.client.send(self.axis, command)
+        return self.last_command
+
+    def move_abs(self, coordinate):
+        self.last_command = self.client.send(self.axis, "move_abs", coordinate)
+        return self.last_command
+
+    def move_rel(self, displacement=0.0):
+        self.last_command = self.client.send(self.axis, "move_rel", displacement)
+        return self.last_command
+
+    def define_home(self):
+        self.home_pos = self.get_position()
+
+    def go_home(self):
+        self.last_command = self.client.send(self.axis, "go_home")
+        return self.last_command
+
+    def end_session(self):
+        # the connection is closed by the service when it stops
+        self.connection = False
@@ -97,9 +97,11 @@ class MotorSlider(QWidget):
         self.slider.sig_changed.connect(self.update_values)
         self.sig_changed.connect(self.slider.motor.move_abs)
 
+        # the positions are read from the cache of the motor service,
+        # which polls the controller
         self._timer_painter = QTimer(self)
         self._timer_painter.timeout.connect(self.update_actual_pos)
-        self._timer_painter.start()
+        self._timer_painter.start(50)
 
     def update_actual_pos(self):
         if self.slider.motor.connection is True:
@@ -0,0 +1,341 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Optional
+from time import perf_counter
+import json
+import os
+import click
+import flammkuchen as fl
+import numpy as np
+
+import scanning_patterns
+import sparse_reconstruction
+from scanning import reconstruction_waveform, image_shape, reconstruction_matrix
+from raw_capture import load_raw, load_generations, waveform_hash
+from streaming_save import save_times, SAVED_SCALE
+
+CHANNEL_INDICES = dict(Green=[0], Red=[1], Both=[0, 1])
+
+
+@dataclass
+class ReconstructionOptions:
+    # the offset of the recording if None
+    mystery_offset: Optional[int] = None
+    channel: str = "Both"  # Green, Red or Both, as in the recordings
+    # the first bin_skip samples of each pixel are left out, and the
+    # following bin_samples, or all the others if None, are summed
+    bin_skip: int = 0
+    bin_samples: Optional[int] = None
+    # "pixels" or "sparse", the one of the recording if None
+    reconstruction: Optional[str] = None
+
+
+def reconstruct_frame(
+    samples, sp, waveform, shape, options: ReconstructionOptions, matrix=None
+):
+    """ The images of the channels, as reconstructed by the ImageReconstructor
+    and converted for saving by the StackSaver, with the sparse matrix if given
+    """
+    channels = CHANNEL_INDICES[options.channel]
+    if matrix is not None:
+        images = sparse_reconstruction.reconstruct_sparse(
+            matrix, samples[channels].astype(np.float64), shape
+        )
+        return (np.negative(images) / SAVED_SCALE).astype(np.int16)
+    n_bin = sp.n_bin
+    n_used = options.bin_samples or n_bin - options.bin_skip
+    images = []
+    for i_channel in channels:
+        signal = np.roll(samples[i_channel].astype(np.float64), sp.mystery_offset)
+        if n_used != n_bin:
+            signal = np.ascontiguousarray(
+                signal.reshape(-1, n_bin)[
+                    :, options.bin_skip : options.bin_skip + n_used
+                ]
+            ).reshape(-1)
+        images.append(
+            scanning_patterns.reconstruct_image_pattern(
+                signal, *waveform, shape, n_used
+            )
+        )
+    # the PMT signal is negative, and the saver stores int16
+    return (np.negative(np.stack(images)) / SAVED_SCALE).astype(np.int16)
+
+
+# state of each worker process, set by the initializer
+_worker = dict()
+
+
+def generation_reconstruction(sp, rp, options: ReconstructionOptions):
+    """ The parameters, waveform, image shape and sparse matrix, if any, to
+    reconstruct the frames of a generation of parameters
+    """
+    if options.mystery_offset is not None:
+        sp = replace(sp, mystery_offset=options.mystery_offset)
+    if options.reconstruction is not None:
+        sp = replace(sp, reconstruction=options.reconstruction)
+    return dict(
+        sp=sp,
+        waveform=reconstruction_waveform(sp, rp),
+        shape=image_shape(sp, rp),
+        matrix=(
+            reconstruction_matrix(sp, rp, options.bin_skip, options.bin_samples)
+            if sp.reconstruction == "sparse"
+            else None
+        ),
+    )
+
+
+def _init_worker(path, options):
+    _, _, metadata, samples = load_raw(path)
+    generations, _ = load_generations(path, metadata)
+    _worker.update(
+        samples=samples,
+        options=options,
+        generations=[
+            generation_reconstruction(sp, rp, options) for sp, rp in generations
+        ],
+    )
+
+
+def _reconstruct_chunk(chunk):
+    frame_indices, i_generations = chunk
+    images = []
+    for i, i_generation in zip(frame_indices, i_generations):
+        generation = _worker["generations"][i_generation]
+        images.append(
+            reconstruct_frame(
+                _worker["samples"][i],
+                generation["sp"],
+                generation["waveform"],
+                generation["shape"],
+                _worker["options"],
+                generation["matrix"],
+            )
+        )
+    return np.stack(images)
+
+
+def plane_frames(path, n_frames):
+    """ Indices of the captured frames of each plane, the frames read
+    before the first plane started are left out
+    """
+    frames = fl.load(Path(path) / "raw" / "frames.h5")
+    t = np.asarray(frames["t"])[:n_frames]
+    plane_start = np.asarray(frames["plane_start"])
+    if len(plane_start) == 0:
+        return [np.arange(n_frames)]
+    i_plane = np.searchsorted(plane_start, t) - 1
+    return [np.flatnonzero(i_plane == i) for i in range(len(plane_start))]
+
+
+class StackWriter:
+    """ Writes the planes in the layout of the StackSaver
+    """
+
+    def __init__(self, output_dir, channel, n_t, n_z, shape):
+        self.output_dir = Path(output_dir)
+        self.channel = channel
+        self.n_t = n_t
+        self.n_z = n_z
+        self.shape = shape
+        if channel == "Both":
+            self.channel_dirs = [
+                self.output_dir / "original" / "green",
+                self.output_dir / "original" / "red",
+            ]
+        else:
+            self.channel_dirs = [self.output_dir / "original"]
+        for channel_dir in self.channel_dirs:
+            channel_dir.mkdir(parents=True, exist_ok=True)
+        self.timestamps = []
+        self.sample_timestamps = []
+        self.plane_starts = []
+
+    def write_plane(self, i_plane, stack, times, sample_times):
+        for i_channel, channel_dir in enumerate(self.channel_dirs):
+            fl.save(
+                channel_dir / "{:04d}.h5".format(i_plane),
+                {"stack_4D": stack[:, i_channel : i_channel + 1]},
+                compression="blosc",
+            )
+        self.timestamps.append(times - times[0])
+        self.sample_timestamps.append(sample_times - sample_times[0])
+        self.plane_starts.append((times[0], sample_times[0]))
+        save_times(
+            self.output_dir / "time.h5",
+            np.squeeze(np.vstack(self.timestamps)).T,
+            np.squeeze(np.vstack(self.sample_timestamps)).T,
+            *zip(*self.plane_starts),
+        )
+
+    def finalize(self):
+        for channel_dir in self.channel_dirs:
+            with open(channel_dir / "stack_metadata.json", "w") as f:
+                json.dump(
+                    {
+                        "shape_full": (self.n_t, len(self.timestamps), *self.shape),
+                        "shape_block": (self.n_t, 1, *self.shape),
+                        "crop_start": [0, 0, 0, 0],
+                        "crop_end": [0, 0, 0, 0],
+                        "padding": [0, 0, 0, 0],
+                    },
+                    f,
+                )
+
+
+def reconstruct_recording(
+    path, output_dir, options=None, n_workers=None, chunk_size=8, report_interval=5.0
+):
+    """ Reconstructs the raw samples captured with a recording again, with
+    the frames shared among worker processes which read the memory-mapped
+    samples, and writes the planes in the layout of the saved stacks.
+    Returns the number of frames reconstructed per second
+
+    """
+    options = options if options is not None else ReconstructionOptions()
+    n_workers = n_workers or os.cpu_count() or 1
+    sp, rp, metadata, samples = load_raw(path)
+    generations, i_generations = load_generations(path, metadata)
+    n_used = options.bin_samples or sp.n_bin - options.bin_skip
+    if n_used <= 0 or options.bin_skip + n_used > sp.n_bin:
+        raise ValueError(
+            "Cannot sum {} samples after skipping {}, the pixels have {}".format(
+                n_used, options.bin_skip, sp.n_bin
+            )
+        )
+    hashes = [
+        generation["waveform_hash"]
+        for generation in metadata.get("generations", [metadata])
+    ]
+    if any(
+        waveform_hash(*parameters) != recorded
+        for parameters, recorded in zip(generations, hashes)
+    ):
+        print(
+            "The scanning pattern differs from the one of the capture, "
+            "the images will not match the recording"
+        )
+    shape = image_shape(sp, rp)
+    # the planes are saved in one shape, which the parameters have to keep
+    if any(image_shape(*parameters) != shape for parameters in generations):
+        raise ValueError("The image shape changed during the capture")
+    planes = plane_frames(path, metadata["n_frames"])
+    # all the planes of a stack have the same number of frames
+    n_t = min(len(frames) for frames in planes)
+    frames = fl.load(Path(path) / "raw" / "frames.h5")
+    times = np.asarray(frames["t"])
+    # captured before the frames had the times of the sample clock
+    sample_times = np.asarray(frames.get("t_sample", np.full(len(times), np.nan)))
+    writer = StackWriter(output_dir, options.channel, n_t, len(planes), shape)
+
+    n_channels = len(CHANNEL_INDICES[options.channel])
+    planes = [frames[:n_t] for frames in planes]
+    # the chunks follow each other across the planes, so that the workers
+    # do not wait for the end of each plane
+    chunks = [
+        (i_plane, frames[i : i + chunk_size])
+        for i_plane, frames in enumerate(planes)
+        for i in range(0, n_t, chunk_size)
+    ]
+    t_start = perf_counter()
+    t_report = t_start
+    n_done = 0
+    stack = np.empty((n_t, n_channels, *shape), dtype=np.int16)
+    i_frame = 0
+    with ProcessPoolExecutor(
+        n_workers, initializer=_init_worker, initargs=(str(path), options)
+    ) as executor:
+        # about two chunks per worker are in flight, so that the reconstructed
+        # ones do not pile up in memory while the planes are written
+        in_flight = deque()
+        i_submitted = 0
+        for i_plane, _ in chunks:
+            while i_submitted < len(chunks) and len(in_flight) < 2 * n_workers:
+                submitted = chunks[i_submitted][1]
+                in_flight.append(
+                    executor.submit(
+                        _reconstruct_chunk, (submitted, i_generations[submitted])
+                    )
+                )
+                i_submitted += 1
+            block = in_flight.popleft().result()
+            stack[i_frame : i_frame + len(block)] = block
+            i_frame += len(block)
+            n_done += len(block)
+            if i_frame == n_t:
+                writer.write_plane(
+                    i_plane,
+                    stack,
+                    times[planes[i_plane]],
+                    sample_times[planes[i_plane]],
+                )
+                i_frame = 0
+            if perf_counter() - t_report > report_interval:
+                t_report = perf_counter()
+                print(
+                    "plane {}/{}, {:.1f} frames/s".format(
+                        i_plane + 1, len(planes), n_done / (t_report - t_start)
+                    ),
+                    flush=True,
+                )
+    writer.finalize()
+    framerate = n_done / (perf_counter() - t_start)
+    print(
+        "{} frames of {} planes in {:.1f} s, {:.1f} frames/s with {} workers".format(
+            n_done, len(planes), perf_counter() - t_start, framerate, n_workers
+        )
+    )
+    return framerate
+
+
+@click.command()
+@click.argument("recording", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the new stack, by default reconstructed in the recording",
+)
+@click.option("--offset", type=int, default=None, help="Mystery offset in samples")
+@click.option("--channel", type=click.Choice(["Green", "Red", "Both"]), default="Both")
+@click.option(
+    "--bin-skip", type=int, default=0, help="Samples of each pixel left out first"
+)
+@click.option(
+    "--bin-samples",
+    type=int,
+    default=None,
+    help="Samples of each pixel summed, by default all the ones after the skipped",
+)
+@click.option(
+    "--reconstruction",
+    type=click.Choice(["pixels", "sparse"]),
+    default=None,
+    help="By default the one of the recording",
+)
+@click.option("--workers", type=int, default=None, help="By default one per core")
+def main(
+    recording, output, offset, channel, bin_skip, bin_samples, reconstruction, workers
+):
+    """ Reconstructs the raw samples captured with a recording again,
+    e.g. with another offset
+    """
+    reconstruct_recording(
+        recording,
+        output if output is not None else Path(recording) / "reconstructed",
+        ReconstructionOptions(
+            mystery_offset=offset,
+            channel=channel,
+            bin_skip=bin_skip,
+            bin_samples=bin_samples,
+            reconstruction=reconstruction,
+        ),
+        n_workers=workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
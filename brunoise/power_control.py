@@ -1,5 +1,12 @@
 import pyvisa
 from math import acos
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Optional
+import json
+import numpy as np
 
 
 class LaserPowerControl:
@@ -79,3 +86,186 @@ class LaserPowerControl:
             power_units / amplitude - vertical_shift
         ) / frequency
         return target_units
+
+
+class PowerCalibration:
+    """ Table mapping the laser power in percent to the angle of the
+    rotation stage, interpolated in both directions
+
+    """
+
+    def __init__(self, percent, angle):
+        percent = np.asarray(percent, dtype=float)
+        angle = np.asarray(angle, dtype=float)
+        order = np.argsort(percent)
+        self.percent = percent[order]
+        self.angle = angle[order]
+        if not (np.all(np.diff(self.angle) > 0) or np.all(np.diff(self.angle) < 0)):
+            raise ValueError("The calibration angles have to be monotonic in power")
+        angle_order = np.argsort(self.angle)
+        self.sorted_angle = self.angle[angle_order]
+        self.percent_by_angle = self.percent[angle_order]
+
+    def to_angle(self, percent):
+        return np.interp(percent, self.percent, self.angle)
+
+    def to_percent(self, angle):
+        return np.interp(angle, self.sorted_angle, self.percent_by_angle)
+
+    @classmethod
+    def from_transformer(cls, n_points=1001):
+        """ Table of LaserPowerControl.unit_transformer, with the powers
+        outside of its domain clipped to the closest valid angle
+        """
+        percent = np.linspace(0, 100, n_points)
+        angle = []
+        for p in percent:
+            try:
+                angle.append(LaserPowerControl.unit_transformer(p))
+            except ValueError:
+                angle.append(np.nan)
+        angle = np.array(angle)
+        valid = np.isfinite(angle)
+        return cls(percent[valid], angle[valid])
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a table saved by the calibration notebook, as a JSON with
+        percent and angle lists or a text file with the two columns
+        """
+        path = Path(path)
+        if path.suffix == ".json":
+            with open(path) as f:
+                table = json.load(f)
+            return cls(table["percent"], table["angle"])
+        percent, angle = np.loadtxt(path, delimiter=",", unpack=True)
+        return cls(percent, angle)
+
+    @classmethod
+    def load_or_default(cls, path=None):
+        if path is not None:
+            try:
+                return cls.load(path)
+            except (OSError, KeyError, ValueError) as e:
+                print("Could not load the laser calibration {}: {}".format(path, e))
+        return cls.from_transformer()
+
+
+class PowerRamp:
+    """ Laser power as a function of the plane of a z-stack, linear between
+    the first and the last plane, converted to angles ahead of the stack
+
+    """
+
+    def __init__(self, calibration: PowerCalibration, first, last, n_planes):
+        self.percent = np.linspace(first, last, max(n_planes, 1))
+        self.angle = calibration.to_angle(self.percent)
+
+    def __len__(self):
+        return len(self.percent)
+
+
+class PowerService(Thread):
+    """ Drives the rotation stage of the laser power off the GUI thread.
+    Power targets are debounced, to move only once a setting stops changing,
+    and skipped if they do not change the angle. The position of the stage
+    is read back and reported as position_angle and position_percent
+
+    """
+
+    def __init__(
+        self,
+        open_device=LaserPowerControl,
+        calibration: PowerCalibration = None,
+        debounce=0.2,
+        poll_interval=0.5,
+        angle_tolerance=0.01,
+    ):
+        super().__init__(daemon=True)
+        self.open_device = open_device
+        self.calibration = (
+            calibration if calibration is not None else PowerCalibration.from_transformer()
+        )
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.angle_tolerance = angle_tolerance
+        self.device = None
+        self.ready = Event()
+        self.stopped = Event()
+        self.error = None
+        self.startup_duration = None
+        self.targets = SimpleQueue()
+        self.ramp: Optional[PowerRamp] = None
+        self.last_angle = None
+        self.position_angle = None
+        self.position_percent = None
+
+    def set_power(self, percent):
+        self.targets.put((perf_counter(), float(self.calibration.to_angle(percent)), True))
+
+    def set_ramp(self, ramp: Optional[PowerRamp]):
+        self.ramp = ramp
+
+    def go_to_plane(self, i_plane):
+        """ Moves to the power of the plane of the ramp without debouncing,
+        so that the stage moves while the objective does
+        """
+        if self.ramp is not None:
+            angle = self.ramp.angle[min(i_plane, len(self.ramp) - 1)]
+            self.targets.put((perf_counter(), float(angle), False))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def latest_target(self):
+        """ The latest of the queued targets as (time set, angle, debounced),
+        or None if there is none. The debouncing is left to the caller
+        """
+        target = None
+        while True:
+            try:
+                target = self.targets.get_nowait()
+            except Empty:
+                break
+        return target
+
+    def move(self, angle):
+        if self.last_angle is not None and abs(angle - self.last_angle) < self.angle_tolerance:
+            return
+        self.device.rotatory_stage.write("{}PA{}".format(self.device.device, angle))
+        self.last_angle = angle
+
+    def read_position(self):
+        try:
+            output = self.device.get_position()
+            self.position_angle = float(output.strip().split("TP")[-1])
+            self.position_percent = float(self.calibration.to_percent(self.position_angle))
+        except Exception:
+            pass
+
+    def run(self):
+        t_start = perf_counter()
+        try:
+            self.device = self.open_device()
+        except Exception as e:
+            self.error = e
+            return
+        self.startup_duration = perf_counter() - t_start
+        self.ready.set()
+        pending = None
+        t_poll = 0.0
+        while not self.stopped.is_set():
+            latest = self.latest_target()
+            if latest is not None:
+                pending = latest
+            if pending is not None:
+                t_set, angle, debounced = pending
+                if not debounced or perf_counter() - t_set >= self.debounce:
+                    self.move(angle)
+                    pending = None
+            if perf_counter() - t_poll >= self.poll_interval:
+                t_poll = perf_counter()
+                self.read_position()
+            sleep(0.01)
+        self.device.terminate_connection()
@@ -0,0 +1,137 @@
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+PRIORITIES = ["low", "normal", "high", "realtime"]
+
+if sys.platform == "win32" and psutil is not None:
+    PRIORITY_CLASSES = dict(
+        low=psutil.BELOW_NORMAL_PRIORITY_CLASS,
+        normal=psutil.NORMAL_PRIORITY_CLASS,
+        high=psutil.HIGH_PRIORITY_CLASS,
+        realtime=psutil.REALTIME_PRIORITY_CLASS,
+    )
+else:
+    PRIORITY_CLASSES = dict(low=10, normal=0, high=-10, realtime=-20)
+
+
+@dataclass
+class ProcessPlacement:
+    """ Where and how a process of the pipeline runs. None leaves the
+    operating system or library default in place
+
+    """
+
+    cores: Optional[Tuple[int, ...]] = None
+    priority: str = "normal"
+    n_blosc_threads: Optional[int] = None
+    n_numba_threads: Optional[int] = None
+
+
+def default_placement(n_cores=None):
+    """ Gives the scanner a dedicated core with high priority, the other
+    processes share the remaining ones. With less than 4 cores nothing is pinned
+
+    """
+    n_cores = n_cores or os.cpu_count() or 1
+    if n_cores < 4:
+        return dict(
+            main=ProcessPlacement(),
+            scanner=ProcessPlacement(priority="high"),
+            reconstructor=ProcessPlacement(),
+            saver=ProcessPlacement(),
+            registration=ProcessPlacement(),
+            raw_saver=ProcessPlacement(),
+        )
+    scanner_core = n_cores - 1
+    other_cores = tuple(range(n_cores - 1))
+    return dict(
+        main=ProcessPlacement(cores=other_cores),
+        scanner=ProcessPlacement(
+            cores=(scanner_core,), priority="high", n_numba_threads=1
+        ),
+        reconstructor=ProcessPlacement(
+            cores=other_cores, priority="high", n_numba_threads=1
+        ),
+        saver=ProcessPlacement(
+            cores=other_cores,
+            priority="low",
+            n_blosc_threads=max(1, len(other_cores) // 2),
+        ),
+        registration=ProcessPlacement(cores=other_cores, n_numba_threads=1),
+        # only writes to the disk, it must not compete with the reconstructor
+        raw_saver=ProcessPlacement(cores=other_cores, priority="low"),
+    )
+
+
+def _set_cores(cores):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    elif psutil is not None:
+        psutil.Process().cpu_affinity(list(cores))
+    else:
+        raise OSError("setting the affinity requires psutil")
+
+
+def _get_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return tuple(sorted(os.sched_getaffinity(0)))
+    if psutil is not None:
+        return tuple(psutil.Process().cpu_affinity())
+    return None
+
+
+def _set_priority(priority):
+    if priority == "realtime" and hasattr(os, "sched_setscheduler"):
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(50))
+    elif psutil is not None:
+        psutil.Process().nice(PRIORITY_CLASSES[priority])
+    else:
+        os.setpriority(os.PRIO_PROCESS, 0, PRIORITY_CLASSES[priority])
+
+
+def _set_blosc_threads(n_threads):
+    import tables
+
+    tables.set_blosc_max_threads(n_threads)
+
+
+def _set_numba_threads(n_threads):
+    import numba
+
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def apply_placement(name, placement: Optional[ProcessPlacement]):
+    """ Applies the placement to the calling process and prints what
+    could be applied, as settings which need privileges can fail
+
+    """
+    if placement is None:
+        placement = ProcessPlacement()
+    report = []
+    for description, setter, value in [
+        ("cores", _set_cores, placement.cores),
+        ("priority", _set_priority, placement.priority),
+        ("blosc threads", _set_blosc_threads, placement.n_blosc_threads),
+        ("numba threads", _set_numba_threads, placement.n_numba_threads),
+    ]:
+        if value is None or (description == "priority" and value == "normal"):
+            continue
+        try:
+            setter(value)
+        except Exception as e:
+            report.append("{} {} failed ({})".format(description, value, e))
+        else:
+            report.append("{} {}".format(description, value))
+
+    if placement.cores is None:
+        report.insert(0, "cores {}".format(_get_cores()))
+    print("{} (pid {}): {}".format(name, os.getpid(), ", ".join(report)))
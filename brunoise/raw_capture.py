@@ -0,0 +1,276 @@
+from multiprocessing import Event, Process, Queue
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from queue import Empty
+from time import perf_counter_ns
+import hashlib
+import json
+import flammkuchen as fl
+import numpy as np
+
+from scanning import (
+    ScanningParameters,
+    ScanningState,
+    RoiParameters,
+    reconstruction_waveform,
+)
+from frame_queues import FrameQueue, BackpressurePolicy
+from sequence_diagram import NoTrace, TraceEvent
+from process_placement import apply_placement
+from sample_clock import frame_sample_time
+
+RAW_CHANNELS = ["green", "red"]
+
+
+@dataclass
+class RawCaptureParameters:
+    output_dir: Path
+    scanning_parameters: ScanningParameters
+    roi_parameters: RoiParameters
+
+
+def waveform_hash(sp: ScanningParameters, rp: RoiParameters):
+    """ Hash of the pixel positions of the samples, to check that an
+    offline reconstruction uses the same scanning pattern
+    """
+    digest = hashlib.sha1()
+    for array in reconstruction_waveform(sp, rp):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def parameters_to_dict(sp: ScanningParameters, rp: RoiParameters):
+    scanning = asdict(sp)
+    scanning["scanning_state"] = sp.scanning_state.name
+    return dict(scanning_parameters=scanning, roi_parameters=asdict(rp))
+
+
+def parameters_from_dict(metadata):
+    scanning = dict(metadata["scanning_parameters"])
+    scanning["scanning_state"] = ScanningState[scanning["scanning_state"]]
+    roi = dict(metadata["roi_parameters"])
+    if roi["roi_rect"] is not None:
+        roi["roi_rect"] = tuple(roi["roi_rect"])
+    return ScanningParameters(**scanning), RoiParameters(**roi)
+
+
+def load_raw(path):
+    """ The parameters of the first frame, the metadata and the memory-mapped
+    samples of the frames, of shape (n_frames, n_channels, n_samples), captured
+    in the recording directory
+    """
+    raw_dir = Path(path) / "raw"
+    with open(raw_dir / "raw_metadata.json") as f:
+        metadata = json.load(f)
+    sp, rp = parameters_from_dict(metadata)
+    samples = np.memmap(
+        raw_dir / "samples.bin",
+        dtype=np.dtype(metadata["dtype"]),
+        mode="r",
+        shape=(
+            metadata["n_frames"],
+            len(metadata["channels"]),
+            metadata["n_samples"],
+        ),
+    )
+    return sp, rp, metadata, samples
+
+
+def load_generations(path, metadata):
+    """ The (scanning, ROI) parameters the frames were scanned with, and
+    the index in them of the ones of each frame
+    """
+    frames = fl.load(Path(path) / "raw" / "frames.h5")
+    if "generations" not in metadata:
+        # captured before the parameters were recorded for each frame
+        return [parameters_from_dict(metadata)], np.zeros(metadata["n_frames"], int)
+    return (
+        [parameters_from_dict(generation) for generation in metadata["generations"]],
+        np.asarray(frames["i_generation"]),
+    )
+
+
+class RawSaver(Process):
+    """ Writes the samples of the PMTs, as read by the scanner, next to the
+    saved stack, so that a recording can be reconstructed again offline.
+    The reconstructor copies the frames into the queue while capture_event
+    is set, and the frames which do not fit in it are dropped so that the
+    live path never waits for the disk. The frames are appended to
+    raw/samples.bin, which can be memory-mapped, and raw_metadata.json
+    records the parameters and the hash of the scanning waveform of each
+    generation of parameters the frames were scanned with, which the
+    reconstructor sends through the generation queue
+
+    """
+
+    def __init__(
+        self, stop_event, max_mbytes=200, dtype=np.float32, trace=None, placement=None
+    ):
+        super().__init__()
+        self.trace = trace if trace is not None else NoTrace()
+        self.placement = placement
+        self.stop_event = stop_event
+        # the samples are digitised with 16 bits, float32 keeps them exactly
+        self.dtype = np.dtype(dtype)
+        self.frame_queue = FrameQueue(
+            "raw",
+            max_mbytes=max_mbytes,
+            policy=BackpressurePolicy.DROP_NEWEST,
+            stop_event=stop_event,
+        )
+        self.capture_event = Event()
+        self.parameter_queue = Queue()
+        # (generation, scanning parameters, ROI parameters) of the frames
+        self.generation_queue = Queue()
+        # times at which the planes of the recording start
+        self.plane_queue = Queue()
+
+    def run(self):
+        apply_placement("raw_saver", self.placement)
+        while not self.stop_event.is_set():
+            try:
+                parameters = self.parameter_queue.get(timeout=0.01)
+            except Empty:
+                continue
+            self.capture(parameters)
+
+    def capture(self, parameters: RawCaptureParameters):
+        raw_dir = Path(parameters.output_dir) / "raw"
+        raw_dir.mkdir(parents=True, exist_ok=True)
+        seqs = []
+        times = []
+        sample_times = []
+        plane_starts = []
+        # the parameters received for each generation, the frames of an
+        # unknown one have the parameters of the capture, and the generations
+        # of the frames written, in the order of their first frame
+        received = {
+            None: (parameters.scanning_parameters, parameters.roi_parameters)
+        }
+        generations = []
+        i_generations = []
+        n_samples = None
+        # frames of another size, after a change of the resolution, which
+        # cannot go in the same file
+        n_other_size = 0
+        last_seq = None
+        with open(raw_dir / "samples.bin", "wb") as f:
+            while not self.stop_event.is_set():
+                self.receive_plane_starts(plane_starts)
+                try:
+                    t_start = perf_counter_ns()
+                    header, frame = self.frame_queue.get(timeout=0.01)
+                    self.trace.span(TraceEvent.QUEUE_GET, t_start)
+                except Empty:
+                    # the frames still queued are written once the capture stops
+                    if not self.capture_event.is_set():
+                        break
+                    continue
+                last_seq = header.seq
+                if n_samples is None:
+                    n_samples = frame.shape[1]
+                elif frame.shape[1] != n_samples:
+                    n_other_size += 1
+                    continue
+                generation = self.receive_generation(received, header.generation)
+                if generation not in generations:
+                    generations.append(generation)
+                t_start = perf_counter_ns()
+                frame.astype(self.dtype).tofile(f)
+                self.trace.span(TraceEvent.COMPRESSION, t_start)
+                i_generations.append(generations.index(generation))
+                seqs.append(header.seq)
+                times.append(header.t)
+                sample_times.append(frame_sample_time(header))
+        self.receive_plane_starts(plane_starts)
+        self.write_metadata(
+            raw_dir,
+            parameters,
+            [received[generation] for generation in generations],
+            i_generations,
+            seqs,
+            times,
+            sample_times,
+            plane_starts,
+            n_samples,
+            last_seq,
+            n_other_size,
+        )
+
+    def receive_generation(self, received, generation):
+        """ Waits for the parameters of the generation of the frame, which
+        the reconstructor sends before its first frame
+        """
+        while generation not in received:
+            try:
+                new_generation, sp, rp = self.generation_queue.get(timeout=1)
+                received[new_generation] = (sp, rp)
+            except Empty:
+                # never sent, the frames get the parameters of the capture
+                received[generation] = received[None]
+        return generation
+
+    def receive_plane_starts(self, plane_starts):
+        while True:
+            try:
+                plane_starts.append(self.plane_queue.get_nowait())
+            except Empty:
+                break
+
+    def write_metadata(
+        self,
+        raw_dir,
+        parameters,
+        generations,
+        i_generations,
+        seqs,
+        times,
+        sample_times,
+        plane_starts,
+        n_samples,
+        last_seq,
+        n_other_size,
+    ):
+        fl.save(
+            raw_dir / "frames.h5",
+            dict(
+                seq=np.array(seqs),
+                t=np.array(times),
+                t_sample=np.array(sample_times),
+                plane_start=np.array(plane_starts),
+                i_generation=np.array(i_generations, dtype=np.int64),
+            ),
+        )
+        # the frames missing up to the last one received, the ones of another
+        # size included
+        n_dropped = last_seq - seqs[0] + 1 - len(seqs) if len(seqs) > 0 else 0
+        if len(generations) == 0:
+            generations = [(parameters.scanning_parameters, parameters.roi_parameters)]
+        # the parameters at the top level are the ones of the first frame
+        metadata = parameters_to_dict(*generations[0])
+        metadata.update(
+            waveform_hash=waveform_hash(*generations[0]),
+            generations=[
+                dict(**parameters_to_dict(sp, rp), waveform_hash=waveform_hash(sp, rp))
+                for sp, rp in generations
+            ],
+            channels=RAW_CHANNELS,
+            dtype=self.dtype.str,
+            n_samples=n_samples if n_samples is not None else 0,
+            n_frames=len(seqs),
+            n_dropped=n_dropped,
+            n_other_size=n_other_size,
+        )
+        with open(raw_dir / "raw_metadata.json", "w") as f:
+            json.dump(metadata, f, indent=2)
+        if n_other_size > 0:
+            print(
+                "{} frames of raw samples were left out, their size changed "
+                "during the capture".format(n_other_size)
+            )
+        if n_dropped > n_other_size:
+            print(
+                "{} frames of raw samples were dropped, the disk is too slow".format(
+                    n_dropped - n_other_size
+                )
+            )
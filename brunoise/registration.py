@@ -0,0 +1,141 @@
+from multiprocessing import Event, Process, Queue, RawValue
+from dataclasses import dataclass
+from queue import Empty
+import numpy as np
+
+from frame_queues import FrameQueue, BackpressurePolicy
+from process_placement import apply_placement
+
+
+@dataclass
+class RegistrationParameters:
+    downsampling: int = 4
+    n_reference: int = 10
+    channel: int = 0
+
+
+def downsample(image, factor):
+    """ Block mean, the edges that do not fit in a block are cropped
+    """
+    n_x, n_y = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    return (
+        image[:n_x, :n_y]
+        .reshape(n_x // factor, factor, n_y // factor, factor)
+        .mean(axis=(1, 3))
+    )
+
+
+def _subpixel_peak(left, centre, right):
+    denominator = left - 2 * centre + right
+    if denominator == 0:
+        return 0.0
+    return 0.5 * (left - right) / denominator
+
+
+def phase_correlation(reference_fft, image, shape):
+    """ Rigid shift of the image with respect to the reference, from the peak
+    of the phase correlation refined with a parabola along each axis
+
+    :param reference_fft: rfft2 of the reference
+    :param image: image of the given shape
+    :return: shift along the two axes of the image in pixels
+    """
+    cross_power = np.fft.rfft2(image) * np.conj(reference_fft)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=shape)
+    peak = np.unravel_index(np.argmax(correlation), shape)
+    shift = []
+    for axis, (i_peak, n) in enumerate(zip(peak, shape)):
+        neighbours = [list(peak), list(peak)]
+        neighbours[0][axis] = (i_peak - 1) % n
+        neighbours[1][axis] = (i_peak + 1) % n
+        offset = _subpixel_peak(
+            correlation[tuple(neighbours[0])],
+            correlation[peak],
+            correlation[tuple(neighbours[1])],
+        )
+        position = i_peak + offset
+        shift.append(position - n if position > n / 2 else position)
+    return np.array(shift)
+
+
+class DriftEstimator:
+    """ Estimates the rigid shift of frames against a reference, the mean
+    of the first n_reference frames, on downsampled images
+
+    """
+
+    def __init__(self, parameters: RegistrationParameters):
+        self.parameters = parameters
+        self.reference_frames = []
+        self.reference_fft = None
+        self.shape = None
+
+    def reset(self):
+        self.reference_frames = []
+        self.reference_fft = None
+
+    def update(self, images):
+        """ Returns the shift in pixels of the full frame, or None while
+        the reference is being built
+
+        """
+        image = downsample(
+            images[self.parameters.channel], self.parameters.downsampling
+        )
+        if self.shape is not None and image.shape != self.shape:
+            self.reset()
+        self.shape = image.shape
+        if self.reference_fft is None:
+            self.reference_frames.append(image)
+            if len(self.reference_frames) == self.parameters.n_reference:
+                self.reference_fft = np.fft.rfft2(np.mean(self.reference_frames, 0))
+                self.reference_frames = []
+            return None
+        return (
+            phase_correlation(self.reference_fft, image, self.shape)
+            * self.parameters.downsampling
+        )
+
+
+class Registration(Process):
+    """ Runs the drift estimation on the frames sent by the reconstructor
+    every every_n frames, 0 switches it off
+
+    """
+
+    def __init__(self, stop_event, max_mbytes_queue=100, placement=None):
+        super().__init__()
+        self.stop_event = stop_event
+        self.placement = placement
+        self.frame_queue = FrameQueue(
+            "registration",
+            max_mbytes=max_mbytes_queue,
+            policy=BackpressurePolicy.DROP_NEWEST,
+            stop_event=stop_event,
+        )
+        self.every_n = RawValue("i", 0)
+        self.parameter_queue = Queue()
+        self.reset_event = Event()
+        self.shift_queue = Queue()
+        self.estimator = DriftEstimator(RegistrationParameters())
+
+    def run(self):
+        apply_placement("registration", self.placement)
+        while not self.stop_event.is_set():
+            try:
+                self.estimator = DriftEstimator(
+                    self.parameter_queue.get(timeout=0.0001)
+                )
+            except Empty:
+                pass
+            if self.reset_event.is_set():
+                self.estimator.reset()
+                self.reset_event.clear()
+            try:
+                header, images = self.frame_queue.get(timeout=0.001)
+            except Empty:
+                continue
+            shift = self.estimator.update(images)
+            if shift is not None:
+                self.shift_queue.put((header, shift))
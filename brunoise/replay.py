@@ -0,0 +1,224 @@
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Empty
+from time import perf_counter, sleep
+import json
+import flammkuchen as fl
+import numpy as np
+
+from scanning import ImageReconstructor, ScanningState
+from frame_queues import FrameHeader
+from process_placement import apply_placement
+from streaming_save import SAVED_SCALE, load_times
+
+
+@dataclass
+class ReplayParameters:
+    path: str
+    # at the original frame times, otherwise as fast as possible
+    realtime: bool = True
+    # frames read from the disk at once
+    block_size: int = 32
+
+
+class SavedRecording:
+    """ A recording saved by the StackSaver, original/NNNN.h5 or the
+    green and red folders for both channels, read block by block
+
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        original = self.path / "original"
+        if (original / "stack_metadata.json").is_file():
+            # a single channel, which is not recorded, is replayed as the first one
+            self.channel_dirs = [original]
+        elif (original / "green" / "stack_metadata.json").is_file():
+            self.channel_dirs = [original / "green", original / "red"]
+        else:
+            raise FileNotFoundError("No saved stack in {}".format(original))
+        with open(self.channel_dirs[0] / "stack_metadata.json") as f:
+            metadata = json.load(f)
+        self.n_t, self.n_z = metadata["shape_full"][:2]
+        self.plane_size = tuple(metadata["shape_full"][2:])
+        self.times = None
+
+    def load_times(self):
+        # time.h5 has one column of times from the start of each plane, the
+        # ones of the sample clock are replayed when all frames have them
+        times, sample_times = load_times(self.path / "time.h5")
+        if sample_times is not None and np.all(np.isfinite(sample_times)):
+            times = sample_times
+        self.times = times.reshape(times.shape[0], -1)
+        return self.times
+
+    def read_block(self, i_plane, i_start, i_end):
+        """ Frames i_start to i_end of the plane as saved, with both channels
+        """
+        block = np.zeros((i_end - i_start, 2, *self.plane_size), dtype=np.int16)
+        for i_channel, channel_dir in enumerate(self.channel_dirs):
+            block[:, i_channel : i_channel + 1] = fl.load(
+                channel_dir / "{:04d}.h5".format(i_plane),
+                "/stack_4D",
+                sel=fl.aslice[i_start:i_end],
+            )
+        return block
+
+    def frames(self, i_plane, block_size=32):
+        """ Yields the time from the start of the plane and the images
+        of the frames of the plane
+        """
+        if self.times is None:
+            self.load_times()
+        for i_start in range(0, self.n_t, block_size):
+            i_end = min(i_start + block_size, self.n_t)
+            block = self.read_block(i_plane, i_start, i_end)
+            for i_frame in range(i_end - i_start):
+                yield (
+                    self.times[i_start + i_frame, i_plane],
+                    block[i_frame].astype(np.float64) * SAVED_SCALE,
+                )
+
+
+class ReplaySource(ImageReconstructor):
+    """ Stands in for the scanner and the reconstructor, sending the frames
+    of a saved recording to the main process, the display and everything
+    downstream of the reconstruction. It follows the scanning state like the
+    scanner: in preview the recording is replayed over and over, in a running
+    experiment each plane started replays the next plane of the recording,
+    whose number of frames is sent to the saver
+
+    """
+
+    def __init__(
+        self,
+        replay: ReplayParameters,
+        experiment_start_event,
+        duration_queue,
+        n_frames_queue,
+        stop_event,
+        **kwargs
+    ):
+        super().__init__(None, stop_event, **kwargs)
+        self.replay = replay
+        self.experiment_start_event = experiment_start_event
+        self.duration_queue = duration_queue
+        self.n_frames_queue = n_frames_queue
+        self.recording = None
+        self.i_frame = 0
+
+    def update_waveform(self):
+        # the frames are already reconstructed
+        pass
+
+    def receive_parameters(self):
+        # there are no scanned frames to wait for
+        super().receive_parameters()
+        self.apply_parameters()
+
+    @property
+    def scanning_state(self):
+        if self.scanning_parameters is None:
+            return ScanningState.PAUSED
+        return self.scanning_parameters.scanning_state
+
+    def wait(self, t_target, scanning_state):
+        """ Waits until the time, returns False if the scanning state
+        changed in the meantime
+        """
+        while perf_counter() < t_target:
+            self.receive_parameters()
+            if self.stop_event.is_set() or self.scanning_state != scanning_state:
+                return False
+            sleep(min(0.001, max(t_target - perf_counter(), 0)))
+        return True
+
+    def replay_plane(self, i_plane):
+        """ Replays the plane, stops early if the scanning state changes
+        """
+        scanning_state = self.scanning_state
+        t_start = perf_counter()
+        for t, images in self.recording.frames(i_plane, self.replay.block_size):
+            if self.replay.realtime and not self.wait(t_start + t, scanning_state):
+                return
+            self.receive_parameters()
+            if self.stop_event.is_set() or self.scanning_state != scanning_state:
+                return
+            self.output_frame(FrameHeader(seq=self.i_frame, t=perf_counter()), images)
+            self.i_frame += 1
+
+    def run_experiment_plane(self, i_plane):
+        while not self.experiment_start_event.is_set():
+            self.receive_parameters()
+            if (
+                self.stop_event.is_set()
+                or self.scanning_state != ScanningState.EXPERIMENT_RUNNING
+            ):
+                return False
+            sleep(0.0001)
+        # the length of the plane is the one of the recording, not the duration
+        try:
+            while True:
+                self.duration_queue.get_nowait()
+        except Empty:
+            pass
+        self.n_frames_queue.put(self.recording.n_t)
+        self.replay_plane(i_plane)
+        # the next plane starts once the main process has ended this one
+        while self.experiment_start_event.is_set() and not self.stop_event.is_set():
+            self.receive_parameters()
+            if self.scanning_state != ScanningState.EXPERIMENT_RUNNING:
+                break
+            sleep(0.0001)
+        return True
+
+    def run(self):
+        apply_placement("reconstructor", self.placement)
+        self.open_publisher()
+        self.recording = SavedRecording(self.replay.path)
+        i_preview = 0
+        i_experiment = 0
+        while not self.stop_event.is_set():
+            self.receive_parameters()
+            if self.scanning_state == ScanningState.PREVIEW:
+                i_experiment = 0
+                self.replay_plane(i_preview % self.recording.n_z)
+                i_preview += 1
+            elif self.scanning_state == ScanningState.EXPERIMENT_RUNNING:
+                if self.run_experiment_plane(i_experiment % self.recording.n_z):
+                    i_experiment += 1
+            else:
+                sleep(0.001)
+        self.close_publisher()
+
+
+class ReplayMotor:
+    """ Stands for a MotorProxy in replays, the stage stays where it is
+    """
+
+    def __init__(self, axis):
+        self.axis = axis
+        self.position = 0.0
+        self.home_pos = 0.0
+        self.connection = True
+
+    def get_position(self):
+        return self.position
+
+    def send_command(self, command):
+        return None
+
+    def move_abs(self, coordinate):
+        self.position = coordinate
+
+    def move_rel(self, displacement=0.0):
+        self.position += displacement
+
+    def define_home(self):
+        self.home_pos = self.position
+
+    def go_home(self):
+        self.position = self.home_pos
+
+    def end_session(self):
+        self.connection = False
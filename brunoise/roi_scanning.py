@@ -0,0 +1,37 @@
+from functools import lru_cache
+import scanning_patterns
+
+
+def roi_geometry(n_x, n_y, roi_rect):
+    """ Clips the ROI rectangle (x0, y0, width, height), in pixels of the full
+    frame, to the frame and rounds it to whole pixels. Returns None if
+    nothing of the ROI is left
+
+    """
+    x0, y0, width, height = roi_rect
+    x_start = min(max(int(round(x0)), 0), n_x)
+    y_start = min(max(int(round(y0)), 0), n_y)
+    x_end = min(max(int(round(x0 + width)), 0), n_x)
+    y_end = min(max(int(round(y0 + height)), 0), n_y)
+    if x_end - x_start < 2 or y_end - y_start < 2:
+        return None
+    return x_start, y_start, x_end - x_start, y_end - y_start
+
+
+@lru_cache(maxsize=16)
+def roi_scanning_pattern(
+    pattern, x0, y0, n_x_roi, n_y_roi, n_turn, n_extra_points, pause
+):
+    """ The scanning pattern over the ROI with the same pixel size as the full
+    frame, with turns outside the ROI
+
+    Returns the pattern in pixels of the full frame, for the scanning waveform,
+    the pixels of the ROI the samples are reconstructed into, and the
+    positions in the ROI with the scanned path, for the sparse reconstruction.
+    The arrays are cached per ROI geometry and must not be modified
+
+    """
+    roi_x, roi_y, pixel_x, pixel_y, imaged = scanning_patterns.scan_pattern(
+        pattern, n_x_roi, n_y_roi, n_turn, n_extra_points, pause
+    )
+    return (roi_x + x0, roi_y + y0), (pixel_x, pixel_y), (roi_x, roi_y, imaged)
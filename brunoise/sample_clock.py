@@ -0,0 +1,94 @@
+from collections import deque
+import numpy as np
+
+
+def frame_sample_time(header):
+    """ Time of the frame on the sample clock, NaN for the frames which
+    were not timed by the DAQ, e.g. replayed ones
+    """
+    return header.t_sample if header.t_sample is not None else np.nan
+
+
+class SampleClock:
+    """ Times of the samples read by the DAQ, in seconds of perf_counter.
+    The samples are acquired at the configured rate from the start of the
+    tasks, so the time of a sample follows from its index, without the
+    jitter of the moment the read returns to the process. The reference is
+    the time at which the tasks start, and the drift of the DAQ clock with
+    respect to the host is estimated from the reads: in each window of
+    refresh_interval the least delayed read is kept, the rate of the clock
+    is the slope of these through the last n_windows windows, and the times
+    are pulled towards the line through them less the delay of the first
+    window, when the drift had no time to build up, by a fraction of the
+    difference at each refresh so that they do not jump
+
+    """
+
+    def __init__(self, sample_rate, refresh_interval=5.0, n_windows=12):
+        self.sample_rate = sample_rate
+        self.refresh_interval = refresh_interval
+        self.n_windows = n_windows
+        # drifts beyond this are taken for errors of the estimation
+        self.max_drift = 1e-3
+        # fraction of the offset from the reads corrected at each refresh
+        self.offset_gain = 0.2
+        self.t_anchor = None
+        self.i_anchor = 0
+        self.period = 1 / sample_rate
+        self.minima = deque(maxlen=n_windows)
+        self.window_start = None
+        self.window_min = None
+        # least delay of the reads from the start
+        self.read_delay = None
+
+    def start(self, t_start):
+        """ Sets the time of the first sample, taken when the tasks start
+        """
+        self.t_anchor = t_start
+        self.i_anchor = 0
+        self.period = 1 / self.sample_rate
+        self.minima.clear()
+        self.window_start = t_start
+        self.window_min = None
+        self.read_delay = None
+
+    @property
+    def started(self):
+        return self.t_anchor is not None
+
+    @property
+    def drift_ppm(self):
+        return (self.period * self.sample_rate - 1) * 1e6
+
+    def time(self, i_sample):
+        return self.t_anchor + (i_sample - self.i_anchor) * self.period
+
+    def observe(self, i_sample, t_read):
+        """ Records that the samples up to i_sample had been read at t_read
+        """
+        delay = t_read - self.time(i_sample)
+        if self.window_min is None or delay < self.window_min[0]:
+            self.window_min = (delay, i_sample, t_read)
+        if t_read - self.window_start < self.refresh_interval:
+            return
+        if self.read_delay is None:
+            self.read_delay = self.window_min[0]
+        self.minima.append(self.window_min[1:])
+        self.window_start = t_read
+        self.window_min = None
+        if len(self.minima) >= 3:
+            self.refresh(i_sample)
+
+    def refresh(self, i_sample):
+        """ Updates the clock from i_sample on, the times of the samples
+        before stay as they were given
+        """
+        i_samples, t_reads = np.array(self.minima).T
+        period, t_first = np.polyfit(i_samples - i_samples[0], t_reads, 1)
+        if abs(period * self.sample_rate - 1) > self.max_drift:
+            return
+        t_current = self.time(i_sample)
+        t_reads_line = t_first + (i_sample - i_samples[0]) * period - self.read_delay
+        self.t_anchor = t_current + self.offset_gain * (t_reads_line - t_current)
+        self.i_anchor = i_sample
+        self.period = period
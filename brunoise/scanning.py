@@ -13,14 +13,25 @@ except ImportError:
     from theknights.constants import Edge, AcquisitionType, LineGrouping
 
 
-from arrayqueues.shared_arrays import ArrayQueue
 from queue import Empty
 
 import scanning_patterns
+import roi_scanning
+import sparse_reconstruction
+from sequence_diagram import NoTrace, TraceEvent
+from process_placement import apply_placement
+from frame_queues import FrameQueue, FrameHeader, BackpressurePolicy
+from display import DisplayRenderer
+from traces import TraceExtractor, ellipse_labels
+from frame_publisher import FramePublisher
+from sample_clock import SampleClock
+from collections import namedtuple
 from copy import copy
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
-from time import sleep, perf_counter
+from typing import Optional
+from time import sleep, perf_counter, perf_counter_ns
 from math import ceil
 
 
@@ -46,44 +57,187 @@ class ScanningParameters:
     n_frames: int = 100
     framerate: int = 2
     pause: bool = True
+    # one of scanning_patterns.PATTERNS
+    pattern: str = "bidirectional"
+    # "pixels": each pixel takes the bins of one sample, with
+    # reconstruct_image_pattern, "sparse": the bins are splatted bilinearly
+    # along the trajectory with the sparse_reconstruction matrix, which fills
+    # the pixels the non-raster patterns pass through, see
+    # sparse_reconstruction.benchmark for the times of both
+    reconstruction: str = "pixels"
+
+
+# the parameters sent to the scanner and the reconstructor are numbered, so
+# that each frame is reconstructed with the ones it was scanned with
+ParameterUpdate = namedtuple("ParameterUpdate", "generation parameters")
 
 
 @dataclass
 class RoiParameters:
     roi_scanning: bool = False
-    roi_write_signals: object = np.empty(0)
+    # x0, y0, width, height in pixels of the full frame
+    roi_rect: Optional[tuple] = None
+
+
+def full_frame_pattern(sp: ScanningParameters):
+    return scanning_patterns.scan_pattern(
+        sp.pattern, sp.n_x, sp.n_y, sp.n_turn, sp.n_extra, sp.pause
+    )
+
+
+def frame_samples(sp: ScanningParameters):
+    """ Number of output samples of a full frame
+    """
+    return len(full_frame_pattern(sp)[0])
 
 
 def frame_duration(sp: ScanningParameters):
-    return (
-        scanning_patterns.n_total(sp.n_x, sp.n_y, sp.n_turn, sp.n_extra, sp.pause)
-        / sp.sample_rate_out
+    return frame_samples(sp) / sp.sample_rate_out
+
+
+def active_roi(sp: ScanningParameters, rp: Optional[RoiParameters]):
+    if rp is None or not rp.roi_scanning or rp.roi_rect is None:
+        return None
+    return roi_scanning.roi_geometry(sp.n_x, sp.n_y, rp.roi_rect)
+
+
+def roi_patterns(sp: ScanningParameters, roi):
+    return roi_scanning.roi_scanning_pattern(
+        sp.pattern, *roi, sp.n_turn, sp.n_extra, sp.pause
+    )
+
+
+def compute_waveform(sp: ScanningParameters, rp: Optional[RoiParameters] = None):
+    """ Scanning pattern in pixels of the full frame
+    """
+    roi = active_roi(sp, rp)
+    if roi is not None:
+        return roi_patterns(sp, roi)[0]
+    return full_frame_pattern(sp)[:2]
+
+
+def reconstruction_waveform(sp: ScanningParameters, rp: Optional[RoiParameters] = None):
+    """ Scanning pattern in pixels of the reconstructed image
+    """
+    roi = active_roi(sp, rp)
+    if roi is not None:
+        return roi_patterns(sp, roi)[1]
+    return full_frame_pattern(sp)[2:4]
+
+
+def scanned_path(sp: ScanningParameters, rp: Optional[RoiParameters] = None):
+    """ Positions of the samples in pixels of the reconstructed image, and
+    whether they are on the scanned path
+    """
+    roi = active_roi(sp, rp)
+    if roi is not None:
+        return roi_patterns(sp, roi)[2]
+    x, y, _, _, imaged = full_frame_pattern(sp)
+    return x, y, imaged
+
+
+@lru_cache(maxsize=4)
+def _reconstruction_matrix(sp_key, roi, bin_skip, bin_samples):
+    pattern, n_x, n_y, n_turn, n_extra, pause, n_bin, offset = sp_key
+    sp = ScanningParameters(
+        n_x=n_x,
+        n_y=n_y,
+        n_turn=n_turn,
+        n_extra=n_extra,
+        pause=pause,
+        n_bin=n_bin,
+        pattern=pattern,
+    )
+    rp = RoiParameters(roi_scanning=True, roi_rect=roi) if roi is not None else None
+    return sparse_reconstruction.sampling_matrix(
+        *scanned_path(sp, rp),
+        image_shape(sp, rp),
+        n_bin,
+        offset,
+        bin_skip,
+        bin_samples,
     )
 
 
-def compute_waveform(sp: ScanningParameters):
-    return scanning_patterns.simple_scanning_pattern(
-        sp.n_x, sp.n_y, sp.n_turn, sp.n_extra, sp.pause
+def reconstruction_matrix(
+    sp: ScanningParameters,
+    rp: Optional[RoiParameters] = None,
+    bin_skip=0,
+    bin_samples=None,
+):
+    """ The SamplingMatrix reconstructing the channels, cached per geometry
+    """
+    return _reconstruction_matrix(
+        (
+            sp.pattern,
+            sp.n_x,
+            sp.n_y,
+            sp.n_turn,
+            sp.n_extra,
+            sp.pause,
+            sp.n_bin,
+            sp.mystery_offset,
+        ),
+        active_roi(sp, rp),
+        bin_skip,
+        bin_samples,
     )
 
 
+def image_shape(sp: ScanningParameters, rp: Optional[RoiParameters] = None):
+    roi = active_roi(sp, rp)
+    if roi is not None:
+        return roi[2], roi[3]
+    return sp.n_x, sp.n_y
+
+
+def image_origin(sp: ScanningParameters, rp: Optional[RoiParameters], shape):
+    """ Position in the full frame of an image of the given shape,
+    which is not at the origin only if it is the scanned ROI
+
+    """
+    roi = active_roi(sp, rp)
+    if roi is not None and tuple(shape[:2]) == (roi[2], roi[3]):
+        return roi[0], roi[1]
+    return 0, 0
+
+
 class Scanner(Process):
-    def __init__(self, experiment_start_event, duration_queue, max_queuesize=200):
+    def __init__(
+        self,
+        experiment_start_event,
+        duration_queue,
+        max_queuesize=200,
+        trace=None,
+        placement=None,
+    ):
         super().__init__()
-        self.data_queue = ArrayQueue(max_mbytes=max_queuesize)
-        self.time_queue = Queue()
+        self.trace = trace if trace is not None else NoTrace()
+        self.placement = placement
+        self.stop_event = Event()
+        self.sample_clock = None
+        self.data_queue = FrameQueue(
+            "scanner",
+            max_mbytes=max_queuesize,
+            policy=BackpressurePolicy.DROP_OLDEST,
+            stop_event=self.stop_event,
+        )
         self.parameter_queue = Queue()
         self.roi_queue = Queue()
-        self.stop_event = Event()
+        self.i_frame = 0
         self.experiment_start_event = experiment_start_event
         self.scanning_parameters = ScanningParameters()
         self.new_parameters = copy(self.scanning_parameters)
         self.roi_parameters = RoiParameters()
         self.new_roi_parameters = copy(self.roi_parameters)
+        # numbers of the parameter updates in use and of the last received
+        self.generation = (0, 0)
+        self.new_generation = (0, 0)
         self.duration_queue = duration_queue
         self.n_frames_queue = Queue()
 
     def run(self):
+        apply_placement("scanner", self.placement)
         self.compute_scan_parameters()
         self.run_scanning()
 
@@ -99,7 +253,9 @@ class Scanner(Process):
 
         self.n_x = self.scanning_parameters.n_x
         self.n_y = self.scanning_parameters.n_y
-        self.raw_x, self.raw_y = compute_waveform(self.scanning_parameters)
+        self.raw_x, self.raw_y = compute_waveform(
+            self.scanning_parameters, self.roi_parameters
+        )
         self.pos_x = (
             self.raw_x * ((self.extent_x[1] - self.extent_x[0]) / self.n_x)
             + self.extent_x[0]
@@ -123,8 +279,38 @@ class Scanner(Process):
         self.read_buffer = np.zeros((4, self.n_samples_in))
         self.mystery_offset = self.scanning_parameters.mystery_offset
 
-        self.roi_scanning = self.roi_parameters.roi_scanning
-        self.roi_write_signals = np.ascontiguousarray(self.roi_parameters.roi_write_signals)
+    def keeps_timing(self):
+        """ Checks whether the new parameters can be applied by swapping the
+        output waveform, without setting up the DAQ tasks again. This is the
+        case when the scanning state, the sample rates and the number
+        of samples in a frame stay the same
+
+        """
+        sp = self.scanning_parameters
+        new_sp = self.new_parameters
+        if (
+            new_sp.scanning_state != sp.scanning_state
+            or new_sp.sample_rate_out != sp.sample_rate_out
+            or new_sp.n_bin != sp.n_bin
+        ):
+            return False
+        new_x, _ = compute_waveform(new_sp, self.new_roi_parameters)
+        return len(new_x) == self.n_samples_out
+
+    def swap_waveform(self, shutter_task):
+        """ Applies the new parameters to the running tasks, the new
+        waveform is written at the start of the next frame
+
+        """
+        if self.new_parameters.shutter != self.scanning_parameters.shutter:
+            self.set_shutter(shutter_task, self.new_parameters.shutter)
+        self.apply_new_parameters()
+
+    def apply_new_parameters(self):
+        self.scanning_parameters = self.new_parameters
+        self.roi_parameters = self.new_roi_parameters
+        self.generation = self.new_generation
+        self.compute_scan_parameters()
 
     def setup_tasks(self, read_task, write_task, shutter_task):
         # Configure the channels
@@ -167,18 +353,61 @@ class Scanner(Process):
         try:
             duration = self.duration_queue.get(timeout=0.0001)
             self.scanning_parameters.n_frames = (
-                int(ceil(duration / frame_duration(self.scanning_parameters))) + 1
+                int(ceil(duration / self.plane_duration)) + 1
             )
             self.n_frames_queue.put(self.scanning_parameters.n_frames)
         except Empty:
             pass
 
-    def scan_loop(self, read_task, write_task):
+    def receive_update(self, update: ParameterUpdate):
+        self.new_parameters = update.parameters
+        self.new_generation = (update.generation, self.new_generation[1])
+
+    def receive_roi_update(self, update: ParameterUpdate):
+        self.new_roi_parameters = update.parameters
+        self.new_generation = (self.new_generation[0], update.generation)
+
+    def parameters_changed(self):
+        """ Whether the new parameters or ROI have to be applied now. While
+        a plane is recorded they are kept for the next one, so that its
+        frames are all scanned the same way, unless the recording stops
+        """
+        differ = (
+            self.new_parameters != self.scanning_parameters
+            or self.new_roi_parameters != self.roi_parameters
+        )
+        if not differ:
+            # the same parameters under new numbers
+            self.generation = self.new_generation
+        return differ and (
+            self.scanning_parameters.scanning_state != ScanningState.EXPERIMENT_RUNNING
+            or self.new_parameters.scanning_state == ScanningState.PREVIEW
+        )
+
+    def receive_parameters(self):
+        """ Gets the most recent parameters sent, returns whether
+        they have to be applied
+
+        """
+        try:
+            while True:
+                self.receive_update(self.parameter_queue.get(timeout=0.0001))
+        except Empty:
+            pass
+        try:
+            while True:
+                self.receive_roi_update(self.roi_queue.get(timeout=0.0001))
+        except Empty:
+            pass
+        return self.parameters_changed()
+
+    def scan_loop(self, read_task, write_task, shutter_task):
         writer = AnalogMultiChannelWriter(write_task.out_stream)
         reader = AnalogMultiChannelReader(read_task.in_stream)
 
         first_write = True
         i_acquired = 0
+        self.sample_clock = SampleClock(self.sample_rate_in)
         while not self.stop_event.is_set() and (
             not self.scanning_parameters.scanning_state
             == ScanningState.EXPERIMENT_RUNNING
@@ -186,45 +415,52 @@ class Scanner(Process):
         ):
             # The first write has to be defined before the task starts
             try:
-                if self.roi_scanning and len(self.roi_write_signals) == 2:
-                    writer.write_many_sample(self.roi_write_signals)
-                else:
-                    writer.write_many_sample(self.write_signals)
+                writer.write_many_sample(self.write_signals)
                 if i_acquired == 0:
                     self.check_start_plane()
                 if first_write:
                     read_task.start()
+                    t_before_start = perf_counter()
                     write_task.start()
+                    # the reading starts with the output, on its start trigger
+                    self.sample_clock.start((t_before_start + perf_counter()) / 2)
                     first_write = False
+                t_start = perf_counter_ns()
                 reader.read_many_sample(
                     self.read_buffer,
                     number_of_samples_per_channel=self.n_samples_in,
                     timeout=1,
                 )
-                self.time_queue.put(perf_counter())
+                t_read = perf_counter()
+                self.trace.span(TraceEvent.DAQ_READ_WAIT, t_start)
+                # the tasks run continuously, so the samples read so far follow
+                # from the number of frames
+                i_sample = i_acquired * self.n_samples_in
+                self.sample_clock.observe(i_sample + self.n_samples_in, t_read)
+                header = FrameHeader(
+                    seq=self.i_frame,
+                    t=t_read,
+                    t_sample=self.sample_clock.time(i_sample),
+                    generation=self.generation,
+                )
                 i_acquired += 1
+                self.i_frame += 1
             except nidaqmx.DaqError as e:
                 print(e)
                 break
-            self.data_queue.put(np.stack([self.read_buffer[0, :], self.read_buffer[-1, :]]))
-            # if new parameters have been received and changed, update
-            # them, breaking out of the loop if the experiment is not running
-            try:
-                self.new_parameters = self.parameter_queue.get(timeout=0.0001)
-                if self.new_parameters != self.scanning_parameters and (
-                    self.scanning_parameters.scanning_state
-                    != ScanningState.EXPERIMENT_RUNNING
-                    or self.new_parameters.scanning_state == ScanningState.PREVIEW
-                ):
-                    break
-            except Empty:
-                pass
-            try:
-                self.new_roi_parameters = self.roi_queue.get(timeout=0.0001)
-                if self.new_roi_parameters.roi_scanning != self.roi_parameters.roi_scanning:
+            t_start = perf_counter_ns()
+            self.data_queue.put(
+                np.stack([self.read_buffer[0, :], self.read_buffer[-1, :]]), header
+            )
+            self.trace.span(TraceEvent.QUEUE_PUT, t_start)
+            # if new parameters have been received and changed, swap the
+            # waveform at the frame boundary if the timing stays the same,
+            # otherwise break out of the loop to set up the tasks again
+            if self.receive_parameters():
+                if self.keeps_timing():
+                    self.swap_waveform(shutter_task)
+                else:
                     break
-            except Empty:
-                pass
 
             # calculate duration
             self.calculate_duration()
@@ -232,24 +468,23 @@ class Scanner(Process):
     def pause_loop(self):
         while not self.stop_event.is_set():
             try:
-                self.new_parameters = self.parameter_queue.get(timeout=0.001)
-                if self.new_parameters != self.scanning_parameters and (
-                    self.scanning_parameters.scanning_state
-                    != ScanningState.EXPERIMENT_RUNNING
-                    or self.new_parameters.scanning_state == ScanningState.PREVIEW
-                ):
-                    break
+                self.receive_update(self.parameter_queue.get(timeout=0.001))
+            except Empty:
+                pass
+            try:
+                while True:
+                    self.receive_roi_update(self.roi_queue.get_nowait())
             except Empty:
                 pass
+            if self.parameters_changed():
+                break
 
     def set_shutter(self, shutter_task, shutter_state):
         shutter_task.write(shutter_state, auto_start=True)
 
     def run_scanning(self):
         while not self.stop_event.is_set():
-            self.scanning_parameters = self.new_parameters
-            self.roi_parameters = self.new_roi_parameters
-            self.compute_scan_parameters()
+            self.apply_new_parameters()
             with Task() as write_task, Task() as read_task, Task() as shutter_task:
                 self.setup_tasks(read_task, write_task, shutter_task)
                 self.set_shutter(shutter_task, self.scanning_parameters.shutter)
@@ -257,40 +492,235 @@ class Scanner(Process):
                     self.set_shutter(shutter_task, False)
                     self.pause_loop()
                 else:
-                    self.scan_loop(read_task, write_task)
+                    self.scan_loop(read_task, write_task, shutter_task)
 
 
 class ImageReconstructor(Process):
-    def __init__(self, data_in_queue, stop_event, max_mbytes_queue=300):
+    def __init__(
+        self,
+        data_in_queue,
+        stop_event,
+        max_mbytes_queue=300,
+        max_mbytes_display=50,
+        trace=None,
+        placement=None,
+        registration_queue=None,
+        registration_every=None,
+        publisher_parameters=None,
+        raw_queue=None,
+        raw_capture_event=None,
+        raw_generation_queue=None,
+    ):
         super().__init__()
+        self.trace = trace if trace is not None else NoTrace()
+        self.placement = placement
         self.data_in_queue = data_in_queue
         self.parameter_queue = Queue()
+        self.roi_queue = Queue()
         self.stop_event = stop_event
-        self.output_queue = ArrayQueue(max_mbytes_queue)
+        self.output_queue = FrameQueue(
+            "reconstructor",
+            max_mbytes=max_mbytes_queue,
+            policy=BackpressurePolicy.DROP_OLDEST,
+            stop_event=self.stop_event,
+        )
+        self.display_queue = FrameQueue(
+            "display",
+            max_mbytes=max_mbytes_display,
+            policy=BackpressurePolicy.DROP_OLDEST,
+            stop_event=self.stop_event,
+        )
+        self.display_parameter_queue = Queue()
+        self.display_renderer = DisplayRenderer()
+        # the elliptical ROIs of the traces come in pixels of the full frame,
+        # their labels in the coordinates of the images go out for saving
+        self.trace_roi_queue = Queue()
+        self.trace_label_queue = Queue()
+        self.trace_queue = Queue()
+        self.trace_ellipses = None
+        self.trace_extractor = None
+        self.trace_origin = None
+        # frames are sent for registration every registration_every.value frames
+        self.registration_queue = registration_queue
+        self.registration_every = registration_every
+        # the frames are published for external consumers if set
+        self.publisher_parameters = publisher_parameters
+        self.publisher = None
+        # the samples are copied for the raw saver while the event is set
+        self.raw_queue = raw_queue
+        self.raw_capture_event = raw_capture_event
+        # with the parameters of each generation of the captured frames
+        self.raw_generation_queue = raw_generation_queue
+        self.raw_generation = None
         self.scanning_parameters = None
+        self.roi_parameters = None
+        # the ParameterUpdates received which the frames do not use yet
+        self.pending_parameters = []
+        self.pending_roi_parameters = []
         self.waveform = None
+        self.image_shape = None
+        self.matrix = None
+
+    def update_waveform(self):
+        if self.scanning_parameters is None:
+            return
+        self.waveform = reconstruction_waveform(
+            self.scanning_parameters, self.roi_parameters
+        )
+        self.image_shape = image_shape(self.scanning_parameters, self.roi_parameters)
+        if self.scanning_parameters.reconstruction == "sparse":
+            self.matrix = reconstruction_matrix(
+                self.scanning_parameters, self.roi_parameters
+            )
+        else:
+            self.matrix = None
+
+    def reconstruct(self, images):
+        if self.matrix is not None:
+            return sparse_reconstruction.reconstruct_sparse(
+                self.matrix, images, self.image_shape
+            )
+        return np.stack(
+            [
+                scanning_patterns.reconstruct_image_pattern(
+                    np.roll(image, self.scanning_parameters.mystery_offset),
+                    *self.waveform,
+                    self.image_shape,
+                    self.scanning_parameters.n_bin,
+                )
+                for image in images
+            ]
+        )
+
+    def apply_parameters(self, generation=None):
+        """ Applies the parameter updates up to the generation the frame
+        was scanned with, all the ones received if it is not known
+        """
+        changed = False
+        while self.pending_parameters and (
+            generation is None or self.pending_parameters[0].generation <= generation[0]
+        ):
+            self.scanning_parameters = self.pending_parameters.pop(0).parameters
+            changed = True
+        while self.pending_roi_parameters and (
+            generation is None
+            or self.pending_roi_parameters[0].generation <= generation[1]
+        ):
+            self.roi_parameters = self.pending_roi_parameters.pop(0).parameters
+            changed = True
+        if changed:
+            self.update_waveform()
+
+    def send_raw_generation(self, generation):
+        """ Sends the parameters of the frames to the raw saver when they
+        change, so that each captured frame is recorded with its own
+        """
+        if generation != self.raw_generation:
+            self.raw_generation_queue.put(
+                (generation, self.scanning_parameters, self.roi_parameters)
+            )
+            self.raw_generation = generation
+
+    def receive_parameters(self):
+        try:
+            self.pending_parameters.append(self.parameter_queue.get(timeout=0.001))
+        except Empty:
+            pass
+        try:
+            self.pending_roi_parameters.append(self.roi_queue.get(timeout=0.0001))
+        except Empty:
+            pass
+        try:
+            self.display_renderer.set_parameters(
+                self.display_parameter_queue.get(timeout=0.0001)
+            )
+        except Empty:
+            pass
+        try:
+            self.trace_ellipses = self.trace_roi_queue.get(timeout=0.0001)
+            self.trace_extractor = None
+        except Empty:
+            pass
+
+    def extract_traces(self, header, recon_images):
+        """ Sends the means of the trace ROIs, whose labels are drawn
+        again whenever the images change shape or place in the full frame,
+        as they do with ROI scanning
+        """
+        if self.trace_ellipses is None:
+            return
+        shape = recon_images.shape[1:]
+        origin = image_origin(self.scanning_parameters, self.roi_parameters, shape)
+        if (
+            self.trace_extractor is None
+            or self.trace_extractor.shape != shape
+            or self.trace_origin != origin
+        ):
+            labels = ellipse_labels(
+                shape,
+                [
+                    (x0 - origin[0], y0 - origin[1], width, height)
+                    for x0, y0, width, height in self.trace_ellipses
+                ],
+            )
+            self.trace_extractor = TraceExtractor(labels)
+            self.trace_origin = origin
+            self.trace_label_queue.put(labels)
+        self.trace_queue.put((header, self.trace_extractor.extract(recon_images)))
+
+    def output_frame(self, header, recon_images):
+        """ Sends the reconstructed images to the main process, the display,
+        the trace extraction, the registration and the publisher
+        """
+        t_start = perf_counter_ns()
+        self.output_queue.put(recon_images, header)
+        display_frame = self.display_renderer.render(recon_images)
+        self.display_queue.put(
+            display_frame, header._replace(levels=self.display_renderer.levels),
+        )
+        self.trace.span(TraceEvent.QUEUE_PUT, t_start)
+        self.extract_traces(header, recon_images)
+        if (
+            self.registration_queue is not None
+            and self.registration_every.value > 0
+            and header.seq % self.registration_every.value == 0
+        ):
+            self.registration_queue.put(recon_images, header)
+        if self.publisher is not None:
+            self.publisher.publish(header, recon_images)
+
+    def open_publisher(self):
+        if self.publisher_parameters is not None:
+            self.publisher = FramePublisher(self.publisher_parameters)
+
+    def close_publisher(self):
+        if self.publisher is not None:
+            self.publisher.close()
 
     def run(self):
+        apply_placement("reconstructor", self.placement)
+        self.open_publisher()
         while not self.stop_event.is_set():
+            self.receive_parameters()
             try:
-                self.scanning_parameters = self.parameter_queue.get(timeout=0.001)
-                self.waveform = compute_waveform(self.scanning_parameters)
-            except Empty:
-                pass
-
-            try:
-                images = self.data_in_queue.get(timeout=0.001)
-                recon_images = []
-                for image in images:
-                    recon_images.append(
-                        scanning_patterns.reconstruct_image_pattern(
-                            np.roll(image, self.scanning_parameters.mystery_offset),
-                            *self.waveform,
-                            (self.scanning_parameters.n_x, self.scanning_parameters.n_y),
-                            self.scanning_parameters.n_bin,
-                        )
-                    )
-                self.output_queue.put(np.stack(recon_images)
-                )
+                t_start = perf_counter_ns()
+                header, images = self.data_in_queue.get(timeout=0.001)
+                self.trace.span(TraceEvent.QUEUE_GET, t_start)
+                self.apply_parameters(header.generation)
+                if (
+                    self.raw_capture_event is not None
+                    and self.raw_capture_event.is_set()
+                ):
+                    self.send_raw_generation(header.generation)
+                    self.raw_queue.put(images, header)
+                else:
+                    # a new capture starts with no parameters
+                    self.raw_generation = None
+                t_start = perf_counter_ns()
+                # the PMT signal is negative
+                recon_images = np.negative(self.reconstruct(images))
+                self.trace.span(TraceEvent.RECONSTRUCTION, t_start)
+                self.output_frame(header, recon_images)
             except Empty:
                 pass
+        self.close_publisher()
@@ -1,8 +1,9 @@
+from functools import lru_cache
 import numpy as np
 from numba import jit
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def make_arc(cx, cy, radius, n_segments=12, is_left=True):
     """
         Make an half-circle arc with the centre cx, cy with n_segments poic
@@ -13,13 +14,13 @@ def make_arc(cx, cy, radius, n_segments=12, is_left=True):
     return np.cos(angles) * radius + cx, np.sin(angles) * radius + cy
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def n_total(n_x, n_y, n_turn, n_extra_points, pause):
     pause_points = n_x if pause else 0
     return (n_x + 2 * n_turn) * n_y - 2 * n_turn + n_extra_points + pause_points
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def simple_scanning_pattern(n_x, n_y, n_turn, n_extra_points=20, pause_x=False):
     """
     n_x valid x resolution
@@ -48,16 +49,251 @@ def simple_scanning_pattern(n_x, n_y, n_turn, n_extra_points=20, pause_x=False):
     return np.array(points_x), np.array(points_y)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def reconstruct_image_pattern(signal, scan_y, scan_x, image_size, n_bin=10):
     """
     Reconstructs an image given an integrar scanning pattern
     """
     n_y, n_x = image_size
-    image = np.empty((n_y, n_x))
+    image = np.zeros((n_y, n_x))
     for i in range(0, len(scan_x)):
         cx = scan_x[i]
         cy = scan_y[i]
         if (0 <= cx < n_x) and (0 <= cy < n_y):
             image[cy, cx] = np.sum(signal[i * n_bin : (i + 1) * n_bin])
     return image
+
+
+# The scanning patterns selectable in the scanning settings. A generator takes
+# the frame geometry, (n_x, n_y, n_turn, n_extra_points, pause), and returns
+# the positions of the galvos at each output sample, in pixels, the pixel
+# (x, y) each sample is reconstructed into by reconstruct_image_pattern, -1 for
+# the samples which are not, and whether each sample is on the scanned path,
+# and not on a turn or the return to the start, for the sparse reconstruction.
+# The patterns other than the rasters leave some pixels unvisited
+PATTERNS = dict()
+
+
+def register_pattern(name):
+    def register(generator):
+        PATTERNS[name] = generator
+        return generator
+
+    return register
+
+
+@lru_cache(maxsize=16)
+def scan_pattern(name, n_x, n_y, n_turn, n_extra_points, pause):
+    """ Positions, pixels and scanned path of the samples of the pattern,
+    cached per geometry, the arrays must not be modified
+    """
+    if name not in PATTERNS:
+        raise ValueError(
+            "Unknown scanning pattern {}, available: {}".format(
+                name, ", ".join(PATTERNS.keys())
+            )
+        )
+    arrays = PATTERNS[name](n_x, n_y, n_turn, n_extra_points, pause)
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays
+
+
+def smooth_ramp(n_points):
+    """ Half cosine from 0 to 1, without the ends
+    """
+    return 0.5 - 0.5 * np.cos(np.pi * np.arange(1, n_points + 1) / (n_points + 1))
+
+
+def close_frame(x, y, pixel_x, pixel_y, imaged, n_return):
+    """ Appends the return of the galvos to the start of the frame
+    """
+    ramp = smooth_ramp(max(n_return, 0))
+    not_imaged = np.full(len(ramp), -1)
+    return (
+        np.concatenate([x, x[-1] + (x[0] - x[-1]) * ramp]),
+        np.concatenate([y, y[-1] + (y[0] - y[-1]) * ramp]),
+        np.concatenate([pixel_x, not_imaged]),
+        np.concatenate([pixel_y, not_imaged]),
+        np.concatenate([imaged, np.zeros(len(ramp), dtype=bool)]),
+    )
+
+
+def nearest_samples(x, y, n_x, n_y, line=None):
+    """ Pixels of the samples, for trajectories which are not on the pixel
+    grid: each pixel, in each line if given, gets the sample passing closest
+    to its centre, as the reconstruction takes a single sample per pixel
+    """
+    pixel_x = np.rint(x).astype(np.int64)
+    pixel_y = np.rint(y).astype(np.int64)
+    inside = (pixel_x >= 0) & (pixel_x < n_x) & (pixel_y >= 0) & (pixel_y < n_y)
+    key = pixel_y * n_x + pixel_x
+    if line is not None:
+        key += line * (n_x * n_y)
+    order = np.lexsort((np.hypot(x - pixel_x, y - pixel_y), key))
+    nearest = np.zeros(len(x), dtype=bool)
+    nearest[order[np.unique(key[order], return_index=True)[1]]] = True
+    nearest &= inside
+    return np.where(nearest, pixel_x, -1), np.where(nearest, pixel_y, -1)
+
+
+@register_pattern("bidirectional")
+def bidirectional_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ The raster of simple_scanning_pattern, the samples are reconstructed
+    where the galvos are
+    """
+    pause_x = 1 if pause else 0
+    lines = [
+        np.arange(
+            0 if i_y == 0 else -n_turn,
+            n_x + 1 if i_y == n_y - 1 else n_x + n_turn + pause_x,
+        )
+        if i_y % 2 == 0
+        else np.arange(n_x + n_turn, -1 if i_y == n_y - 1 else -n_turn - pause_x, -1)
+        for i_y in range(n_y)
+    ]
+    n_line = np.array([len(line) for line in lines])
+    extra = np.zeros(max(n_extra_points - 1, 0), dtype=np.int64)
+    x = np.concatenate(lines + [extra])
+    y = np.concatenate([np.repeat(np.arange(n_y), n_line), extra])
+    imaged = (x >= 0) & (x < n_x)
+    imaged[len(x) - len(extra) :] = False
+    return x, y, x, y, imaged
+
+
+@register_pattern("unidirectional")
+def unidirectional_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ Every line is scanned from left to right, starting n_turn / 2 pixels
+    before the frame, and the galvos fly back during 2 * n_turn samples
+    """
+    n_turn = max(n_turn, 1)
+    n_forward = n_x + n_turn
+    start = -(n_turn // 2)
+    end = start + n_forward - 1
+    line_x = np.concatenate(
+        [np.arange(start, start + n_forward), end + (start - end) * smooth_ramp(n_turn)]
+    )
+    line_y = np.concatenate([np.zeros(n_forward), smooth_ramp(n_turn)])
+    imaged = np.zeros(len(line_x), dtype=bool)
+    imaged[-start : -start + n_x] = True
+    x = np.tile(line_x, n_y)
+    y = np.repeat(np.arange(n_y), len(line_x)) + np.tile(line_y, n_y)
+    imaged = np.tile(imaged, n_y)
+    pixel_x = np.where(imaged, x, -1).astype(np.int64)
+    pixel_y = np.where(imaged, y, -1).astype(np.int64)
+    # the last flyback goes to the start of the frame instead
+    keep = slice(0, len(x) - n_turn)
+    return close_frame(
+        x[keep],
+        y[keep],
+        pixel_x[keep],
+        pixel_y[keep],
+        imaged[keep],
+        n_total(n_x, n_y, n_turn, n_extra_points, pause) - (len(x) - n_turn),
+    )
+
+
+@register_pattern("arc_turns")
+def arc_turns_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ Bidirectional raster whose lines are joined by half-ellipse arcs of
+    2 * n_turn samples outside the frame, so that the galvos turn at the
+    speed of the lines instead of stopping
+    """
+    n_arc = max(2 * n_turn, 2)
+    # the speed on the arc matches the one of the lines, one pixel per sample
+    radius_x = (n_arc + 1) / np.pi
+    arcs = []
+    for is_left in (False, True):
+        arc_x, arc_y = make_arc(0.0, 0.0, 1.0, n_arc + 2, is_left)
+        arcs.append(
+            (
+                arc_x[1:-1] * radius_x + (0 if is_left else n_x - 1),
+                (arc_y[1:-1] + 1) / 2,
+            )
+        )
+    forward = np.arange(n_x, dtype=np.float64)
+    segments_x = []
+    segments_y = []
+    for i_y in range(n_y):
+        segments_x.append(forward if i_y % 2 == 0 else forward[::-1])
+        segments_y.append(np.full(n_x, float(i_y)))
+        if i_y < n_y - 1:
+            arc_x, arc_y = arcs[i_y % 2]
+            segments_x.append(arc_x)
+            segments_y.append(arc_y + i_y)
+    # the lines are the even segments, the arcs are not imaged
+    imaged = np.concatenate(
+        [
+            np.full(len(segment), i_segment % 2 == 0)
+            for i_segment, segment in enumerate(segments_x)
+        ]
+    )
+    x = np.concatenate(segments_x)
+    y = np.concatenate(segments_y)
+    return close_frame(
+        x,
+        y,
+        np.where(imaged, x, -1).astype(np.int64),
+        np.where(imaged, y, -1).astype(np.int64),
+        imaged,
+        n_total(n_x, n_y, n_turn, n_extra_points, pause) - len(x),
+    )
+
+
+@register_pattern("sinusoidal")
+def sinusoidal_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ Bidirectional line scanning with a sinusoidal fast axis, as with a
+    resonant scanner. Each line lasts n_x + 2 * n_turn samples, the central
+    n_x of which cross the frame, and the slow axis steps during the turns
+    """
+    n_line = n_x + 2 * n_turn
+    t = np.arange(n_y * n_line) + 0.5
+    # the frame is crossed in the time of n_x samples around the middle of the line
+    amplitude = (n_x / 2) / np.sin(np.pi / 2 * n_x / n_line)
+    x = (n_x - 1) / 2 - amplitude * np.cos(np.pi * t / n_line)
+    line = np.arange(n_y)
+    line_start = line * n_line + n_turn
+    y = np.interp(
+        t,
+        np.stack([line_start, line_start + n_x], 1).ravel(),
+        np.repeat(line, 2).astype(np.float64),
+    )
+    line_of_sample = (t // n_line).astype(np.int64)
+    pixel_x, pixel_y = nearest_samples(x, y, n_x, n_y, line_of_sample)
+    return close_frame(
+        x,
+        y,
+        pixel_x,
+        pixel_y,
+        np.ones(len(x), dtype=bool),
+        max(n_total(n_x, n_y, n_turn, n_extra_points, pause) - len(x), 2 * n_turn),
+    )
+
+
+@register_pattern("spiral")
+def spiral_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ Spiral from the centre of the frame out to the inscribed ellipse,
+    with the rings one pixel apart and a constant area scanned per sample
+    """
+    n_return = max(n_extra_points, 2 * n_turn, 1)
+    n_spiral = n_total(n_x, n_y, n_turn, n_extra_points, pause) - n_return
+    u = np.sqrt((np.arange(n_spiral) + 0.5) / n_spiral)
+    angle = 2 * np.pi * (max(n_x, n_y) / 2) * u
+    x = (n_x - 1) / 2 + n_x / 2 * u * np.cos(angle)
+    y = (n_y - 1) / 2 + n_y / 2 * u * np.sin(angle)
+    return close_frame(
+        x, y, *nearest_samples(x, y, n_x, n_y), np.ones(len(x), dtype=bool), n_return
+    )
+
+
+@register_pattern("lissajous")
+def lissajous_pattern(n_x, n_y, n_turn, n_extra_points, pause):
+    """ Closed Lissajous figure, with about n_y sweeps of the fast axis and
+    a slow axis one cycle slower, which needs no return to the start
+    """
+    n_samples = n_total(n_x, n_y, n_turn, n_extra_points, pause)
+    f_x = max(n_y // 2, 2)
+    t = 2 * np.pi * np.arange(n_samples) / n_samples
+    x = (n_x - 1) / 2 + n_x / 2 * np.sin(f_x * t + np.pi / 2)
+    y = (n_y - 1) / 2 + n_y / 2 * np.sin((f_x - 1) * t)
+    return (x, y, *nearest_samples(x, y, n_x, n_y), np.ones(len(x), dtype=bool))
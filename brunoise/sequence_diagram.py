@@ -1,14 +1,99 @@
-from multiprocessing import Queue
-from collections import namedtuple
-from time import time_ns
+from multiprocessing import RawArray, RawValue
+from enum import IntEnum
+from pathlib import Path
+from time import perf_counter_ns
+import json
 
-SequenceElement = namedtuple("SequenceElement", "source t event")
 
+class TraceEvent(IntEnum):
+    DAQ_READ_WAIT = 1
+    QUEUE_PUT = 2
+    QUEUE_GET = 3
+    RECONSTRUCTION = 4
+    COMPRESSION = 5
+    GUI_REDRAW = 6
 
-class SequenceDiagram:
-    def __init__(self, queue: Queue, source: str):
-        self.queue = queue
+
+class TraceBuffer:
+    """ Ring of spans in shared memory, written by a single process and read
+    by the TraceCollector. Each span is stored as 3 integers: start time and
+    duration in ns and the event. When the ring is full the oldest spans
+    are overwritten
+
+    Usage:
+        t_start = perf_counter_ns()
+        ...
+        trace.span(TraceEvent.RECONSTRUCTION, t_start)
+
+    """
+
+    def __init__(self, source: str, capacity=2 ** 16):
         self.source = source
+        self.capacity = capacity
+        self.spans = RawArray("q", 3 * capacity)
+        self.n_written = RawValue("q", 0)
+
+    def span(self, event, t_start):
+        t_end = perf_counter_ns()
+        i_span = self.n_written.value
+        i_start = 3 * (i_span % self.capacity)
+        self.spans[i_start] = t_start
+        self.spans[i_start + 1] = t_end - t_start
+        self.spans[i_start + 2] = event
+        self.n_written.value = i_span + 1
+
+
+class NoTrace:
+    """ Stands in for a TraceBuffer when diagnostics are off
+    """
+
+    def span(self, event, t_start):
+        pass
+
+
+class TraceCollector:
+    """ Owns the TraceBuffers of all the processes in the pipeline and
+    merges them in a single timeline that can be exported in the Chrome
+    trace format (readable by chrome://tracing and Perfetto)
+
+    """
+
+    def __init__(self, sources, capacity=2 ** 16):
+        self.buffers = {source: TraceBuffer(source, capacity) for source in sources}
+        self.n_read = {source: 0 for source in sources}
+        self.spans = []
+
+    def collect(self):
+        for source, buffer in self.buffers.items():
+            n_written = buffer.n_written.value
+            i_first = max(self.n_read[source], n_written - buffer.capacity)
+            for i_span in range(i_first, n_written):
+                i_start = 3 * (i_span % buffer.capacity)
+                self.spans.append((source, *buffer.spans[i_start : i_start + 3]))
+            self.n_read[source] = n_written
+
+    def chrome_trace(self):
+        self.collect()
+        pids = {source: i for i, source in enumerate(self.buffers.keys())}
+        events = [
+            dict(name="process_name", ph="M", pid=pid, args=dict(name=source))
+            for source, pid in pids.items()
+        ]
+        events.extend(
+            dict(
+                name=TraceEvent(event).name.lower(),
+                ph="X",
+                ts=t / 1000,
+                dur=duration / 1000,
+                pid=pids[source],
+                tid=0,
+            )
+            for source, t, duration, event in self.spans
+        )
+        return dict(traceEvents=events, displayTimeUnit="ms")
 
-    def put(self, message):
-        self.queue.put(SequenceElement(self.source, time_ns(), message))
+    def export_chrome_trace(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,192 @@
+from time import perf_counter
+import timeit
+import numpy as np
+from numba import jit
+from scipy import sparse
+
+import scanning_patterns
+
+
+def bilinear_weights(x, y, image_shape):
+    """ Pixels and weights of the bilinear splatting of the positions, as
+    (i_point, i_pixel, weight) with the pixels outside the image left out.
+    The image is indexed [x, y] like the ones of reconstruct_image_pattern
+    """
+    n_x, n_y = image_shape
+    x0 = np.floor(x).astype(np.int64)
+    y0 = np.floor(y).astype(np.int64)
+    fx = x - x0
+    fy = y - y0
+    i_points = []
+    i_pixels = []
+    weights = []
+    for dx, dy, weight in (
+        (0, 0, (1 - fx) * (1 - fy)),
+        (1, 0, fx * (1 - fy)),
+        (0, 1, (1 - fx) * fy),
+        (1, 1, fx * fy),
+    ):
+        cx = x0 + dx
+        cy = y0 + dy
+        valid = (weight > 0) & (cx >= 0) & (cx < n_x) & (cy >= 0) & (cy < n_y)
+        i_points.append(np.flatnonzero(valid))
+        i_pixels.append(cx[valid] * n_y + cy[valid])
+        weights.append(weight[valid])
+    return np.concatenate(i_points), np.concatenate(i_pixels), np.concatenate(weights)
+
+
+@jit(nopython=True, cache=True)
+def bin_sums(signal, n_bin, offset, bin_skip, bin_samples):
+    """ Sums of the bins of the signal rolled by the offset, as np.roll,
+    leaving out the first bin_skip samples of each bin and summing the
+    following bin_samples
+    """
+    n_samples = len(signal)
+    sums = np.zeros(n_samples // n_bin)
+    start = (bin_skip - offset) % n_samples
+    for i_bin in range(len(sums)):
+        first = start + i_bin * n_bin
+        if first >= n_samples:
+            first -= n_samples
+        total = 0.0
+        if first + bin_samples <= n_samples:
+            for i_sample in range(first, first + bin_samples):
+                total += signal[i_sample]
+        else:
+            # the bin wraps around the end of the frame
+            for i_sample in range(first, first + bin_samples):
+                total += signal[i_sample % n_samples]
+        sums[i_bin] = total
+    return sums
+
+
+class SamplingMatrix:
+    """ Reconstructs the images of the channels from the samples read over a
+    frame: the samples are rolled by the offset and summed in their bins, as
+    for reconstruct_image_pattern, and a sparse matrix with one entry per bin
+    and pixel maps the sums of the bins of all the channels on the pixels
+    """
+
+    def __init__(self, matrix, n_bin, offset, bin_skip, bin_samples):
+        self.matrix = matrix
+        self.n_bin = n_bin
+        self.offset = offset
+        self.bin_skip = bin_skip
+        self.bin_samples = bin_samples
+
+    def reconstruct(self, signals, image_shape):
+        return np.stack(
+            [
+                (
+                    self.matrix
+                    @ bin_sums(
+                        signal, self.n_bin, self.offset, self.bin_skip, self.bin_samples
+                    )
+                ).reshape(image_shape)
+                for signal in signals
+            ]
+        )
+
+
+def sampling_matrix(
+    x, y, imaged, image_shape, n_bin, offset=0, bin_skip=0, bin_samples=None
+):
+    """ SamplingMatrix which reconstructs the images of the channels from
+    the samples read over a frame
+
+    Each output sample on the scanned path is splatted bilinearly on the pixels
+    around its position, and the pixels are normalised by the sum of the
+    weights they got, so that they are the weighted mean of the sums of the
+    bins of the samples. The rasters give the images of
+    reconstruct_image_pattern, except for the first pixel of the bidirectional
+    one, which that takes from the samples parked there at the end of the
+    frame
+
+    :param x: positions of the output samples, in pixels of the image
+    :param y:
+    :param imaged: whether each output sample is on the scanned path
+    :param image_shape: (n_x, n_y)
+    :param n_bin: input samples per output sample
+    :param offset: samples by which the input is rolled
+    :param bin_skip: the first bin_skip input samples of each bin are left out
+    :param bin_samples: input samples summed per bin, all the others if None
+    :return: SamplingMatrix, with a scipy.sparse.csr_matrix of shape
+        (n_x * n_y, len(x))
+    """
+    bin_samples = bin_samples or n_bin - bin_skip
+    i_samples = np.flatnonzero(imaged)
+    i_points, i_pixels, weights = bilinear_weights(
+        np.asarray(x, dtype=np.float64)[i_samples],
+        np.asarray(y, dtype=np.float64)[i_samples],
+        image_shape,
+    )
+    n_pixels = image_shape[0] * image_shape[1]
+    weights = weights / np.bincount(i_pixels, weights, n_pixels)[i_pixels]
+    matrix = sparse.csr_matrix(
+        (weights, (i_pixels, i_samples[i_points])), shape=(n_pixels, len(x)),
+    )
+    matrix.sum_duplicates()
+    return SamplingMatrix(matrix, n_bin, offset, bin_skip, bin_samples)
+
+
+def reconstruct_sparse(matrix: SamplingMatrix, signals, image_shape):
+    """ Images of the channels, from the samples of shape (n_channels, n_samples)
+    """
+    return matrix.reconstruct(signals, image_shape)
+
+
+def benchmark(n_x=400, n_y=400, n_bin=10, n_frames=10, n_repeats=10, offset=-400):
+    """ Compares the throughput of the sparse reconstruction with the one of
+    reconstruct_image_pattern, for the patterns, on two channels, with the
+    best of n_repeats runs of n_frames frames
+    """
+    for name in scanning_patterns.PATTERNS:
+        x, y, pixel_x, pixel_y, imaged = scanning_patterns.scan_pattern(
+            name, n_x, n_y, 10, 100, True
+        )
+        signals = np.random.rand(2, len(x) * n_bin)
+        t_start = perf_counter()
+        matrix = sampling_matrix(x, y, imaged, (n_x, n_y), n_bin, offset)
+        t_compile = perf_counter() - t_start
+
+        def reconstruct_pixels():
+            return np.stack(
+                [
+                    scanning_patterns.reconstruct_image_pattern(
+                        np.roll(signal, offset), pixel_x, pixel_y, (n_x, n_y), n_bin
+                    )
+                    for signal in signals
+                ]
+            )
+
+        def reconstruct_matrix():
+            return reconstruct_sparse(matrix, signals, (n_x, n_y))
+
+        times = {
+            method: min(timeit.repeat(reconstruct, number=n_frames, repeat=n_repeats))
+            / n_frames
+            for method, reconstruct in (
+                ("pixels", reconstruct_pixels),
+                ("sparse", reconstruct_matrix),
+            )
+        }
+        images = reconstruct_matrix()
+        pixel_images = reconstruct_pixels()
+        visited = np.asarray(matrix.matrix.sum(1)).ravel() > 0
+        print(
+            "{}: {:.2f} ms per frame with reconstruct_image_pattern, "
+            "{:.2f} ms sparse ({:.0f} ms to build, {} entries), "
+            "{:.0f}% of the pixels reconstructed, max difference {:.2g}".format(
+                name,
+                times["pixels"] * 1000,
+                times["sparse"] * 1000,
+                t_compile * 1000,
+                matrix.matrix.nnz,
+                100 * visited.mean(),
+                np.abs(images - pixel_images).max(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
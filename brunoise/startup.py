@@ -0,0 +1,37 @@
+from threading import Lock
+from time import perf_counter
+
+
+class StartupTimer:
+    """ Collects the durations of the startup phases, of the main thread
+    and of the devices opening in the background
+
+    """
+
+    def __init__(self):
+        self.t_start = perf_counter()
+        self.t_last = self.t_start
+        self.phases = []
+        self.lock = Lock()
+        self.reported = False
+
+    def mark(self, phase):
+        """ Ends a phase of the main thread, which started at the previous mark
+        """
+        t = perf_counter()
+        with self.lock:
+            self.phases.append(("main", phase, t - self.t_last))
+        self.t_last = t
+
+    def record(self, thread, phase, duration):
+        with self.lock:
+            self.phases.append((thread, phase, duration))
+
+    def report(self):
+        total = perf_counter() - self.t_start
+        lines = ["Startup in {:.2f} s".format(total)]
+        with self.lock:
+            for thread, phase, duration in self.phases:
+                lines.append("  {:<8} {:<28} {:6.3f} s".format(thread, phase, duration))
+        print("\n".join(lines))
+        self.reported = True
@@ -1,29 +1,35 @@
-from multiprocessing import Event, Queue
+from multiprocessing import Event
 from lightparam import Param, ParameterTree
 from lightparam.param_qt import ParametrizedQt
 from scanning import (
-    Scanner,
     ScanningParameters,
     ScanningState,
     RoiParameters,
-    ImageReconstructor,
     frame_duration,
+    image_origin,
+    image_shape,
 )
+from acquisition import AcquisitionPipeline, convert_params
+from scanning_patterns import PATTERNS
 from pathlib import Path
-from streaming_save import StackSaver, SavingParameters, SavingStatus
-from arrayqueues.shared_arrays import ArrayQueue
+from streaming_save import SavingParameters, SavingStatus
+from display import DisplayParameters
+from registration import RegistrationParameters
 from queue import Empty
-from brunoise.objective_motor import MotorControl
 from brunoise.external_communication import ZMQcomm
-from brunoise.power_control import LaserPowerControl
-from math import sqrt
+from startup import StartupTimer
+from brunoise.power_control import PowerService, PowerCalibration, PowerRamp
+from motor_service import MotorService, MotorClient, MotorProxy
+from zstack import ZStackEngine
+from control_server import ControlServer, StateCommands
+from replay import ReplayMotor
+from clock_sync import ClockSync
+from sample_clock import frame_sample_time
 from PyQt5.QtCore import QObject, pyqtSignal
-from PyQt5.QtWidgets import QMessageBox
 from typing import Optional
-from time import sleep
-from sequence_diagram import SequenceDiagram
-import numpy as np
-
+import flammkuchen as fl
+import json
+from time import sleep, perf_counter
 import numpy as np
 
 
@@ -38,6 +44,11 @@ class ExperimentSettings(ParametrizedQt):
         self.save_dir = Param(r"C:\Users\portugueslab\Desktop\test", gui=False)
         self.notification_email = Param("None")
         self.notify_every_n_planes = Param(3, (1, 1000))
+        self.save_traces = Param(False)
+        # the laser power is ramped linearly from the one of the scanning
+        # settings on the first plane to this one on the last
+        self.ramp_power = Param(False)
+        self.laser_power_last_plane = Param(10.0, (0, 100))
 
 
 class ScanningSettings(ParametrizedQt):
@@ -54,6 +65,13 @@ class ScanningSettings(ParametrizedQt):
         self.n_turn = Param(10, (0, 100))
         self.n_extra_init = Param(100, (0, 100))
         self.pause = Param(1, (0, 1))  # Int as Boolean GUI generation is not supported.
+        self.pattern = Param("bidirectional", list(PATTERNS.keys()))
+        self.reconstruction = Param(
+            "pixels",
+            ["pixels", "sparse"],
+            desc="sparse reconstructs the whole path of the non-raster patterns, "
+            "pixels takes one bin of samples per pixel",
+        )
 
 
 class RoiSettings(ParametrizedQt):
@@ -61,247 +79,649 @@ class RoiSettings(ParametrizedQt):
         super().__init__()
         self.name = "roi"
         self.roi_scanning = Param(False)
-        self.roi_write_signals = np.empty(0)
-
-
-def convert_params(st: ScanningSettings) -> ScanningParameters:
-    """
-    Converts the GUI scanning settings in parameters appropriate for the
-    laser scanning
-
-    """
-    pause = True if st.pause else False
-
-    sample_rate = st.output_rate_khz * 1000
-    n_total = sample_rate / st.framerate
-    # Loosens the restraint by 2 * the turn value, as the first and last line require one turn less.
-    n_total += 2 * st.n_turn
-
-    # Solving for the biggest image surface is basically a constraint problem of the form:
-    # ax**2 + bx + c = 0, where a is the aspect ratio (can be seen as y * x where y = a * x), b is the two turns,
-    # and c is the total number of available positions (given the desired frequency and sampling rate).
-    b = 2 * st.n_turn
-    if pause:  # If pause is enabled, additional points dependent on x will be added to the trajectory.
-        b += 1
-    n = (-b + np.sqrt(b**2 - (4 * st.aspect_ratio * -n_total))) / (2 * st.aspect_ratio) # Image dimensions.
-
-    # Change the y-axis to get the right aspect ratio.
-    n_x = int(np.floor(n))
-    n_y = int(np.floor(n * st.aspect_ratio))
-
-    # No need to get rid of 2 turns, we already added it before.
-    n_extra = int(n_total - ((n_x * b) + (n_x*n_y)))
-
-    mystery_offset = -int(round(st.output_rate_khz * 0.8))
-    voltage_max = st.voltage
-    if st.aspect_ratio >= 1:
-        voltage_y = voltage_max
-        voltage_x = voltage_y / st.aspect_ratio
-    else:
-        voltage_y = voltage_max * st.aspect_ratio
-        voltage_x = voltage_max
-
-    sp = ScanningParameters(
-        voltage_x=voltage_x,
-        voltage_y=voltage_y,
-        n_x=n_x,
-        n_y=n_y,
-        n_turn=st.n_turn,
-        n_extra=n_extra,
-        sample_rate_out=sample_rate,
-        shutter=st.shutter,
-        mystery_offset=mystery_offset,
-        framerate=st.framerate,
-        pause=pause
+        # set from the ROI drawn in the viewer
+        self.roi_rect = None
+
+
+class DisplaySettings(ParametrizedQt):
+    def __init__(self):
+        super().__init__()
+        self.name = "display"
+        self.auto_levels = Param(True)
+        self.percentile_low = Param(1.0, (0.0, 50.0))
+        self.percentile_high = Param(99.5, (50.0, 100.0))
+        self.smoothing = Param(0.8, (0.0, 0.99))
+
+
+class DriftSettings(ParametrizedQt):
+    def __init__(self):
+        super().__init__()
+        self.name = "drift"
+        self.estimate = Param(False)
+        self.every_n_frames = Param(5, (1, 100))
+        self.downsampling = Param(4, (1, 16))
+        self.n_reference = Param(10, (1, 100))
+        self.correct = Param(False)
+        self.threshold = Param(5.0, (0.5, 100.0), unit="um")
+        # from the last correction, for the stage to settle before the frames
+        # which show its effect are read
+        self.min_interval = Param(10.0, (1.0, 600.0), unit="s")
+        # fraction of the drift corrected, the sign depends on the stage orientation
+        self.gain = Param(0.5, (-1.0, 1.0))
+        self.um_per_volt = Param(100.0, (1.0, 1000.0), gui=False)
+
+
+def convert_display_params(st: DisplaySettings, channels) -> DisplayParameters:
+    return DisplayParameters(
+        channels=channels,
+        auto_levels=st.auto_levels,
+        percentile_low=st.percentile_low,
+        percentile_high=st.percentile_high,
+        smoothing=st.smoothing,
     )
-    return sp
 
 
 def convert_roi_params(st: RoiSettings) -> RoiParameters:
     rp = RoiParameters(
         roi_scanning=st.roi_scanning,
-        roi_write_signals=st.roi_write_signals
+        roi_rect=st.roi_rect,
     )
     return rp
 
 
 class ExperimentState(QObject):
     sig_scanning_changed = pyqtSignal()
-
-    def __init__(self, diagnostics=False):
+    sig_settings_changed = pyqtSignal()
+    sig_start_failed = pyqtSignal()
+
+    def __init__(
+        self,
+        diagnostics=False,
+        placement=None,
+        memory_budget=None,
+        startup_timer=None,
+        laser_calibration=None,
+        publisher=None,
+        control_address=None,
+        replay=None,
+        raw_capture=False,
+        clock_address=None,
+    ):
+        """
+        :param diagnostics: trace the pipeline processes
+        :param placement: dictionary of ProcessPlacement for the main, scanner,
+            reconstructor and saver processes, see process_placement.default_placement
+        :param memory_budget: MemoryBudget sizing the queues between the processes
+        :param startup_timer: StartupTimer collecting the startup phases
+        :param laser_calibration: file of the power calibration table of the laser,
+            if None the calibration function of LaserPowerControl is used
+        :param publisher: PublisherParameters to publish the reconstructed frames
+            to external consumers, not published if None
+        :param control_address: ZMQ address on which the control server answers
+            the requests of automation scripts, no server if None
+        :param replay: ReplayParameters of a saved recording replayed instead of
+            scanning, the laser and the stage are then not opened
+        :param raw_capture: save the samples of the PMTs next to the stack
+        :param clock_address: address of the clock_sync.ClockServer of the
+            stimulus computer, pinged to estimate the offset of its clock,
+            saved with each recording in clock_alignment.h5
+        """
         super().__init__()
-        if diagnostics:
-            self.sequence_queue = Queue()
-            self.sequence_diagram = SequenceDiagram(self.sequence_queue, "main")
+        self.startup_timer = (
+            startup_timer if startup_timer is not None else StartupTimer()
+        )
+        # the devices open in the background while the pipeline starts,
+        # they are taken by update_devices once ready
+        self.replay = replay
+        self.power_service = PowerService(
+            calibration=PowerCalibration.load_or_default(laser_calibration)
+        )
+        # the motor service owns the connection to the stage controller
+        self.motor_service = MotorService("COM5", axes=("x", "y", "z"))
+        self.motor_client = MotorClient(self.motor_service)
+        self.motors = dict()
+        if replay is None:
+            self.power_service.start()
+            self.motor_service.start()
+        else:
+            self.motors = {axis: ReplayMotor(axis) for axis in self.motor_service.axes}
+        self.laser_ready = False
+        self.devices_reported = False
+
+        self.pipeline = AcquisitionPipeline(
+            diagnostics=diagnostics,
+            placement=placement,
+            memory_budget=memory_budget,
+            publisher=publisher,
+            replay=replay,
+            raw_capture=raw_capture,
+        )
+        self.trace = self.pipeline.trace
+        self.frame_accounting = self.pipeline.frame_accounting
 
-        self.experiment_start_event = Event()
         self.scanning_settings = ScanningSettings()
         self.experiment_settings = ExperimentSettings()
         self.roi_settings = RoiSettings()
+        self.display_settings = DisplaySettings()
+        self.drift_settings = DriftSettings()
         self.pause_after = False
 
         self.parameter_tree = ParameterTree()
         self.parameter_tree.add(self.scanning_settings)
         self.parameter_tree.add(self.experiment_settings)
+        self.parameter_tree.add(self.drift_settings)
 
         self.end_event = Event()
+        # the session with Stytra stays open, so that a trial only takes
+        # a round trip on the open connection
         self.external_sync = ZMQcomm()
-        self.duration_queue = Queue()
-        self.scanner = Scanner(
-            self.experiment_start_event, duration_queue=self.duration_queue
-        )
-        self.scanning_parameters = None
-        self.roi_parameters = None
-        self.reconstructor = ImageReconstructor(
-            self.scanner.data_queue, self.scanner.stop_event
+        self.external_sync.start()
+        self.clock_sync = None
+        if clock_address is not None:
+            self.clock_sync = ClockSync(clock_address)
+            self.clock_sync.start()
+        self.t_recording_start = None
+        self.trial_parameters = None
+        # the trial of the first plane, negotiated in the thread of the z-stack
+        self.first_trial = None
+        self.start_error = None
+        self.z_move = None
+        self.zstack = ZStackEngine(
+            move_to_plane=self.move_to_plane,
+            move_state=self.z_move_state,
+            negotiate_trial=self.negotiate_trial,
+            start_plane=self.start_plane,
+            saving=lambda: self.saving,
+            finish=self.finish_experiment,
         )
-        self.save_queue = ArrayQueue(max_mbytes=800)
-        self.timestamp_queue = Queue()
+        self.display_parameters = DisplayParameters()
+        self.trace_labels = None
+        self.recorded_traces = []
+        self.drift_log = []
+        self.t_last_correction = -np.inf
+        self.registration_parameters = None
 
-        self.saver = StackSaver(
-            self.scanner.stop_event, self.save_queue, self.timestamp_queue, self.scanner.n_frames_queue
-        )
-        self.save_status: Optional[SavingStatus] = None
-
-        self.motors = dict()
-        self.motors["x"] = MotorControl("COM5", axes="x")
-        self.motors["y"] = MotorControl("COM5", axes="y")
-        self.motors["z"] = MotorControl("COM5", axes="z")
-        self.power_controller = LaserPowerControl()
         self.scanning_settings.sig_param_changed.connect(self.send_scan_params)
         self.scanning_settings.sig_param_changed.connect(self.send_save_params)
-        self.roi_settings.sig_param_changed.connect(self.send_scan_params)
-        self.scanner.start()
-        self.reconstructor.start()
-        self.saver.start()
+        self.roi_settings.sig_param_changed.connect(self.send_roi_params)
+        self.display_settings.sig_param_changed.connect(self.send_display_params)
+        self.drift_settings.sig_param_changed.connect(self.send_drift_params)
+        self.startup_timer.mark("state")
+        self.pipeline.start()
+        self.startup_timer.mark("acquisition processes")
         self.open_setup()
 
         self.paused = False
 
+        self.control_server = None
+        if control_address is not None:
+            self.control_server = ControlServer(control_address)
+            self.remote_commands = StateCommands(self).commands()
+            self.control_server.start()
+
+    def execute_remote_commands(self):
+        if self.control_server is not None:
+            self.control_server.execute_pending(self.remote_commands)
+
+    def all_settings(self):
+        return [
+            self.scanning_settings,
+            self.experiment_settings,
+            self.roi_settings,
+            self.display_settings,
+            self.drift_settings,
+        ]
+
+    def apply_settings(self, new_settings):
+        """ Sets the values of several settings at once, as a dictionary
+        of the values by settings name, e.g. {"scanning": {"framerate": 3.0}}.
+        Each settings changed notifies the pipeline once, instead of
+        once for each value
+
+        """
+        by_name = {settings.name: settings for settings in self.all_settings()}
+        for name, values in new_settings.items():
+            if name not in by_name:
+                raise ValueError("Unknown settings {}".format(name))
+            unknown = set(values) - set(by_name[name].params.items())
+            if unknown:
+                raise ValueError(
+                    "Unknown {} settings: {}".format(name, ", ".join(sorted(unknown)))
+                )
+        if self.saving and "scanning" in new_settings:
+            raise ValueError("The scanning settings cannot change while recording")
+        for name, values in new_settings.items():
+            settings = by_name[name]
+            settings.block_signal = True
+            try:
+                for param_name, value in values.items():
+                    setattr(settings, param_name, value)
+            finally:
+                settings.block_signal = False
+            settings.sig_param_changed.emit(dict(values))
+        self.sig_settings_changed.emit()
+
+    def update_devices(self):
+        """ Takes the devices which finished opening in the background,
+        returns whether all the devices are done opening
+
+        """
+        self.motor_client.update()
+        if not self.motors_ready() and self.motor_client.ready:
+            self.motors = {
+                axis: MotorProxy(self.motor_client, axis)
+                for axis in self.motor_service.axes
+            }
+        if not self.laser_ready and self.power_service.ready.is_set():
+            self.laser_ready = True
+            self.set_laser_power()
+        done = (self.laser_ready or not self.power_service.is_alive()) and (
+            self.motors_ready() or not self.motor_service.is_alive()
+        )
+        if done and not self.devices_reported:
+            if self.power_service.error is not None:
+                print("Could not open the laser: {}".format(self.power_service.error))
+            for name, duration in [
+                ("laser", self.power_service.startup_duration),
+                ("motors", self.motor_client.startup_duration),
+            ]:
+                if duration is not None:
+                    self.startup_timer.record("devices", name, duration)
+            self.devices_reported = True
+        return done
+
+    def wait_for_devices(self):
+        while (
+            not self.power_service.ready.is_set() and self.power_service.is_alive()
+        ) or (not self.motor_client.ready and self.motor_service.is_alive()):
+            sleep(0.01)
+        self.update_devices()
+
+    def motors_ready(self):
+        return len(self.motors) == 3
+
+    def set_laser_power(self):
+        """ The power service moves only once the setting stops changing,
+        and only if the power differs from the last one set
+        """
+        self.power_service.set_power(self.scanning_settings.laser_power)
+
+    def set_power_ramp(self):
+        if self.experiment_settings.ramp_power and self.experiment_settings.n_planes > 1:
+            self.power_service.set_ramp(
+                PowerRamp(
+                    self.power_service.calibration,
+                    self.scanning_settings.laser_power,
+                    self.experiment_settings.laser_power_last_plane,
+                    self.experiment_settings.n_planes,
+                )
+            )
+        else:
+            self.power_service.set_ramp(None)
+
+    @property
+    def scanning_parameters(self) -> Optional[ScanningParameters]:
+        return self.pipeline.scanning_parameters
+
+    @property
+    def roi_parameters(self) -> Optional[RoiParameters]:
+        return self.pipeline.roi_parameters
+
+    @property
+    def save_status(self) -> Optional[SavingStatus]:
+        return self.pipeline.save_status
+
     @property
     def saving(self):
-        return self.saver.saving_signal.is_set()
+        return self.pipeline.saving
+
+    def export_trace(self, path):
+        self.pipeline.export_trace(path)
 
     def open_setup(self):
         self.send_scan_params()
+        self.send_drift_params()
 
-    def start_experiment(self, first_plane=True):
-        duration = self.external_sync.send(self.parameter_tree.serialize())
-        if duration is None:
-            msg = QMessageBox()
-            msg.setIcon(QMessageBox.Critical)
-            msg.setText("Warning")
-            msg.setInformativeText("Couldn't make a connection with Stytra. Experiment not started.")
-            msg.setWindowTitle("Warning")
-            msg.exec_()
+    @property
+    def starting(self):
+        return self.first_trial is not None
 
+    def start_experiment(self):
+        """ Negotiates the trial of the first plane in the thread of the
+        z-stack engine, so that the GUI does not wait for Stytra. The
+        recording starts from poll_start once the trial is ready
+        """
+        if self.starting:
+            return
+        self.wait_for_devices()
+        self.trial_parameters = self.parameter_tree.serialize()
+        self.start_error = None
+        self.first_trial = self.zstack.executor.submit(self.negotiate_trial)
+
+    def poll_start(self):
+        """ Starts the recording if the first trial has been negotiated
+        """
+        if self.first_trial is None or not self.first_trial.done():
+            return
+        duration = self.first_trial.result()
+        self.first_trial = None
+        if duration is None:
+            self.start_error = "the trial could not be negotiated with Stytra"
             self.restart_scanning()
-            return False
-        self.duration_queue.put(duration)
-        params_to_send = convert_params(self.scanning_settings)
-        params_to_send.scanning_state = ScanningState.EXPERIMENT_RUNNING
-        self.scanner.parameter_queue.put(params_to_send)
-        if first_plane:
-            self.send_save_params()
-            self.saver.saving_signal.set()
-        self.experiment_start_event.set()
+            self.sig_start_failed.emit()
+            return
+        self.recorded_traces = []
+        self.t_recording_start = perf_counter()
+        self.reset_drift()
+        self.set_power_ramp()
+        self.power_service.go_to_plane(0)
+        self.start_plane(0, duration)
+        self.zstack.begin(self.experiment_settings.n_planes)
+
+    def negotiate_trial(self):
+        """ Sends the parameters to Stytra, which answers with the duration
+        of the trial. Called from the thread of the z-stack engine
+        """
+        return self.external_sync.send(self.trial_parameters)
+
+    def start_plane(self, i_plane, duration):
+        self.pipeline.start_plane(
+            convert_params(self.scanning_settings),
+            duration,
+            self.saving_parameters() if i_plane == 0 else None,
+        )
         if self.experiment_settings.lock_z:
             self.motors["z"].send_command("MF")
-        return True
 
-    def end_experiment(self, force=False):
-        self.experiment_start_event.clear()
+    def move_to_plane(self, i_plane):
+        """ Starts moving the objective to the plane, the power of the
+        plane is set while it moves
+        """
+        self.power_service.go_to_plane(i_plane)
+        self.motors["z"].send_command("MO")
+        self.z_move = self.motors["z"].move_rel(self.experiment_settings.dz / 1000)
+
+    def z_move_state(self):
+        """ State of the last move of the objective as notified by the motor
+        service, the ReplayMotors settle right away
+        """
+        if self.z_move is None:
+            return "settled"
+        return self.motor_client.state(self.z_move)
 
-        if not force and self.save_status.i_z + 1 < self.save_status.target_params.n_z:
-            self.advance_plane()
+    def end_experiment(self, force=False):
+        """ Ends the current plane, the z-stack engine then moves to the
+        next one or finishes the recording. If forced the recording
+        is stopped right away
+        """
+        self.pipeline.end_plane()
+        if force:
+            self.zstack.abort()
+        else:
+            self.zstack.end_plane()
+
+    def finish_experiment(self, aborted=False):
+        self.pipeline.stop_saving(self.experiment_settings.save_dir)
+        if self.power_service.ramp is not None:
+            self.power_service.set_ramp(None)
+            self.set_laser_power()
+        self.write_traces()
+        self.write_drift()
+        self.write_plane_timing()
+        self.write_clock_alignment()
+        self.motors["z"].send_command("MO")
+        if self.pause_after:
+            self.pause_scanning()
         else:
-            sleep(0.2)
-            self.saver.saving_signal.clear()
-            self.motors["z"].send_command("MO")
-            if self.pause_after:
-                self.pause_scanning()
-            else:
-                self.restart_scanning()
+            self.restart_scanning()
+
+    def write_plane_timing(self):
+        if len(self.zstack.timing) == 0:
+            return
+        with open(Path(self.experiment_settings.save_dir) / "plane_timing.json", "w") as f:
+            json.dump(self.zstack.timing, f)
+
+    def write_clock_alignment(self):
+        """ Saves the pings of the clock synchronization from a while before
+        the recording, so that the model is fitted on enough of them
+        """
+        if self.clock_sync is None or self.t_recording_start is None:
+            return
+        self.clock_sync.write_alignment(
+            Path(self.experiment_settings.save_dir) / "clock_alignment.h5",
+            t_start=self.t_recording_start - 60.0,
+        )
+
+    def seconds_buffered(self):
+        return self.pipeline.seconds_buffered()
+
+    def set_trace_rois(self, ellipses):
+        """ Sets the elliptical ROIs, as (x0, y0, width, height) in pixels
+        of the full frame, whose traces are extracted live, None to stop
+        extracting
+
+        """
+        if ellipses is None:
+            self.trace_labels = None
+        self.pipeline.reconstructor.trace_roi_queue.put(ellipses)
+
+    def get_traces(self):
+        """ Returns the list of (header, ROI means) extracted since the last call
+        """
+        try:
+            while True:
+                self.trace_labels = (
+                    self.pipeline.reconstructor.trace_label_queue.get_nowait()
+                )
+        except Empty:
+            pass
+        traces = []
+        while True:
+            try:
+                traces.append(self.pipeline.reconstructor.trace_queue.get_nowait())
+            except Empty:
+                break
+        if self.saving and self.experiment_settings.save_traces:
+            self.recorded_traces.extend(traces)
+        return traces
+
+    def write_traces(self):
+        if len(self.recorded_traces) == 0:
+            return
+        # only the traces of the last set of ROIs are kept
+        n_rois = self.recorded_traces[-1][1].shape[1]
+        self.recorded_traces = [
+            (header, traces)
+            for header, traces in self.recorded_traces
+            if traces.shape[1] == n_rois
+        ]
+        fl.save(
+            Path(self.experiment_settings.save_dir) / "traces.h5",
+            dict(
+                seq=np.array([header.seq for header, _ in self.recorded_traces]),
+                t=np.array([header.t for header, _ in self.recorded_traces]),
+                t_sample=np.array(
+                    [frame_sample_time(header) for header, _ in self.recorded_traces]
+                ),
+                traces=np.stack([traces for _, traces in self.recorded_traces]),
+                labels=self.trace_labels,
+            ),
+        )
+        self.recorded_traces = []
+
+    def send_drift_params(self):
+        registration = self.pipeline.registration
+        registration.every_n.value = (
+            self.drift_settings.every_n_frames if self.drift_settings.estimate else 0
+        )
+        parameters = RegistrationParameters(
+            downsampling=self.drift_settings.downsampling,
+            n_reference=self.drift_settings.n_reference,
+        )
+        # the registration takes a new reference with new parameters, the
+        # settings of the correction keep the current one
+        if parameters != self.registration_parameters:
+            registration.parameter_queue.put(parameters)
+            self.registration_parameters = parameters
+
+    def reset_drift(self):
+        """ Takes a new reference and starts a new drift log
+        """
+        self.pipeline.registration.reset_event.set()
+        self.drift_log = []
+        self.t_last_correction = -np.inf
+
+    def pixel_size_um(self):
+        sp = self.scanning_parameters
+        return np.array(
+            [
+                2 * sp.voltage_x * self.drift_settings.um_per_volt / sp.n_x,
+                2 * sp.voltage_y * self.drift_settings.um_per_volt / sp.n_y,
+            ]
+        )
+
+    def update_drift(self):
+        """ Logs the shifts estimated by the registration and, if enabled,
+        moves the stage when the drift exceeds the threshold. The shifts are
+        measured against the reference, so they include the corrections
+        already made, and only the frames read min_interval after the last
+        correction was sent are used. The correction made after each shift,
+        zero if none, is logged with the time it was sent
+
+        """
+        while True:
+            try:
+                header, shift = self.pipeline.registration.shift_queue.get_nowait()
+            except Empty:
+                break
+            shift_um = shift * self.pixel_size_um()
+            correction = np.zeros(2)
+            t_correction = np.nan
+            if (
+                self.drift_settings.correct
+                and self.motors_ready()
+                and np.max(np.abs(shift_um)) > self.drift_settings.threshold
+                and header.t - self.t_last_correction > self.drift_settings.min_interval
+            ):
+                correction = shift_um * self.drift_settings.gain
+                self.motors["x"].move_rel(correction[0] / 1000)
+                self.motors["y"].move_rel(correction[1] / 1000)
+                # the frames are timed with perf_counter too
+                t_correction = self.t_last_correction = perf_counter()
+            self.drift_log.append(
+                (header.seq, header.t, *shift_um, *correction, t_correction)
+            )
+
+    def write_drift(self):
+        if len(self.drift_log) == 0:
+            return
+        drift_log = np.array(self.drift_log)
+        fl.save(
+            Path(self.experiment_settings.save_dir) / "drift.h5",
+            dict(
+                seq=drift_log[:, 0].astype(np.int64),
+                t=drift_log[:, 1],
+                shift_um=drift_log[:, 2:4],
+                correction_um=drift_log[:, 4:6],
+                t_correction=drift_log[:, 6],
+            ),
+        )
 
     def restart_scanning(self):
-        params_to_send = convert_params(self.scanning_settings)
-        params_to_send.scanning_state = ScanningState.PREVIEW
-        self.scanner.parameter_queue.put(params_to_send)
-        self.roi_parameters = convert_roi_params(self.roi_settings)
-        self.scanner.roi_queue.put(self.roi_parameters)
+        self.pipeline.set_scanning_state(
+            convert_params(self.scanning_settings), ScanningState.PREVIEW
+        )
+        self.send_roi_params()
         self.paused = False
 
     def pause_scanning(self):
-        params_to_send = convert_params(self.scanning_settings)
-        params_to_send.scanning_state = ScanningState.PAUSED
-        self.scanner.parameter_queue.put(params_to_send)
+        self.pipeline.set_scanning_state(
+            convert_params(self.scanning_settings), ScanningState.PAUSED
+        )
         self.paused = True
 
-    def advance_plane(self):
-        self.motors["z"].send_command("MO")
-        self.motors["z"].move_rel(self.experiment_settings.dz / 1000)
-        sleep(0.2)
-        self.start_experiment(first_plane=False)
-
     def close_setup(self):
         """ Cleanup on programe close:
         end all parallel processes, close all communication channels
 
         """
+        self.wait_for_devices()
+        if self.control_server is not None:
+            self.control_server.stop()
         for motor in self.motors.values():
             motor.end_session()
-        self.power_controller.terminate_connection()
-        self.scanner.stop_event.set()
+        if self.clock_sync is not None:
+            self.clock_sync.stop()
+        self.external_sync.close()
+        if self.replay is None:
+            self.motor_client.stop()
+            self.power_service.stop()
         self.end_event.set()
-        self.scanner.join()
-        self.reconstructor.join()
+        self.pipeline.stop()
+        self.export_trace(Path(self.experiment_settings.save_dir) / "trace.json")
 
     def get_image(self):
-        try:
-            images = -self.reconstructor.output_queue.get(timeout=0.001)
-            try:
-                t = self.scanner.time_queue.get(timeout=0.001)
-            except Empty:
-                t = 0
-                print("scanner time queue is empty")
-            if self.saver.saving_signal.is_set():
-                if (
-                    self.save_status is not None
-                    and self.save_status.i_t + 1 == self.save_status.target_params.n_t
-                ):
-                    self.end_experiment()
-                    self.save_status.i_t = -5
-                self.save_queue.put(images)
-                self.timestamp_queue.put(t)
-            return images
-        except Empty:
+        frame = self.pipeline.get_frame()
+        if frame is None:
             return None
+        header, images = frame
+        if self.saving:
+            if (
+                self.save_status is not None
+                and self.zstack.scanning_plane(self.save_status.i_z)
+                and self.save_status.i_t + 1 == self.save_status.target_params.n_t
+            ):
+                self.end_experiment()
+            self.pipeline.save_frame(images, header)
+        return images
+
+    def get_display_frame(self):
+        return self.pipeline.get_display_frame()
+
+    def set_display_channels(self, channels):
+        if channels != self.display_parameters.channels:
+            self.display_parameters.channels = channels
+            self.send_display_params()
+
+    def send_display_params(self):
+        self.display_parameters = convert_display_params(
+            self.display_settings, self.display_parameters.channels
+        )
+        self.pipeline.reconstructor.display_parameter_queue.put(self.display_parameters)
 
     def send_scan_params(self):
-        self.scanning_parameters = convert_params(self.scanning_settings)
-        self.power_controller.move_abs(self.scanning_settings.laser_power)
-        self.scanner.parameter_queue.put(self.scanning_parameters)
-        self.roi_parameters = convert_roi_params(self.roi_settings)
-        self.scanner.roi_queue.put(self.roi_parameters)
-        self.reconstructor.parameter_queue.put(self.scanning_parameters)
+        self.set_laser_power()
+        self.pipeline.send_scan_params(convert_params(self.scanning_settings))
+        self.send_roi_params()
         self.sig_scanning_changed.emit()
 
-    def send_save_params(self):
-        self.saver.saving_parameter_queue.put(
-            SavingParameters(
-                output_dir=Path(self.experiment_settings.save_dir),
-                plane_size=(self.scanning_parameters.n_x, self.scanning_parameters.n_y),
-                n_z=self.experiment_settings.n_planes,
-                channel=self.experiment_settings.channel,
-                notification_email=self.experiment_settings.notification_email,
-                notification_frequency=self.experiment_settings.notify_every_n_planes
-            )
+    def send_roi_params(self):
+        self.pipeline.send_roi_params(convert_roi_params(self.roi_settings))
+
+    def set_roi_rect(self, roi_rect):
+        """ Sets the ROI scanned when ROI scanning is on, as x0, y0, width
+        and height in pixels of the full frame
+
+        """
+        self.roi_settings.roi_rect = roi_rect
+        if self.roi_settings.roi_scanning:
+            self.send_roi_params()
+
+    def image_origin(self, shape):
+        return image_origin(self.scanning_parameters, self.roi_parameters, shape)
+
+    def saving_parameters(self):
+        return SavingParameters(
+            output_dir=Path(self.experiment_settings.save_dir),
+            plane_size=image_shape(self.scanning_parameters, self.roi_parameters),
+            n_z=self.experiment_settings.n_planes,
+            channel=self.experiment_settings.channel,
+            notification_email=self.experiment_settings.notification_email,
+            notification_frequency=self.experiment_settings.notify_every_n_planes
         )
 
+    def send_save_params(self):
+        self.pipeline.send_save_params(self.saving_parameters())
+
     def get_save_status(self) -> Optional[SavingStatus]:
-        try:
-            self.save_status = self.saver.saved_status_queue.get(timeout=0.001)
-            return self.save_status
-        except Empty:
-            pass
-        return None
+        return self.pipeline.get_save_status()
@@ -3,14 +3,19 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 from queue import Empty
+from sequence_diagram import NoTrace, TraceEvent
+from process_placement import apply_placement
+from sample_clock import frame_sample_time
 import flammkuchen as fl
 import numpy as np
 import shutil
 import json
-import yagmail
-from PIL import Image
 import os
 import time
+from time import perf_counter_ns
+
+# volts of the PMT signal per unit of the saved int16 frames
+SAVED_SCALE = 2 / 2 ** 12
 
 
 @dataclass
@@ -31,12 +36,47 @@ class SavingStatus:
     i_z: int = 0
 
 
+def save_times(
+    path, times, sample_times, plane_starts=None, sample_plane_starts=None
+):
+    """ Saves the times of the frames from the start of each plane, of shape
+    (n_t, n_z), as read by the host (t) and from the sample clock of the
+    DAQ (t_sample), NaN for the frames which were not timed by the DAQ,
+    and the perf_counter times of the first frames of the planes
+    """
+    saved = dict(t=times, t_sample=sample_times)
+    if plane_starts is not None:
+        saved.update(
+            t_plane_start=np.asarray(plane_starts),
+            t_sample_plane_start=np.asarray(sample_plane_starts),
+        )
+    fl.save(path, saved, compression="blosc")
+
+
+def load_times(path):
+    """ The times of the frames of a time.h5 file, as (times, sample_times),
+    the sample times are None for the recordings which only have the host times
+    """
+    saved = fl.load(path)
+    if isinstance(saved, dict):
+        return np.asarray(saved["t"]), np.asarray(saved["t_sample"])
+    return np.asarray(saved), None
+
+
 class StackSaver(Process):
-    def __init__(self, stop_signal, data_queue, time_queue, n_frames_queue):
+    def __init__(
+        self,
+        stop_signal,
+        data_queue,
+        n_frames_queue,
+        trace=None,
+        placement=None,
+    ):
         super().__init__()
+        self.trace = trace if trace is not None else NoTrace()
+        self.placement = placement
         self.stop_signal = stop_signal
         self.data_queue = data_queue
-        self.time_queue = time_queue
         self.saving_signal = Event()
         self.n_frames_queue = n_frames_queue
         self.saving = False
@@ -50,8 +90,14 @@ class StackSaver(Process):
         # self.dtype = float
         self.current_time = None
         self.timestamps = None
+        # times of the frames from the sample clock of the DAQ
+        self.current_sample_time = None
+        self.sample_timestamps = None
+        # times of the first frames of the planes, on both clocks
+        self.plane_starts = []
 
     def run(self):
+        apply_placement("saver", self.placement)
         while not self.stop_signal.is_set():
             if self.saving_signal.is_set() and self.save_parameters is not None:
                 self.save_loop()
@@ -84,6 +130,7 @@ class StackSaver(Process):
             dtype=self.dtype,
         )
         self.current_time = np.empty(self.save_parameters.n_t)
+        self.current_sample_time = np.empty(self.save_parameters.n_t)
         n_total = self.save_parameters.n_t * self.save_parameters.n_z
         while (
                 i_received < n_total
@@ -97,21 +144,25 @@ class StackSaver(Process):
             except Empty:
                 pass
             try:
-                frame = self.data_queue.get(timeout=0.01)
-                self.fill_dataset(frame)
+                t_start = perf_counter_ns()
+                header, frame = self.data_queue.get(timeout=0.01)
+                self.trace.span(TraceEvent.QUEUE_GET, t_start)
+                self.fill_dataset(frame, header)
                 i_received += 1
             except Empty:
                 pass
-        
+
+        # a recording stopped early may still have its last frame on the way,
+        # a complete stack has all of its frames already
         t_end = time.time()
-        while time.time() - t_end < 5:
+        while i_received < n_total and time.time() - t_end < 5:
             try:
-                frame = self.data_queue.get(timeout=0.01)
-                self.fill_dataset(frame)
+                header, frame = self.data_queue.get(timeout=0.01)
+                self.fill_dataset(frame, header)
                 break
             except Empty:
                 pass
-        
+
         if self.i_block > 0:
             self.finalize_dataset()
             if self.save_parameters.notification_email != "None":
@@ -125,7 +176,7 @@ class StackSaver(Process):
         Conversion into a format appropriate for saving
         """
         if self.dtype == np.int16:
-            frame = (frame / (2 / 2**12)).astype(self.dtype)
+            frame = (frame / SAVED_SCALE).astype(self.dtype)
         return frame
 
     def update_n_t(self, n_t):
@@ -137,14 +188,14 @@ class StackSaver(Process):
             old_time = self.current_time[: self.i_in_plane].copy()
             self.current_time = np.empty(n_t)
             self.current_time[: self.i_in_plane] = old_time
+            old_sample_time = self.current_sample_time[: self.i_in_plane].copy()
+            self.current_sample_time = np.empty(n_t)
+            self.current_sample_time[: self.i_in_plane] = old_sample_time
 
-    def fill_dataset(self, frame):
+    def fill_dataset(self, frame, header):
         self.current_data[self.i_in_plane, :, :, :] = self.cast(frame)
-        try:
-            t = self.time_queue.get(timeout=0.001)
-            self.current_time[self.i_in_plane] = t
-        except Empty:
-            print('time queue is empty')
+        self.current_time[self.i_in_plane] = header.t
+        self.current_sample_time[self.i_in_plane] = frame_sample_time(header)
         self.i_in_plane += 1
         self.saved_status_queue.put(
             SavingStatus(
@@ -210,16 +261,28 @@ class StackSaver(Process):
                 self.dump_metadata(f)
 
     def complete_plane(self):
+        t_start = perf_counter_ns()
         if self.i_block == 0:
+            self.plane_starts = []
             self.timestamps = self.current_time.copy() - self.current_time[0]
+            self.sample_timestamps = (
+                self.current_sample_time - self.current_sample_time[0]
+            )
         else:
             self.timestamps = np.vstack((self.timestamps, self.current_time - self.current_time[0]))
+            self.sample_timestamps = np.vstack(
+                (
+                    self.sample_timestamps,
+                    self.current_sample_time - self.current_sample_time[0],
+                )
+            )
+        self.plane_starts.append((self.current_time[0], self.current_sample_time[0]))
         # save each time because the computer might crash before all planes are acquired
-        fl.save(
-            Path(self.save_parameters.output_dir)
-            / "time.h5",
+        save_times(
+            Path(self.save_parameters.output_dir) / "time.h5",
             self.timestamps.T,
-            compression="blosc",
+            self.sample_timestamps.T,
+            *zip(*self.plane_starts),
         )
         if self.save_parameters.channel == "Green":
             fl.save(
@@ -248,6 +311,7 @@ class StackSaver(Process):
                 {"stack_4D": self.current_data[:,1:,:,:]},
                 compression="blosc",
             )
+        self.trace.span(TraceEvent.COMPRESSION, t_start)
         self.i_block += 1
 
         if self.i_block % self.save_parameters.notification_frequency == 0 and \
@@ -257,6 +321,10 @@ class StackSaver(Process):
         self.i_in_plane = 0
 
     def send_email_update(self, frame=None, end=False):
+        # imported here as they are needed only for the notifications
+        import yagmail
+        from PIL import Image
+
         sender_email = "fishgitbot@gmail.com"
         receiver_email = self.save_parameters.notification_email
         subject = "Progress update: Your 2P experiment"
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def ellipse_labels(shape, ellipses):
+    """ Label image for elliptical ROIs given as (x0, y0, width, height) of
+    their bounding box, with x along the first axis of the image like in the
+    viewer. 0 is the background, later ROIs are drawn over earlier ones
+
+    """
+    labels = np.zeros(shape, np.int32)
+    xs = np.arange(shape[0])[:, None] + 0.5
+    ys = np.arange(shape[1])[None, :] + 0.5
+    for i_roi, (x0, y0, width, height) in enumerate(ellipses):
+        inside = ((xs - x0 - width / 2) / (width / 2)) ** 2 + (
+            (ys - y0 - height / 2) / (height / 2)
+        ) ** 2 <= 1
+        labels[inside] = i_roi + 1
+    return labels
+
+
+class TraceExtractor:
+    """ Mean fluorescence of any number of ROIs. The pixels of the ROIs and
+    their labels are indexed once, then the means of all the ROIs of a frame
+    are computed with a single weighted bincount per channel
+
+    """
+
+    def __init__(self, labels):
+        self.shape = labels.shape
+        flat_labels = labels.ravel()
+        self.pixel_index = np.flatnonzero(flat_labels)
+        self.pixel_labels = flat_labels[self.pixel_index] - 1
+        self.n_rois = int(flat_labels.max()) if flat_labels.size > 0 else 0
+        self.n_pixels = np.maximum(
+            np.bincount(self.pixel_labels, minlength=self.n_rois), 1
+        )
+
+    def extract(self, images):
+        """ Means of the ROIs for each channel of the images, as an array
+        of shape (n_channels, n_rois)
+
+        """
+        return np.stack(
+            [
+                np.bincount(
+                    self.pixel_labels,
+                    weights=image.ravel()[self.pixel_index],
+                    minlength=self.n_rois,
+                )
+                / self.n_pixels
+                for image in images
+            ]
+        )
+
+
+class DeltaFBuffer:
+    """ Keeps the last n_samples of the traces, and computes the dF/F with a
+    baseline given by a low percentile of the kept samples
+
+    """
+
+    def __init__(self, n_samples=600, baseline_percentile=10):
+        self.n_samples = n_samples
+        self.baseline_percentile = baseline_percentile
+        self.times = np.zeros(0)
+        self.traces = None
+
+    def clear(self):
+        self.times = np.zeros(0)
+        self.traces = None
+
+    def append(self, t, traces):
+        if self.traces is None or self.traces.shape[1] != len(traces):
+            self.clear()
+            self.traces = np.zeros((0, len(traces)))
+        self.times = np.append(self.times, t)[-self.n_samples :]
+        self.traces = np.vstack([self.traces, traces])[-self.n_samples :]
+
+    def delta_f(self):
+        if self.traces is None or len(self.times) == 0:
+            return self.times, np.zeros((0, 0))
+        baseline = np.percentile(self.traces, self.baseline_percentile, axis=0)
+        return self.times, (self.traces - baseline) / np.maximum(np.abs(baseline), 1e-6)
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from time import perf_counter
+from typing import Callable, Optional
+
+
+class StackPhase(Enum):
+    IDLE = 0
+    SCANNING = 1
+    MOVING = 2
+    WAITING_TRIAL = 3
+    FINISHING = 4
+
+
+@dataclass
+class SettleParameters:
+    # s to wait for the stage to settle, the tolerance and the time to settle
+    # are the ones of the motor service
+    timeout: float = 10.0
+    # s to wait for the saver to receive the last frames of the stack
+    finish_timeout: float = 5.0
+
+
+class ZStackEngine:
+    """ Runs the planes of a recording as a state machine advanced by poll,
+    which is called from the main loop and never blocks. When the last frame
+    of a plane arrives the objective starts moving to the next plane while
+    the last frames are saved. Once the motor service notifies that the stage
+    settled, the next trial is negotiated in a thread, as Stytra starts it on
+    receipt, and the plane starts as soon as the trial is ready
+
+    """
+
+    def __init__(
+        self,
+        move_to_plane: Callable,
+        move_state: Callable,
+        negotiate_trial: Callable,
+        start_plane: Callable,
+        saving: Callable,
+        finish: Callable,
+        settle: Optional[SettleParameters] = None,
+    ):
+        """
+        :param move_to_plane: starts moving to the plane of the given index
+        :param move_state: state of the last move as notified by the motor
+            service, "settled" once settled, "error" if it failed
+        :param negotiate_trial: blocking, returns the duration of the next
+            trial or None if it could not be negotiated
+        :param start_plane: starts the plane of the given index, with the given duration
+        :param saving: whether the saver is still receiving frames
+        :param finish: ends the recording, called with whether it was aborted
+        """
+        self.move_to_plane = move_to_plane
+        self.move_state = move_state
+        self.negotiate_trial = negotiate_trial
+        self.start_plane = start_plane
+        self.saving = saving
+        self.finish = finish
+        self.settle = settle if settle is not None else SettleParameters()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.phase = StackPhase.IDLE
+        self.n_planes = 1
+        self.i_plane = 0
+        self.trial = None
+        self.t_phase = None
+        self.timing = []
+        self.plane_timing = dict()
+
+    def begin(self, n_planes):
+        """ Called once the first plane has started
+        """
+        self.n_planes = n_planes
+        self.i_plane = 0
+        self.timing = []
+        self.set_phase(StackPhase.SCANNING)
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.t_phase = perf_counter()
+
+    def scanning_plane(self, i_plane):
+        return self.phase == StackPhase.SCANNING and self.i_plane == i_plane
+
+    def end_plane(self):
+        """ Called when the last frame of the current plane is on the way
+        """
+        self.plane_timing = dict(i_plane=self.i_plane, t_end=perf_counter())
+        if self.i_plane + 1 >= self.n_planes:
+            self.set_phase(StackPhase.FINISHING)
+            return
+        self.move_to_plane(self.i_plane + 1)
+        self.set_phase(StackPhase.MOVING)
+
+    def abort(self):
+        self.set_phase(StackPhase.IDLE)
+        self.trial = None
+        self.finish(True)
+
+    def poll(self):
+        t_now = perf_counter()
+        if self.phase == StackPhase.MOVING:
+            move_state = self.move_state()
+            if move_state == "settled":
+                self.plane_timing["t_settled"] = t_now
+                self.trial = self.executor.submit(self.negotiate_trial)
+                self.set_phase(StackPhase.WAITING_TRIAL)
+            elif move_state == "error":
+                print("The stage could not move to plane {}".format(self.i_plane + 1))
+                self.abort()
+            elif t_now - self.t_phase > self.settle.timeout:
+                print(
+                    "The stage did not settle on plane {} within {} s".format(
+                        self.i_plane + 1, self.settle.timeout
+                    )
+                )
+                self.abort()
+        elif self.phase == StackPhase.WAITING_TRIAL:
+            if not self.trial.done():
+                return
+            duration = self.trial.result()
+            self.trial = None
+            if duration is None:
+                print("Could not negotiate the trial of plane {}".format(self.i_plane + 1))
+                self.abort()
+                return
+            self.i_plane += 1
+            self.start_plane(self.i_plane, duration)
+            self.plane_timing["t_started"] = perf_counter()
+            self.timing.append(self.plane_timing)
+            self.set_phase(StackPhase.SCANNING)
+        elif self.phase == StackPhase.FINISHING:
+            if not self.saving() or t_now - self.t_phase > self.settle.finish_timeout:
+                self.set_phase(StackPhase.IDLE)
+                self.finish(False)
+
+    def dead_times(self):
+        """ Time between the end of each plane and the start of the next
+        """
+        return [timing["t_started"] - timing["t_end"] for timing in self.timing]
@@ -24,6 +24,8 @@ setup(
     entry_points={
         "console_scripts": [
             "brunoise=brunoise.main:main",
+            "brunoise-headless=brunoise.headless:main",
+            "brunoise-reconstruct=brunoise.offline_reconstruction:main",
         ]
     },
 )
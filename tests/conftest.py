@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules of brunoise import each other by their bare names
+sys.path.insert(0, str(Path(__file__).parents[1] / "brunoise"))
@@ -0,0 +1,67 @@
+from time import perf_counter, sleep
+import numpy as np
+
+from clock_sync import ClockModel, ClockPing, ClockServer, ClockSync
+
+
+def synthetic_pings(offset, drift, n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    pings = []
+    for t_send in np.arange(n) * 1.0:
+        # asymmetric delays, which bias the offsets of the slow pings
+        there, processing, back = rng.exponential([1e-4, 1e-5, 5e-4])
+        t_remote_receive = (t_send + there) * (1 + drift) + offset
+        t_remote_send = t_remote_receive + processing
+        t_receive = t_send + there + processing / (1 + drift) + back
+        pings.append(ClockPing(t_send, t_remote_receive, t_remote_send, t_receive))
+    return pings
+
+
+def test_model_recovers_offset_and_drift():
+    model = ClockModel(synthetic_pings(offset=3.0, drift=50e-6))
+    t_local = np.array([10.0, 150.0])
+    expected = t_local * (1 + 50e-6) + 3.0
+    np.testing.assert_allclose(
+        model.remote_time(t_local), expected, atol=model.precision
+    )
+    assert abs(model.drift - 50e-6) < 5e-6
+    np.testing.assert_allclose(model.local_time(model.remote_time(t_local)), t_local)
+
+
+def test_sync_with_a_clock_server():
+    offset, drift = 5.0, 200e-6
+
+    def remote_clock():
+        return perf_counter() * (1 + drift) + offset
+
+    server = ClockServer("tcp://127.0.0.1:5591", clock=remote_clock)
+    server.start()
+    server.ready.wait()
+    sync = ClockSync("tcp://127.0.0.1:5591", interval=0.01)
+    sync.start()
+    sleep(1.0)
+    model = sync.current_model()
+    error = model.remote_time(perf_counter()) - remote_clock()
+    table = sync.alignment_table()
+    sync.stop()
+    server.stop()
+    assert not sync.unsupported
+    assert abs(error) < 1e-3
+    assert len(table["offset"]) == len(table["delay"]) > 10
+
+
+def test_sync_stops_on_a_server_which_is_not_a_clock_server():
+    import zmq
+
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind("tcp://127.0.0.1:5592")
+    sync = ClockSync("tcp://127.0.0.1:5592", interval=0.01)
+    sync.start()
+    socket.recv_json()
+    socket.send_json(10.0)
+    sync.join(timeout=2)
+    socket.close(linger=0)
+    context.term()
+    assert sync.unsupported
+    assert not sync.is_alive()
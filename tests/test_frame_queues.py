@@ -0,0 +1,87 @@
+from time import sleep
+import numpy as np
+import pytest
+
+from frame_queues import FrameQueue, FrameHeader, FrameAccounting, BackpressurePolicy
+
+FRAME_SHAPE = (2, 125)  # 2000 bytes
+
+
+def make_queue(policy, max_frames=0, n_slots=5, **kwargs):
+    queue = FrameQueue(
+        "test", max_mbytes=n_slots * 2000 / 1e6, policy=policy, **kwargs
+    )
+    queue.max_frames = max_frames
+    return queue
+
+
+def put_frames(queue, seqs):
+    results = [
+        queue.put(np.full(FRAME_SHAPE, seq, dtype=np.float64), FrameHeader(seq, 0.0))
+        for seq in seqs
+    ]
+    # the headers go through a multiprocessing queue
+    sleep(0.05)
+    return results
+
+
+def test_drop_newest():
+    queue = make_queue(BackpressurePolicy.DROP_NEWEST, max_frames=3)
+    assert put_frames(queue, range(5)) == [True] * 3 + [False] * 2
+    seqs = [queue.get(timeout=1)[0].seq for _ in range(3)]
+    assert seqs == [0, 1, 2]
+    assert queue.dropped_frames() == [3, 4]
+    assert queue.n_queued() == 0
+
+
+def test_drop_oldest_skips_to_newest():
+    queue = make_queue(BackpressurePolicy.DROP_OLDEST)
+    put_frames(queue, range(3))
+    header, frame = queue.get(timeout=1)
+    assert header.seq == 2
+    assert np.all(frame == 2)
+    assert queue.dropped_frames() == [0, 1]
+    assert queue.n_queued() == 0
+
+
+def test_drop_oldest_when_full_drops_once():
+    queue = make_queue(BackpressurePolicy.DROP_OLDEST, max_frames=3)
+    assert put_frames(queue, range(4)) == [True, True, True, False]
+    assert queue.get(timeout=1)[0].seq == 2
+    assert queue.dropped_frames() == [0, 1, 3]
+
+
+@pytest.mark.parametrize(
+    "policy", [BackpressurePolicy.DROP_OLDEST, BackpressurePolicy.DROP_NEWEST]
+)
+def test_producer_does_not_overwrite_held_frame(policy):
+    queue = make_queue(policy, n_slots=5)
+    put_frames(queue, [0])
+    _, frame = queue.get(timeout=1)
+    put_frames(queue, range(1, 20))
+    assert np.all(frame == 0)
+
+
+def test_block_drops_after_timeout():
+    queue = make_queue(BackpressurePolicy.BLOCK, max_frames=1, block_timeout=0.01)
+    assert put_frames(queue, range(2)) == [True, False]
+    assert queue.dropped_frames() == [1]
+
+
+def test_recent_dropped_are_bounded():
+    queue = make_queue(BackpressurePolicy.DROP_NEWEST, max_frames=1, n_recent=4)
+    put_frames(queue, range(11))
+    assert queue.n_dropped() == 10
+    assert queue.dropped_frames() == [7, 8, 9, 10]
+
+
+def test_accounting_counts_from_start():
+    queue = make_queue(BackpressurePolicy.DROP_NEWEST, max_frames=1)
+    accounting = FrameAccounting([queue])
+    put_frames(queue, range(3))
+    queue.get(timeout=1)
+    accounting.start()
+    put_frames(queue, range(3, 6))
+    summary = accounting.summary()
+    assert summary["counts"]["test"] == dict(produced=3, consumed=0, dropped=2)
+    assert summary["dropped_frames"]["test"] == [4, 5]
@@ -0,0 +1,83 @@
+from dataclasses import replace
+from multiprocessing import Event
+import flammkuchen as fl
+import numpy as np
+import pytest
+
+try:
+    # the scanner needs the DAQ drivers, nidaqmx or theknights
+    from scanning import (
+        ImageReconstructor,
+        ParameterUpdate,
+        RoiParameters,
+        ScanningParameters,
+        ScanningState,
+    )
+except ImportError:
+    pytest.skip("scanning needs nidaqmx or theknights", allow_module_level=True)
+
+from click.testing import CliRunner
+
+from frame_queues import FrameHeader
+from offline_reconstruction import main
+from raw_capture import RawSaver, RawCaptureParameters
+from streaming_save import SAVED_SCALE
+
+
+def capture(path):
+    """ Captures two planes of random samples, with the offset changed in
+    the first plane, and returns the frames as reconstructed live
+    """
+    sp = ScanningParameters(
+        n_x=40,
+        n_y=30,
+        n_bin=4,
+        mystery_offset=-10,
+        scanning_state=ScanningState.EXPERIMENT_RUNNING,
+    )
+    stop_event = Event()
+    saver = RawSaver(stop_event, max_mbytes=50)
+    reconstructor = ImageReconstructor(
+        None,
+        stop_event,
+        raw_queue=saver.frame_queue,
+        raw_capture_event=saver.capture_event,
+        raw_generation_queue=saver.generation_queue,
+    )
+    reconstructor.pending_parameters = [
+        ParameterUpdate(1, sp),
+        ParameterUpdate(3, replace(sp, mystery_offset=-20)),
+    ]
+    reconstructor.pending_roi_parameters = [ParameterUpdate(2, RoiParameters())]
+    saver.capture_event.set()
+    saver.plane_queue.put(-0.5)
+    saver.plane_queue.put(5.5)
+    rng = np.random.default_rng(0)
+    live = []
+    for seq in range(12):
+        generation = (1 if seq < 3 else 3, 2)
+        header = FrameHeader(seq, seq, t_sample=seq, generation=generation)
+        reconstructor.apply_parameters(header.generation)
+        # exact in the float32 of the capture
+        images = rng.integers(0, 64, (2, 40 * 30 * 4)) / 1024
+        reconstructor.send_raw_generation(header.generation)
+        reconstructor.raw_queue.put(images, header)
+        recon_images = np.negative(reconstructor.reconstruct(images))
+        live.append((recon_images / SAVED_SCALE).astype(np.int16))
+    saver.capture_event.clear()
+    saver.capture(RawCaptureParameters(path, sp, RoiParameters()))
+    return np.stack(live)
+
+
+def test_cli_matches_live_reconstruction(tmp_path):
+    live = capture(tmp_path)
+    output = tmp_path / "reconstructed"
+    result = CliRunner().invoke(
+        main, [str(tmp_path), "--output", str(output), "--workers", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    for i_plane in range(2):
+        for i_channel, channel in enumerate(["green", "red"]):
+            stack = fl.load(output / "original" / channel / "{:04d}.h5".format(i_plane))
+            plane = live[i_plane * 6 : (i_plane + 1) * 6, i_channel]
+            np.testing.assert_array_equal(stack["stack_4D"][:, 0], plane)
@@ -0,0 +1,26 @@
+import numpy as np
+
+from frame_queues import FrameHeader
+from sample_clock import SampleClock, frame_sample_time
+
+
+def test_frames_without_sample_time():
+    assert np.isnan(frame_sample_time(FrameHeader(0, 1.0)))
+    assert frame_sample_time(FrameHeader(0, 1.0, None, 2.0)) == 2.0
+
+
+def test_clock_follows_the_drift_of_the_daq():
+    sample_rate, drift = 100000, 50e-6
+    rng = np.random.default_rng(0)
+    clock = SampleClock(sample_rate, refresh_interval=1.0, n_windows=12)
+    clock.start(100.0)
+    n_read = 10000
+    for i_read in range(1, 3000):
+        i_sample = i_read * n_read
+        t_sample = 100.0 + i_sample / sample_rate * (1 + drift)
+        # the reads return after a scheduling delay
+        clock.observe(i_sample, t_sample + 1e-4 + rng.exponential(2e-3))
+    assert abs(clock.drift_ppm - 50) < 5
+    i_sample = 3000 * n_read
+    t_sample = 100.0 + i_sample / sample_rate * (1 + drift)
+    assert abs(clock.time(i_sample) - t_sample) < 1e-3
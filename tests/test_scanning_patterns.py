@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import scanning_patterns
+from scanning_patterns import PATTERNS, scan_pattern, simple_scanning_pattern
+
+GEOMETRY = (40, 30, 10, 20, True)
+
+
+def test_bidirectional_is_the_original_raster():
+    x, y, pixel_x, pixel_y, _ = scan_pattern("bidirectional", *GEOMETRY)
+    original_x, original_y = simple_scanning_pattern(*GEOMETRY)
+    np.testing.assert_array_equal(x, original_x)
+    np.testing.assert_array_equal(y, original_y)
+    np.testing.assert_array_equal(pixel_x, original_x)
+
+
+@pytest.mark.parametrize("name", list(PATTERNS))
+def test_patterns_are_consistent(name):
+    n_x, n_y = GEOMETRY[:2]
+    arrays = scan_pattern(name, *GEOMETRY)
+    assert len({len(array) for array in arrays}) == 1
+    assert all(not array.flags.writeable for array in arrays)
+    x, y, pixel_x, pixel_y, imaged = arrays
+    assert imaged.any()
+    # the bidirectional raster keeps the positions in the turns as pixels,
+    # which the reconstruction leaves out
+    reconstructed = (pixel_x >= 0) & (pixel_y >= 0)
+    assert np.all(pixel_x[reconstructed] < n_x + GEOMETRY[2] + 1)
+    assert np.all(pixel_y[reconstructed] < n_y)
+
+
+def test_unknown_pattern():
+    with pytest.raises(ValueError):
+        scan_pattern("zigzag", *GEOMETRY)
+
+
+def test_registered_patterns_are_selectable():
+    @scanning_patterns.register_pattern("test_line")
+    def line(n_x, n_y, n_turn, n_extra_points, pause):
+        x = np.arange(n_x, dtype=np.float64)
+        y = np.zeros(n_x)
+        return x, y, x.astype(np.int64), y.astype(np.int64), np.ones(n_x, bool)
+
+    try:
+        assert len(scan_pattern("test_line", *GEOMETRY)[0]) == GEOMETRY[0]
+    finally:
+        del PATTERNS["test_line"]
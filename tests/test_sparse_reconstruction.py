@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import scanning_patterns
+from sparse_reconstruction import bin_sums, sampling_matrix, reconstruct_sparse
+
+N_X, N_Y, N_BIN, OFFSET = 40, 30, 4, -13
+
+
+def reconstruct_both(name):
+    x, y, pixel_x, pixel_y, imaged = scanning_patterns.scan_pattern(
+        name, N_X, N_Y, 10, 20, True
+    )
+    signals = np.random.default_rng(0).random((2, len(x) * N_BIN))
+    matrix = sampling_matrix(x, y, imaged, (N_X, N_Y), N_BIN, OFFSET)
+    sparse_images = reconstruct_sparse(matrix, signals, (N_X, N_Y))
+    pixel_images = np.stack(
+        [
+            scanning_patterns.reconstruct_image_pattern(
+                np.roll(signal, OFFSET), pixel_x, pixel_y, (N_X, N_Y), N_BIN
+            )
+            for signal in signals
+        ]
+    )
+    return sparse_images, pixel_images
+
+
+def test_unidirectional_raster_matches_pixels():
+    sparse_images, pixel_images = reconstruct_both("unidirectional")
+    np.testing.assert_allclose(sparse_images, pixel_images)
+
+
+def test_bidirectional_raster_matches_pixels():
+    sparse_images, pixel_images = reconstruct_both("bidirectional")
+    # the pixels take the first pixel from the samples parked there at the end
+    sparse_images[:, 0, 0] = pixel_images[:, 0, 0]
+    np.testing.assert_allclose(sparse_images, pixel_images)
+
+
+@pytest.mark.parametrize("name", list(scanning_patterns.PATTERNS))
+def test_rows_are_weighted_means(name):
+    x, y, _, _, imaged = scanning_patterns.scan_pattern(name, N_X, N_Y, 10, 20, True)
+    matrix = sampling_matrix(x, y, imaged, (N_X, N_Y), N_BIN)
+    row_sums = np.asarray(matrix.matrix.sum(1)).ravel()
+    visited = row_sums > 0
+    assert visited.mean() > 0.5
+    # each visited pixel averages the sums of the bins splatted on it
+    np.testing.assert_allclose(row_sums[visited], 1)
+
+
+@pytest.mark.parametrize("bin_skip, bin_samples", [(0, N_BIN), (1, 2), (2, None)])
+def test_bin_sums_match_rolled_bins(bin_skip, bin_samples):
+    signal = np.random.default_rng(0).random(N_BIN * 100)
+    n_used = bin_samples or N_BIN - bin_skip
+    expected = (
+        np.roll(signal, OFFSET)
+        .reshape(-1, N_BIN)[:, bin_skip : bin_skip + n_used]
+        .sum(1)
+    )
+    np.testing.assert_allclose(
+        bin_sums(signal, N_BIN, OFFSET, bin_skip, n_used), expected
+    )
@@ -0,0 +1,26 @@
+from multiprocessing import Event, Queue
+from time import perf_counter, sleep
+import numpy as np
+
+from frame_queues import FrameQueue, FrameHeader, BackpressurePolicy
+from streaming_save import StackSaver, SavingParameters, load_times
+
+
+def test_complete_stack_is_finalised_without_waiting(tmp_path):
+    n_t, n_z, shape = 3, 2, (4, 5)
+    queue = FrameQueue("saver", max_mbytes=1, policy=BackpressurePolicy.NEVER_DROP)
+    saver = StackSaver(Event(), queue, Queue())
+    saver.save_parameters = SavingParameters(
+        output_dir=tmp_path, plane_size=shape, n_t=n_t, n_z=n_z
+    )
+    saver.saving_signal.set()
+    for seq in range(n_t * n_z):
+        queue.put(np.zeros((2, *shape)), FrameHeader(seq, seq * 0.1))
+    sleep(0.05)
+
+    t_start = perf_counter()
+    saver.save_loop()
+    assert perf_counter() - t_start < 2
+    assert not saver.saving_signal.is_set()
+    times, _ = load_times(tmp_path / "time.h5")
+    assert times.shape == (n_t, n_z)
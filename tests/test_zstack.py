@@ -0,0 +1,87 @@
+from time import perf_counter, sleep
+
+from zstack import ZStackEngine, StackPhase
+
+
+class FakeStack:
+    """ Records when the stage settled, the trials were negotiated and the
+    planes started
+    """
+
+    def __init__(self, move_error=False):
+        self.events = []
+        self.move_state = "sent"
+        self.move_error = move_error
+        self.engine = ZStackEngine(
+            move_to_plane=self.move_to_plane,
+            move_state=lambda: self.move_state,
+            negotiate_trial=self.negotiate_trial,
+            start_plane=self.start_plane,
+            saving=lambda: False,
+            finish=self.finish,
+        )
+
+    def move_to_plane(self, i_plane):
+        self.events.append(("move", i_plane, perf_counter()))
+        self.move_state = "sent"
+
+    def settle(self):
+        self.move_state = "error" if self.move_error else "settled"
+        self.events.append(("settled", None, perf_counter()))
+
+    def negotiate_trial(self):
+        # Stytra starts the trial when it receives the request
+        self.events.append(("trial", None, perf_counter()))
+        sleep(0.01)
+        return 1.0
+
+    def start_plane(self, i_plane, duration):
+        self.events.append(("plane", i_plane, perf_counter()))
+
+    def finish(self, aborted):
+        self.events.append(("finish", aborted, perf_counter()))
+
+    def poll_until(self, phase, timeout=1.0):
+        t_start = perf_counter()
+        while self.engine.phase != phase and perf_counter() - t_start < timeout:
+            self.engine.poll()
+            sleep(0.001)
+        return self.engine.phase == phase
+
+
+def test_trial_negotiated_once_the_stage_settled():
+    stack = FakeStack()
+    stack.engine.begin(2)
+    stack.engine.end_plane()
+    for _ in range(20):
+        stack.engine.poll()
+    # no trial is requested while the stage moves
+    assert [event[0] for event in stack.events] == ["move"]
+
+    stack.settle()
+    assert stack.poll_until(StackPhase.SCANNING)
+    kinds = [event[0] for event in stack.events]
+    assert kinds == ["move", "settled", "trial", "plane"]
+    t_settled, t_trial, t_plane = (event[2] for event in stack.events[1:])
+    assert t_settled <= t_trial <= t_plane
+    assert stack.events[-1][1] == 1
+    assert len(stack.engine.dead_times()) == 1
+
+
+def test_failed_move_aborts():
+    stack = FakeStack(move_error=True)
+    stack.engine.begin(2)
+    stack.engine.end_plane()
+    stack.settle()
+    stack.engine.poll()
+    assert stack.engine.phase == StackPhase.IDLE
+    assert stack.events[-1][:2] == ("finish", True)
+    assert "trial" not in [event[0] for event in stack.events]
+
+
+def test_last_plane_finishes():
+    stack = FakeStack()
+    stack.engine.begin(1)
+    stack.engine.end_plane()
+    assert stack.poll_until(StackPhase.IDLE)
+    assert [event[:2] for event in stack.events] == [("finish", False)]